@@ -0,0 +1,100 @@
+"""Micro-benchmark of LittleChef's JSON codec against the standard library
+
+Builds a realistic kitchen in memory: ohai-enriched nodes with hardware,
+network and virtualization attributes, and roles with attribute trees.
+It then times parsing and serializing all of it with littlechef.codec and
+with the plain json module.
+
+Usage: python benchmarks/bench_codec.py [--nodes N] [--repeat N]
+
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from littlechef import codec
+
+
+def make_node(i, rand):
+    """Returns a node dictionary as saved by plugins after an ohai run"""
+    name = "web{0:05d}.example.com".format(i)
+    return {
+        "name": name,
+        "chef_environment": rand.choice(["production", "staging", "dev"]),
+        "run_list": ["role[base]", "role[web]", "recipe[nginx::server]"],
+        "tags": ["web", "frontend"],
+        "ipaddress": "10.0.{0}.{1}".format(i // 250, i % 250),
+        "cpu": dict(("{0}".format(c), {
+            "vendor_id": "GenuineIntel", "model_name": "Xeon E5-2670",
+            "mhz": 2600.0 + rand.random(), "cache_size": "20480 KB",
+            "flags": ["fpu", "vme", "de", "pse", "tsc", "msr", "pae"] * 8,
+        }) for c in range(16)),
+        "network": {"interfaces": dict(("eth{0}".format(n), {
+            "addresses": dict(("10.{0}.{1}.{2}".format(n, i % 250, a), {
+                "family": "inet", "prefixlen": "24",
+                "netmask": "255.255.255.0", "scope": "Global"})
+                for a in range(4)),
+            "mtu": 1500, "state": "up", "flags": ["BROADCAST", "UP"],
+        }) for n in range(4))},
+        "virtualization": {
+            "system": "xen", "role": "host",
+            "guests": [{"fqdn": "guest{0}-{1}.example.com".format(i, g),
+                        "memory": 2048, "vcpus": 2} for g in range(8)],
+        },
+        "filesystem": dict(("/dev/xvda{0}".format(d), {
+            "kb_size": rand.randint(10 ** 6, 10 ** 9), "kb_used": 1024,
+            "percent_used": "{0}%".format(rand.randint(1, 99)),
+            "mount": "/mnt/{0}".format(d), "fs_type": "ext4",
+        }) for d in range(12)),
+    }
+
+
+def timed(func, docs, repeat):
+    """Returns the best wall time of applying func to all docs"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for doc in docs:
+            func(doc)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--nodes", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rand = random.Random(42)
+    nodes = [make_node(i, rand) for i in range(args.nodes)]
+    pretty = [json.dumps(n, indent=4, sort_keys=True) for n in nodes]
+    size = sum(len(p) for p in pretty)
+    print("{0} nodes, {1:.1f} MB of JSON".format(len(nodes), size / 1e6))
+    print("codec backends: decoder={0} encoder={1}\n".format(
+          codec.DECODER, codec.ENCODER))
+
+    results = [
+        ("parse", timed(json.loads, pretty, args.repeat),
+         timed(codec.loads, pretty, args.repeat)),
+        ("serialize (data bag)", timed(json.dumps, nodes, args.repeat),
+         timed(codec.dumps, nodes, args.repeat)),
+        ("serialize (nodes/)",
+         timed(lambda n: json.dumps(n, indent=4, sort_keys=True), nodes,
+               args.repeat),
+         timed(codec.dumps_pretty, nodes, args.repeat)),
+    ]
+    print("{0:<22}{1:>10}{2:>10}{3:>10}".format(
+          "operation", "json", "codec", "speedup"))
+    for name, stdlib, fast in results:
+        print("{0:<22}{1:>9.3f}s{2:>9.3f}s{3:>9.2f}x".format(
+              name, stdlib, fast, stdlib / fast))
+
+
+if __name__ == "__main__":
+    main()
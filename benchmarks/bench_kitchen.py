@@ -0,0 +1,258 @@
+"""Benchmark suite of kitchen loading and node data bag building
+
+Generates synthetic kitchens (see benchmarks/kitchen.py) of the given sizes
+and measures the wall time, peak memory and number of files opened by:
+
+* lib.get_nodes()
+* lib.get_roles_in_node(recursive=True), for every node
+* lib.get_recipes()
+* chef.build_node_data_bag()
+
+Every measurement runs in a new process, first with an empty kitchen cache
+(cold) and then with the cache left by the cold run (warm). Parallel loading
+is disabled unless --parallel is given, so that every file is opened in the
+measured process. Peak memory is that of the whole process, the "setup" peak
+is the one before the measured call (loading the nodes to expand).
+
+Results are saved as JSON, by default to benchmarks/results/<commit>.json,
+and can be compared with those of another commit with --compare.
+
+Usage: python benchmarks/bench_kitchen.py [--sizes N,N] [--repeat N]
+           [--only NAME,NAME] [--parallel] [--output FILE] [--compare FILE]
+           [kitchen options, see benchmarks/kitchen.py]
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+import kitchen
+
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+
+def _get_nodes(lib, chef):
+    return None, lambda _: lib.get_nodes()
+
+
+def _get_roles_in_node(lib, chef):
+    def expand(nodes):
+        graph = lib.RoleGraph()
+        for node in nodes:
+            lib.get_roles_in_node(node, recursive=True, graph=graph)
+    return lib.get_nodes, expand
+
+
+def _get_recipes(lib, chef):
+    return None, lambda _: lib.get_recipes()
+
+
+def _build_node_data_bag(lib, chef):
+    return None, lambda _: chef.build_node_data_bag()
+
+
+# name: function returning (setup, measured call) given lib and chef
+ENTRY_POINTS = OrderedDict([
+    ('get_nodes', _get_nodes),
+    ('get_roles_in_node', _get_roles_in_node),
+    ('get_recipes', _get_recipes),
+    ('build_node_data_bag', _build_node_data_bag),
+])
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, OS X bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _count_opens():
+    """Wraps the functions used to open files, returns the counter"""
+    try:
+        import __builtin__ as builtins
+    except ImportError:
+        import builtins
+    import io
+    counter = {'files': 0}
+
+    def counting(func):
+        def wrapper(*args, **kwargs):
+            counter['files'] += 1
+            return func(*args, **kwargs)
+        return wrapper
+    builtins.open = counting(builtins.open)
+    io.open = counting(io.open)
+    os.open = counting(os.open)
+    return counter
+
+
+def measure(entry, kitchen_path, parallel):
+    """Runs one entry point in this process, returns its measurements"""
+    os.chdir(kitchen_path)
+    import littlechef
+    from littlechef import lib, chef
+    if not parallel:
+        littlechef.parallel_load_threshold = 0
+    setup, func = ENTRY_POINTS[entry](lib, chef)
+    data = setup() if setup else None
+    setup_rss = _peak_rss_kb()
+    counter = _count_opens()
+    start = time.time()
+    func(data)
+    wall = time.time() - start
+    return {
+        'wall': wall,
+        'peak_rss_kb': _peak_rss_kb(),
+        'setup_rss_kb': setup_rss,
+        'files_opened': counter['files'],
+    }
+
+
+def run_child(entry, kitchen_path, parallel):
+    """Measures an entry point in a new process"""
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', entry, '--kitchen', kitchen_path]
+    if parallel:
+        command.append('--parallel')
+    # Keep the deprecation warnings of paramiko and friends out of the table
+    environ = dict(os.environ, PYTHONWARNINGS='ignore')
+    output = subprocess.check_output(command, env=environ)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run_entry(entry, kitchen_path, cache, repeat, parallel):
+    """Returns the measurements of the fastest of repeat runs"""
+    cache_path = os.path.join(kitchen_path, '.littlechef')
+    best = None
+    for _ in range(repeat):
+        if cache == 'cold' and os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        elif cache == 'warm' and not os.path.exists(cache_path):
+            run_child(entry, kitchen_path, parallel)
+        result = run_child(entry, kitchen_path, parallel)
+        if best is None or result['wall'] < best['wall']:
+            best = result
+    return best
+
+
+def _git_revision():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BENCHMARKS_DIR).decode('utf-8').strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+                                cwd=BENCHMARKS_DIR)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def _result_key(result):
+    return (result['nodes'], result['entry'], result['cache'])
+
+
+def print_results(results, previous=None):
+    """Prints a table of results, with the change in wall time and memory
+    against the previous results when given
+
+    """
+    header = "{0:>7} {1:<20}{2:<6}{3:>10}{4:>11}{5:>8}".format(
+        "nodes", "entry point", "cache", "wall", "peak RSS", "opens")
+    if previous:
+        header += "{0:>9}{1:>9}".format("wall", "RSS")
+    print(header)
+    old = dict((_result_key(r), r) for r in (previous or []))
+    for result in results:
+        line = "{0:>7} {1:<20}{2:<6}{3:>9.3f}s{4:>8.1f} MB{5:>8}".format(
+            result['nodes'], result['entry'], result['cache'],
+            result['wall'], result['peak_rss_kb'] / 1024.0,
+            result['files_opened'])
+        before = old.get(_result_key(result))
+        if before:
+            line += "{0:>+8.0f}%{1:>+8.0f}%".format(
+                100.0 * (result['wall'] / max(before['wall'], 1e-6) - 1),
+                100.0 * (float(result['peak_rss_kb']) /
+                         before['peak_rss_kb'] - 1))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--sizes", default="1000,5000",
+                        help="node counts of the generated kitchens")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--only", default=','.join(ENTRY_POINTS),
+                        help="entry points to measure")
+    parser.add_argument("--parallel", action='store_true',
+                        help="keep the default parallel loading threshold")
+    parser.add_argument("--output", help="file to save the results to")
+    parser.add_argument("--compare", help="results file to compare with")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--kitchen", help=argparse.SUPPRESS)
+    kitchen.add_arguments(parser, skip=['nodes'])
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.kitchen, args.parallel)))
+        return
+    entries = args.only.split(',')
+    for entry in entries:
+        if entry not in ENTRY_POINTS:
+            sys.exit("Unknown entry point {0}".format(entry))
+    options = dict((option, getattr(args, option))
+                   for option in kitchen.DEFAULTS if option != 'nodes')
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    report = OrderedDict([
+        ('revision', _git_revision()),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('parallel', args.parallel),
+        ('kitchen', options),
+        ('results', []),
+    ])
+    workdir = tempfile.mkdtemp(prefix='littlechef-bench-')
+    try:
+        for size in [int(n) for n in args.sizes.split(',')]:
+            kitchen_path = os.path.join(workdir, str(size))
+            start = time.time()
+            kitchen.generate(kitchen_path, nodes=size, **options)
+            print("Generated a kitchen with {0} nodes in {1:.1f}s".format(
+                  size, time.time() - start))
+            for entry in entries:
+                for cache in ['cold', 'warm']:
+                    result = OrderedDict([
+                        ('nodes', size), ('entry', entry), ('cache', cache)])
+                    result.update(run_entry(entry, kitchen_path, cache,
+                                            args.repeat, args.parallel))
+                    report['results'].append(result)
+            shutil.rmtree(kitchen_path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("")
+    print_results(report['results'], previous)
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, report['revision'] + '.json')
+    with open(output, 'w') as f:
+        f.write(json.dumps(report, indent=2))
+    print("\nResults saved to {0}".format(output))
+
+
+if __name__ == "__main__":
+    main()
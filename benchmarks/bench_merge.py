@@ -0,0 +1,148 @@
+"""Benchmark of the node attribute merge against fleet and catalog size
+
+Builds an in-memory catalog of cookbook recipes with default attributes and
+roles, and a fleet of nodes sharing a few distinct run_lists. It then times
+merging the attributes of every node, with the name-keyed AttributeCatalog
+and layered attributes, and with the former linear scans over the
+recipe and role lists.
+
+Usage: python benchmarks/bench_merge.py [--nodes N,N] [--recipes N,N]
+                                        [--run-lists N] [--repeat N]
+
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from littlechef import chef, attributes
+
+
+def make_catalog(num_recipes, rand):
+    """Returns (recipes, roles) as returned by lib.get_recipes/get_roles"""
+    recipes = []
+    for i in range(num_recipes):
+        cookbook = "cookbook{0}".format(i // 4)
+        name = cookbook if i % 4 == 0 else "{0}::r{1}".format(cookbook, i % 4)
+        attrs = {}
+        for a in range(20):
+            attrs["{0}/section{1}/attr{2}".format(
+                cookbook, a % 4, a)] = {
+                    'default': rand.choice(["true", "false", "value", 80]),
+                    'type': 'string'}
+        attrs["{0}/options".format(cookbook)] = {'type': 'hash'}
+        recipes.append({'name': name, 'attributes': attrs})
+    roles = []
+    for i in range(max(1, num_recipes // 10)):
+        roles.append({
+            'name': "role{0}".format(i),
+            'default_attributes': {"cookbook{0}".format(i): {"port": i}},
+            'override_attributes': {"cookbook{0}".format(i): {"debug": True}},
+        })
+    return recipes, roles
+
+
+def make_nodes(num_nodes, num_run_lists, recipes, roles, rand):
+    """Returns expanded nodes, sharing num_run_lists distinct recipe lists"""
+    expansions = []
+    for _ in range(num_run_lists):
+        expansions.append((
+            [r['name'] for r in rand.sample(recipes, min(15, len(recipes)))],
+            [r['name'] for r in rand.sample(roles, min(3, len(roles)))]))
+    nodes = []
+    for i in range(num_nodes):
+        node_recipes, node_roles = expansions[i % num_run_lists]
+        nodes.append({
+            'name': "node{0}.example.com".format(i),
+            'chef_environment': '_default',
+            'recipes': list(node_recipes), 'roles': list(node_roles),
+            'cookbook0': {'section0': {'attr0': 'node'}},
+        })
+    return nodes
+
+
+def linear_merge(node, all_recipes, all_roles):
+    """Cookbook and role default merge with the former linear scans"""
+    merged = {}
+    for recipe in node['recipes']:
+        for r in all_recipes:
+            if recipe == r['name']:
+                for attr in r['attributes']:
+                    if r['attributes'][attr].get('type') == "hash":
+                        value = {}
+                    else:
+                        value = r['attributes'][attr].get('default')
+                    chef.build_dct(merged, attr.split("/"), value)
+    for role in node['roles']:
+        for r in all_roles:
+            if role == r['name']:
+                chef.update_dct(merged, r.get('default_attributes', {}))
+    for role in node['roles']:
+        for r in all_roles:
+            if role == r['name']:
+                chef.update_dct(merged, r.get('override_attributes', {}))
+    node.update(merged)
+
+
+def catalog_merge(node, catalog):
+    """Same as linear_merge() through an AttributeCatalog and layers"""
+    layers = [catalog.cookbook_defaults(node)]
+    for role in node['roles']:
+        for r in catalog.get_roles(role):
+            layers.append(r.get('default_attributes', {}))
+    for role in node['roles']:
+        for r in catalog.get_roles(role):
+            layers.append(r.get('override_attributes', {}))
+    node.update(attributes.LayeredAttributes(layers))
+    return attributes.materialize(node)
+
+
+def timed(func, repeat):
+    """Returns the best wall time of calling func"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--nodes", default="500,2000")
+    parser.add_argument("--recipes", default="100,400")
+    parser.add_argument("--run-lists", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{0:>7}{1:>9}{2:>10}{3:>10}{4:>10}".format(
+          "nodes", "recipes", "linear", "catalog", "speedup"))
+    for num_recipes in [int(n) for n in args.recipes.split(',')]:
+        rand = random.Random(42)
+        recipes, roles = make_catalog(num_recipes, rand)
+        for num_nodes in [int(n) for n in args.nodes.split(',')]:
+            nodes = make_nodes(num_nodes, args.run_lists, recipes, roles,
+                               rand)
+
+            def run_linear():
+                for node in deepcopy(nodes):
+                    linear_merge(node, recipes, roles)
+
+            def run_catalog():
+                catalog = chef.AttributeCatalog(recipes, roles)
+                for node in deepcopy(nodes):
+                    catalog_merge(node, catalog)
+
+            linear = timed(run_linear, args.repeat)
+            compiled = timed(run_catalog, args.repeat)
+            print("{0:>7}{1:>9}{2:>9.3f}s{3:>9.3f}s{4:>9.2f}x".format(
+                  num_nodes, num_recipes, linear, compiled,
+                  linear / compiled))
+
+
+if __name__ == "__main__":
+    main()
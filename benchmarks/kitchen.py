@@ -0,0 +1,226 @@
+"""Generator of synthetic kitchens for benchmarking
+
+Writes a kitchen with the given number of nodes, environments, cookbooks and
+roles to a directory:
+
+* cookbooks/<name>/metadata.json with recipes, dependencies on cookbooks
+  with a lower number and default attributes, some of them hashes, plus one
+  recipes/*.rb file per recipe. No metadata.rb is written, so knife is never
+  needed
+* roles nested role_depth levels deep. Roles of the first level list recipes,
+  roles of the next levels list role_fanout roles of the level below and a
+  recipe, and all of them have default and override attributes
+* nodes with a run_list of one top level role and one recipe, normal
+  attributes and an ohai-like 'packages' attribute padding the file to
+  node_size KB
+
+The same arguments and seed always produce the same kitchen.
+
+Usage: python benchmarks/kitchen.py DIRECTORY [--nodes N] [--environments N]
+           [--cookbooks N] [--recipes N] [--attributes N] [--roles N]
+           [--role-depth N] [--role-fanout N] [--node-size KB] [--seed N]
+
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+DEFAULTS = {
+    'nodes': 1000,
+    'environments': 4,
+    'cookbooks': 50,
+    'recipes': 4,
+    'attributes': 20,
+    'roles': 20,
+    'role_depth': 3,
+    'role_fanout': 3,
+    'node_size': 4,
+    'seed': 42,
+}
+
+
+def _write_json(path, data):
+    with open(path, 'w') as f:
+        f.write(json.dumps(data, indent=4, sort_keys=True))
+
+
+def cookbook_name(i):
+    return "cookbook{0:04d}".format(i)
+
+
+def recipe_names(cookbook, num_recipes):
+    """Returns the recipe names of a cookbook, the default one first"""
+    return [cookbook] + ["{0}::recipe{1}".format(cookbook, r)
+                         for r in range(1, num_recipes)]
+
+
+def make_cookbook(path, i, num_recipes, num_attributes, rand):
+    name = cookbook_name(i)
+    recipes = recipe_names(name, num_recipes)
+    os.makedirs(os.path.join(path, 'recipes'))
+    for recipe in recipes:
+        basename = recipe.split('::')[1] if '::' in recipe else 'default'
+        with open(os.path.join(path, 'recipes', basename + '.rb'), 'w') as f:
+            f.write("package '{0}'\n".format(recipe.replace('::', '-')))
+    attributes = {}
+    for a in range(num_attributes):
+        key = "{0}/section{1}/attr{2}".format(name, a % 4, a)
+        if a % 10 == 9:
+            attributes[key] = {'display_name': key, 'type': 'hash'}
+        else:
+            attributes[key] = {
+                'display_name': key, 'type': 'string',
+                'default': rand.choice(["true", "false", "8080", key])}
+    dependencies = {}
+    for dep in rand.sample(range(i), min(i, 3)):
+        dependencies[cookbook_name(dep)] = ">= 0.0.0"
+    _write_json(os.path.join(path, 'metadata.json'), {
+        'name': name,
+        'version': "1.{0}.0".format(i % 10),
+        'description': "Synthetic cookbook {0}".format(name),
+        'maintainer': "LittleChef benchmarks",
+        'license': "Apache 2.0",
+        'dependencies': dependencies,
+        'recipes': dict((r, "Recipe {0}".format(r)) for r in recipes),
+        'attributes': attributes,
+        'platforms': {'ubuntu': ">= 0.0.0"},
+    })
+    return recipes
+
+
+def role_name(level, i):
+    return "level{0}_role{1:03d}".format(level, i)
+
+
+def make_roles(path, options, all_recipes, rand):
+    """Writes the nested roles, returns the names of the top level roles"""
+    os.makedirs(path)
+    for level in range(options['role_depth']):
+        for i in range(options['roles']):
+            if level == 0:
+                run_list = ["recipe[{0}]".format(r)
+                            for r in rand.sample(all_recipes, 3)]
+            else:
+                run_list = ["role[{0}]".format(role_name(level - 1, r))
+                            for r in rand.sample(range(options['roles']),
+                                                 options['role_fanout'])]
+                run_list.append("recipe[{0}]".format(
+                    rand.choice(all_recipes)))
+            cookbook = rand.choice(all_recipes).split('::')[0]
+            name = role_name(level, i)
+            _write_json(os.path.join(path, name + '.json'), {
+                'name': name,
+                'description': "Synthetic role {0}".format(name),
+                'chef_type': 'role',
+                'json_class': 'Chef::Role',
+                'run_list': run_list,
+                'default_attributes': {
+                    cookbook: {'section0': {'role_default': name}}},
+                'override_attributes': {
+                    cookbook: {'section1': {'role_override': name}}},
+            })
+    return [role_name(options['role_depth'] - 1, i)
+            for i in range(options['roles'])]
+
+
+def environment_name(i):
+    return "env{0:02d}".format(i)
+
+
+def make_environment(path, i):
+    name = environment_name(i)
+    _write_json(path, {
+        'name': name,
+        'description': "Synthetic environment {0}".format(name),
+        'chef_type': 'environment',
+        'json_class': 'Chef::Environment',
+        'cookbook_versions': {},
+        'default_attributes': {'environment': {'name': name}},
+        'override_attributes': {'environment': {'tier': i % 3}},
+    })
+
+
+def make_node(i, options, top_roles, all_recipes, rand):
+    name = "node{0:06d}.example.com".format(i)
+    node = {
+        'name': name,
+        'chef_environment': environment_name(i % options['environments']),
+        'run_list': ["role[{0}]".format(rand.choice(top_roles)),
+                     "recipe[{0}]".format(rand.choice(all_recipes))],
+        'tags': ["rack{0}".format(i % 40)],
+        'ipaddress': "10.{0}.{1}.{2}".format(
+            i // 62500, i // 250 % 250, i % 250),
+        'apache': {'listen_ports': [80, 443], 'node_id': i},
+        'packages': {},
+    }
+    # Pad the node with ohai-like package data up to node_size KB
+    size = len(json.dumps(node, indent=4))
+    packages = node['packages']
+    while size < options['node_size'] * 1024:
+        package = {'version': "{0}.{1}.{2}-1".format(
+            rand.randint(0, 9), rand.randint(0, 20), rand.randint(0, 99)),
+            'arch': 'amd64'}
+        key = "package{0:05d}".format(len(packages))
+        packages[key] = package
+        size += len(json.dumps({key: package}, indent=4)) + 8
+    return node
+
+
+def generate(path, **kwargs):
+    """Writes a synthetic kitchen to the given directory, which must not
+    exist. Options not given default to those in DEFAULTS
+
+    """
+    options = dict(DEFAULTS, **kwargs)
+    rand = random.Random(options['seed'])
+    os.makedirs(path)
+    for dirname in ['site-cookbooks', 'data_bags', 'plugins']:
+        os.makedirs(os.path.join(path, dirname))
+    all_recipes = []
+    for i in range(options['cookbooks']):
+        all_recipes.extend(make_cookbook(
+            os.path.join(path, 'cookbooks', cookbook_name(i)), i,
+            options['recipes'], options['attributes'], rand))
+    top_roles = make_roles(os.path.join(path, 'roles'), options,
+                           all_recipes, rand)
+    os.makedirs(os.path.join(path, 'environments'))
+    for i in range(options['environments']):
+        make_environment(os.path.join(
+            path, 'environments', environment_name(i) + '.json'), i)
+    os.makedirs(os.path.join(path, 'nodes'))
+    for i in range(options['nodes']):
+        node = make_node(i, options, top_roles, all_recipes, rand)
+        _write_json(os.path.join(path, 'nodes', node['name'] + '.json'), node)
+    with open(os.path.join(path, 'littlechef.cfg'), 'w') as f:
+        f.write("[userinfo]\nuser = benchmark\npassword = benchmark\n")
+    return options
+
+
+def add_arguments(parser, skip=()):
+    """Adds the kitchen options, but those in skip, to an argparse parser"""
+    for option in ['nodes', 'environments', 'cookbooks', 'recipes',
+                   'attributes', 'roles', 'role_depth', 'role_fanout',
+                   'node_size', 'seed']:
+        if option in skip:
+            continue
+        parser.add_argument("--" + option.replace('_', '-'), type=int,
+                            default=DEFAULTS[option], dest=option)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("directory")
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    path = args.pop('directory')
+    if os.path.exists(path):
+        sys.exit("{0} already exists".format(path))
+    generate(path, **args)
+    print("Generated a kitchen with {0} nodes in {1}".format(
+          args['nodes'], path))
+
+
+if __name__ == "__main__":
+    main()
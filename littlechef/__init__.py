@@ -33,6 +33,29 @@ whyrun = False
 concurrency = False
 include_guests = False
 no_color = False
+kitchen_cache = True
+parallel_load_threshold = 500
+metadata_evaluator = "knife"
+metadata_workers = 0
+merge_workers = 0
+node_data_bag_scope = "all"
+node_data_bag_search = []
+# rsync, archive to ship one content-addressed archive to every node, or
+# manifest to only ship the files which changed since the last run
+sync_mode = "rsync"
+# With the archive sync mode, number of nodes the workstation uploads the
+# kitchen to and each node forwards it to, 0 to upload it to every node
+fanout_width = 0
+fanout_ssh_options = "-o BatchMode=yes"
+# Only ship the cookbooks in the dependency closure of each node's run_list
+prune_cookbooks = False
+# Reuse one OpenSSH ControlMaster connection per node for rsync
+ssh_multiplexing = False
+# Seconds the known setup of a node is trusted, 0 to always check it
+remote_state_ttl = 0
+refresh_remote_state = False
+# False, True for the default report path or the path of the report
+profile = False
 
 node_work_path = "/tmp/chef-solo"
 cookbook_paths = ['site-cookbooks', 'cookbooks']
@@ -0,0 +1,247 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Content-addressed archives of the kitchen files synchronized to nodes
+
+An archive is named after the hash of the names, types and contents of the
+files it holds, so that the same kitchen always gives the same name and a
+node which already unpacked it can skip the transfer. Files are laid out
+like rsync lays out directories given without a trailing slash: every
+directory ends up under its own name.
+
+A manifest maps the same names to a digest of their type, mode and contents.
+The manifests of the kitchens shipped to nodes are kept in the kitchen
+cache, together with the hash of the manifest last shipped to each host, so
+that only the files which changed since have to be shipped again.
+
+"""
+import os
+import stat
+import fnmatch
+import hashlib
+import tarfile
+import tempfile
+
+import littlechef
+from littlechef import cache, codec
+
+# Same patterns as excluded when rsyncing
+EXCLUDE = ('*.svn', '.bzr*', '.git*', '.hg*')
+MANIFESTS_DIR = os.path.join(cache.CACHE_DIR, 'manifests')
+# One file per host holding the hash of the manifest last shipped to it
+SYNCED_DIR = os.path.join(cache.CACHE_DIR, 'synced')
+
+
+def _excluded(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in EXCLUDE)
+
+
+def list_files(paths, follow_symlinks=False):
+    """Returns a sorted list of (arcname, path) for the given directories
+    and everything they contain. Later paths win when two of them hold the
+    same arcname
+
+    """
+    entries = {}
+    for path in paths:
+        path = path.rstrip('/')
+        if not os.path.isdir(path):
+            continue
+        root_name = os.path.basename(path)
+        entries[root_name] = path
+        for root, dirnames, filenames in os.walk(path,
+                                                 followlinks=follow_symlinks):
+            dirnames[:] = sorted(d for d in dirnames if not _excluded(d))
+            relative = os.path.relpath(root, path)
+            for name in dirnames + filenames:
+                if _excluded(name):
+                    continue
+                arcname = os.path.normpath(
+                    os.path.join(root_name, relative, name))
+                entries[arcname] = os.path.join(root, name)
+    return sorted(entries.items())
+
+
+def content_hash(entries, follow_symlinks=False):
+    """Returns the sha1 hex digest of the names, types and file contents
+    of the given (arcname, path) entries
+
+    """
+    digest = hashlib.sha1()
+    for arcname, path in entries:
+        st = os.stat(path) if follow_symlinks else os.lstat(path)
+        digest.update(arcname + '\0')
+        if stat.S_ISLNK(st.st_mode):
+            digest.update('l' + os.readlink(path) + '\0')
+        elif stat.S_ISDIR(st.st_mode):
+            digest.update('d\0')
+        else:
+            digest.update('f{0:o}\0'.format(stat.S_IMODE(st.st_mode)))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), ''):
+                    digest.update(chunk)
+            digest.update('\0')
+    return digest.hexdigest()
+
+
+def build(entries, directory, prefix, follow_symlinks=False):
+    """Writes the (arcname, path) entries to a gzipped tarball named
+    <prefix>-<hash>.tar.gz in directory, unless it already exists.
+    Returns (hash, path)
+
+    """
+    digest = content_hash(entries, follow_symlinks)
+    path = os.path.join(directory, '{0}-{1}.tar.gz'.format(prefix, digest))
+    if os.path.exists(path):
+        return digest, path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            archive = tarfile.open(fileobj=f, mode='w:gz',
+                                   dereference=follow_symlinks)
+            try:
+                for arcname, filename in entries:
+                    archive.add(filename, arcname, recursive=False)
+            finally:
+                archive.close()
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return digest, path
+
+
+def file_sha1(path):
+    """Returns the sha1 hex digest of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(entries, follow_symlinks=False):
+    """Returns a manifest of the (arcname, path) entries: a dictionary of
+    arcname to 'd' for directories, 'l:<target>' for symlinks and
+    'f<mode>:<sha1>' for files. File contents are only hashed again when
+    their mtime, size or mode changed since the last run
+
+    """
+    store = cache.get_store('file_digests')
+    manifest = {}
+    for arcname, path in entries:
+        st = os.stat(path) if follow_symlinks else os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            manifest[arcname] = 'l:' + os.readlink(path)
+        elif stat.S_ISDIR(st.st_mode):
+            manifest[arcname] = 'd'
+        else:
+            fingerprint = (st.st_mtime, st.st_size, st.st_mode)
+            digest = store.get_fresh(path, fingerprint)
+            if digest is None:
+                digest = 'f{0:o}:{1}'.format(stat.S_IMODE(st.st_mode),
+                                             file_sha1(path))
+                store.put(path, fingerprint, digest)
+            manifest[arcname] = digest
+    store.retain([path for _, path in entries])
+    store.flush()
+    return manifest
+
+
+def manifest_hash(manifest):
+    """Returns the sha1 hex digest of a manifest"""
+    return hashlib.sha1(codec.dumps(sorted(manifest.items()))).hexdigest()
+
+
+def diff_manifests(old, new):
+    """Returns (changed, deleted): the sorted arcnames of new which are not
+    in old or differ, and those of old which must be removed before
+    unpacking the changes because they are gone or changed type
+
+    """
+    changed = sorted(name for name, digest in new.items()
+                     if old.get(name) != digest)
+    deleted = sorted(name for name, digest in old.items()
+                     if name not in new or new[name][0] != digest[0])
+    return changed, deleted
+
+
+def save_manifest(manifest):
+    """Keeps a manifest in the kitchen cache, returns its hash"""
+    digest = manifest_hash(manifest)
+    path = os.path.join(MANIFESTS_DIR, digest + '.json')
+    if littlechef.kitchen_cache and not os.path.exists(path):
+        _write_atomically(path, codec.dumps(manifest))
+    return digest
+
+
+def load_manifest(digest):
+    """Returns the cached manifest with the given hash, None if unknown"""
+    try:
+        with open(os.path.join(MANIFESTS_DIR, digest + '.json'), 'r') as f:
+            return codec.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _synced_path(host):
+    return os.path.join(SYNCED_DIR, host.replace(os.sep, '_'))
+
+
+def get_synced(host):
+    """Returns the hash of the manifest last shipped to host, if known"""
+    if not littlechef.kitchen_cache:
+        return None
+    try:
+        with open(_synced_path(host), 'r') as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def set_synced(host, digest):
+    """Records the hash of the manifest just shipped to host. Safe to call
+    from parallel worker processes
+
+    """
+    if littlechef.kitchen_cache:
+        _write_atomically(_synced_path(host), digest)
+
+
+def prune_manifests(keep=()):
+    """Removes the cached manifests which no host was last shipped, but
+    those in keep
+
+    """
+    if not os.path.isdir(MANIFESTS_DIR):
+        return
+    referenced = set(keep)
+    if os.path.isdir(SYNCED_DIR):
+        for host in os.listdir(SYNCED_DIR):
+            referenced.add(get_synced(host))
+    for filename in os.listdir(MANIFESTS_DIR):
+        if filename[:-len('.json')] not in referenced:
+            os.remove(os.path.join(MANIFESTS_DIR, filename))
+
+
+def _write_atomically(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
@@ -0,0 +1,173 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Layered, copy-on-write view of node attributes
+
+The attribute precedence levels (cookbook default, environment default, role
+default, node normal, role override, environment override) are kept as a
+stack of layers, which are shared between nodes and never modified. A key
+resolves the way chef.update_dct() would merge the layers in order: the
+value of the highest layer wins, and dictionaries are merged with the
+dictionaries of the layers above the last plain value.
+
+Writes go to a private top layer, so only the keys a node sets itself are
+copied. materialize() builds the plain dictionary for serialization, only
+creating new dictionaries where layers actually have to be merged.
+
+"""
+
+
+class LayeredAttributes(object):
+    """Read-mostly mapping over a stack of attribute dictionaries, lowest
+    precedence first
+
+    """
+    __slots__ = ('_layers', '_local', '_path')
+
+    def __init__(self, layers, _local=None, _path=()):
+        self._layers = tuple(layers)
+        # Private top layer of the root view, shared by all child views
+        self._local = {} if _local is None else _local
+        self._path = _path
+
+    def __repr__(self):
+        return "<LayeredAttributes {0!r}>".format(self.materialize())
+
+    def _local_layer(self, create=False):
+        """Returns the private layer at this view's path"""
+        layer = self._local
+        for key in self._path:
+            if not isinstance(layer.get(key), dict):
+                if not create:
+                    return None
+                layer[key] = {}
+            layer = layer[key]
+        return layer
+
+    def _all_layers(self):
+        local = self._local_layer()
+        if local:
+            return self._layers + (local,)
+        return self._layers
+
+    def _resolve(self, key):
+        """Returns (found, value), value being a plain value or a child view
+        over the dictionaries which are merged for the key
+
+        """
+        values = [layer[key] for layer in self._all_layers() if key in layer]
+        if not values:
+            return False, None
+        value, dicts = _select(values)
+        if dicts is None:
+            return True, value
+        return True, LayeredAttributes(dicts, self._local,
+                                       self._path + (key,))
+
+    def __getitem__(self, key):
+        found, value = self._resolve(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        found, value = self._resolve(key)
+        return value if found else default
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self._all_layers())
+
+    def keys(self):
+        keys = []
+        seen = set()
+        for layer in self._all_layers():
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __setitem__(self, key, value):
+        """Sets a value in the private layer, shared layers are untouched"""
+        self._local_layer(create=True)[key] = value
+
+    def __eq__(self, other):
+        if isinstance(other, LayeredAttributes):
+            other = other.materialize()
+        return self.materialize() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def materialize(self):
+        """Returns the merged attributes as a dictionary, which must be
+        treated as read-only: keys only found in one layer are shared with it
+
+        """
+        return _merge(self._all_layers())
+
+
+def _select(values):
+    """Given the values of a key in every layer that has it, lowest first,
+    returns (value, None) when a plain value wins, or (None, dicts) with the
+    dictionaries to merge
+
+    """
+    last = len(values) - 1
+    for i in range(last, -1, -1):
+        if not isinstance(values[i], dict):
+            # update_dct() can't merge dictionaries into a plain value
+            if i == last or not any(values[i + 1:]):
+                return values[i], None
+            return None, values[i + 1:]
+    return None, values
+
+
+def _merge(layers):
+    """Merges a list of dictionaries like update_dct() would"""
+    if len(layers) == 1:
+        return layers[0]
+    keys = []
+    values = {}
+    for layer in layers:
+        for key, value in layer.items():
+            if key in values:
+                values[key].append(value)
+            else:
+                keys.append(key)
+                values[key] = [value]
+    result = {}
+    for key in keys:
+        value, dicts = _select(values[key])
+        result[key] = value if dicts is None else _merge(dicts)
+    return result
+
+
+def materialize(dct):
+    """Returns a copy of the dictionary where layered values are replaced
+    by plain (read-only) dictionaries
+
+    """
+    return dict((key, value.materialize()
+                 if isinstance(value, LayeredAttributes) else value)
+                for key, value in dct.items())
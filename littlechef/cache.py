@@ -0,0 +1,406 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Persistent index of parsed kitchen files
+
+Every node, role, environment and cookbook metadata.json file is stored
+together with the mtime and size it had when it was parsed, so that
+subsequent 'fix' invocations only need to re-parse the files that changed.
+The index lives in the kitchen's .littlechef/cache directory.
+
+"""
+import os
+import errno
+import atexit
+import hashlib
+import tempfile
+import multiprocessing
+import cPickle as pickle
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import littlechef
+from littlechef import codec
+
+CACHE_DIR = os.path.join('.littlechef', 'cache')
+# Bump whenever the layout of the stored entries changes
+INDEX_VERSION = 3
+
+_stores = {}
+
+
+class Store(object):
+    """A dictionary persisted to the cache directory, whose entries are
+    (fingerprint, ...) tuples. Values are stored pickled, so that every
+    lookup returns a fresh copy which callers are free to modify
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(CACHE_DIR, name + '.pickle')
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        """Reads the stored entries, an unreadable store is just discarded"""
+        if not littlechef.kitchen_cache or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            return {}
+        if version != INDEX_VERSION:
+            return {}
+        return entries
+
+    def reload(self):
+        """Forgets the entries read so far, so that they are read from disk
+        again, as another invocation may have written the store since
+
+        """
+        if not self._dirty:
+            self._entries = None
+
+    def get_fresh(self, key, fingerprint):
+        """Returns the value stored for key if it was stored with the same
+        fingerprint, None otherwise
+
+        """
+        if not self.is_fresh(key, fingerprint):
+            return None
+        return pickle.loads(self.entries[key][1])
+
+    def is_fresh(self, key, fingerprint):
+        """Returns True when key was stored with the given fingerprint"""
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] == fingerprint
+
+    def put(self, key, fingerprint, value):
+        """Stores a value together with the fingerprint of its inputs"""
+        self.entries[key] = (
+            fingerprint, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._dirty = True
+
+    def retain(self, keys):
+        """Drops the entries whose key is not in the given list"""
+        keys = set(keys)
+        for key in self.entries.keys():
+            if key not in keys:
+                del self.entries[key]
+                self._dirty = True
+
+    def flush(self):
+        """Atomically writes the store to disk if it changed"""
+        if not self._dirty or not littlechef.kitchen_cache:
+            return
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((INDEX_VERSION, self._entries), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            # The cache is an optimization, never fail a run because of it
+            print("Warning: could not write kitchen cache {0}: {1}".format(
+                  self.path, e))
+        else:
+            self._dirty = False
+
+
+class KitchenIndex(Store):
+    """Parsed contents of all kitchen files of one kind ('nodes', 'roles'...)
+    keyed by filename, with the file's (mtime, size) as fingerprint
+
+    When a summarize function is given, a small summary of each file is
+    stored in the index instead of its contents, which are pickled to a
+    file of their own under .littlechef/cache/<kind>/ and only read when
+    asked for. Loading the summaries of thousands of nodes then doesn't load
+    their bodies, and parsed bodies are not kept in memory
+
+    """
+    def __init__(self, kind, parse=codec.loads, summarize=None):
+        super(KitchenIndex, self).__init__(kind)
+        self.kind = kind
+        self.parse = parse
+        self.summarize = summarize
+        self.bodies_dir = os.path.join(CACHE_DIR, kind)
+        self._shared = {}
+
+    def _body_path(self, filename):
+        """Returns the path of the file holding the contents of filename,
+        or None when they are stored in the index itself
+
+        """
+        if not self.summarize:
+            return None
+        return os.path.join(self.bodies_dir,
+                            hashlib.sha1(filename).hexdigest() + '.pickle')
+
+    def _stale(self, filenames):
+        """Returns (filename, fingerprint) for the files whose entry is
+        missing or out of date. Files that can't be stat'ed are skipped
+
+        """
+        stale = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            fingerprint = (st.st_mtime, st.st_size)
+            entry = self.entries.get(filename)
+            if entry is None or entry[0] != fingerprint:
+                stale.append((filename, fingerprint))
+        return stale
+
+    def prefetch(self, filenames):
+        """Parses the out of date files among the given ones using a pool of
+        processes, when there are at least littlechef.parallel_load_threshold
+        of them. Files that fail to parse are left alone, so that get()
+        reports the error as usual
+
+        """
+        threshold = littlechef.parallel_load_threshold
+        if not threshold:
+            return
+        stale = self._stale(filenames)
+        if len(stale) < threshold or multiprocessing.cpu_count() < 2:
+            return
+        jobs = [(filename, fingerprint, self.parse, self.summarize,
+                 self._body_path(filename))
+                for filename, fingerprint in stale]
+        try:
+            pool = multiprocessing.Pool()
+        except (OSError, ImportError):
+            return
+        try:
+            chunksize = max(1, len(jobs) // (multiprocessing.cpu_count() * 4))
+            results = pool.map(_parse_file, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+        for filename, entry in results:
+            if entry is not None:
+                self.entries[filename] = entry
+                self._dirty = True
+
+    def _lookup(self, filename):
+        """Returns an up to date (fingerprint, blob, summary) entry and the
+        parsed data if the file had to be parsed, None otherwise
+
+        """
+        try:
+            st = os.stat(filename)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, filename)
+        fingerprint = (st.st_mtime, st.st_size)
+        entry = self.entries.get(filename)
+        if entry is not None and entry[0] == fingerprint:
+            return entry, None
+        return self._parse(filename, fingerprint)
+
+    def _parse(self, filename, fingerprint):
+        """Parses the file and updates its entry. Returns (entry, data)"""
+        with open(filename, 'r') as f:
+            data = self.parse(f.read())
+        entry = _build_entry(data, fingerprint, self.summarize,
+                             self._body_path(filename))
+        self.entries[filename] = entry
+        self._dirty = True
+        return entry, data
+
+    def _load_body(self, filename, entry):
+        """Returns the parsed contents of an up to date entry, parsing the
+        file again when they were not kept
+
+        """
+        if entry[1] is not None:
+            return pickle.loads(entry[1])
+        path = self._body_path(filename)
+        try:
+            with open(path, 'rb') as f:
+                fingerprint, data = pickle.load(f)
+        except Exception:
+            fingerprint = None
+        # Another invocation may have stored another version of the file
+        if fingerprint == entry[0]:
+            return data
+        return self._parse(filename, entry[0])[1]
+
+    def get(self, filename):
+        """Returns the parsed contents of the given file
+        Raises IOError when the file can't be read and ValueError when it
+        can't be parsed
+
+        """
+        entry, data = self._lookup(filename)
+        if data is None:
+            data = self._load_body(filename, entry)
+        return data
+
+    def get_shared(self, filename):
+        """Returns the parsed contents of the given file, unpickled only once
+        per process and version of the file. The returned data is shared by
+        all callers and must be treated as read-only. Raises like get()
+
+        """
+        entry, data = self._lookup(filename)
+        shared = self._shared.get(filename)
+        if shared is not None and shared[0] == entry[0]:
+            return shared[1]
+        if data is None:
+            data = self._load_body(filename, entry)
+        self._shared[filename] = (entry[0], data)
+        return data
+
+    def get_summary(self, filename):
+        """Returns the stored summary of the given file, which must be
+        treated as read-only. Raises like get()
+
+        """
+        entry = self._lookup(filename)[0]
+        if entry[2] is None and self.summarize:
+            # Stored before a summarize function was set
+            entry = self._parse(filename, entry[0])[0]
+        return entry[2]
+
+    def retain(self, keys):
+        """Drops the entries whose key is not in the given list, and the
+        files holding their contents
+
+        """
+        keys = set(keys)
+        for key in self.entries.keys():
+            if key not in keys:
+                path = self._body_path(key)
+                if path is not None and littlechef.kitchen_cache:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        super(KitchenIndex, self).retain(keys)
+
+
+def _build_entry(data, fingerprint, summarize, body_path):
+    """Returns the (fingerprint, blob, summary) index entry of parsed data.
+    When a body_path is given the data is written there instead of to the
+    blob, if the kitchen cache is enabled, and otherwise not kept at all
+
+    """
+    if body_path is None:
+        return (fingerprint, pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+                summarize(data) if summarize else None)
+    if littlechef.kitchen_cache:
+        directory = os.path.dirname(body_path)
+        try:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    # Created by another process in the meantime
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((fingerprint, data), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, body_path)
+        except (IOError, OSError) as e:
+            # The cache is an optimization, never fail a run because of it
+            print("Warning: could not write kitchen cache {0}: {1}".format(
+                  body_path, e))
+    return (fingerprint, None, summarize(data))
+
+
+def _parse_file(job):
+    """Builds the index entry of a file, run by prefetch() worker processes
+    Returns (filename, None) when the file can't be read or parsed
+
+    """
+    filename, fingerprint, parse, summarize, body_path = job
+    try:
+        with open(filename, 'r') as f:
+            data = parse(f.read())
+    except (IOError, ValueError):
+        return filename, None
+    return filename, _build_entry(data, fingerprint, summarize, body_path)
+
+
+def get_index(kind, summarize=None):
+    """Returns the (per process) index for the given kind of kitchen file"""
+    if kind not in _stores:
+        _stores[kind] = KitchenIndex(kind)
+    if summarize is not None:
+        _stores[kind].summarize = summarize
+    return _stores[kind]
+
+
+def get_store(name):
+    """Returns the (per process) store with the given name"""
+    if name not in _stores:
+        _stores[name] = Store(name)
+    return _stores[name]
+
+
+@contextmanager
+def lock(name):
+    """Holds an exclusive lock on the given part of the cache, so that
+    concurrent invocations don't interleave their updates to it. Where fcntl
+    is not available, or the lock file can't be created, nothing is locked
+
+    """
+    fd = None
+    if fcntl is not None and littlechef.kitchen_cache:
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            fd = os.open(os.path.join(CACHE_DIR, name + '.lock'),
+                         os.O_RDWR | os.O_CREAT)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except (IOError, OSError) as e:
+            print("Warning: could not lock kitchen cache {0}: {1}".format(
+                  name, e))
+            if fd is not None:
+                os.close(fd)
+                fd = None
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def flush():
+    """Writes all modified indexes to disk"""
+    for store in _stores.values():
+        store.flush()
+
+
+def clear():
+    """Forgets all in-memory stores, they will be re-read from disk"""
+    _stores.clear()
+
+
+atexit.register(flush)
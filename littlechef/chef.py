@@ -16,18 +16,26 @@
 See http://wiki.opscode.com/display/chef/Anatomy+of+a+Chef+Run
 """
 import os
+import pipes
 import shutil
 import json
+import tempfile
+import multiprocessing
+from itertools import imap, izip
 import requests
 import subprocess
 from copy import deepcopy
+from StringIO import StringIO
 
-from fabric.api import settings, hide, env, sudo, put
-from fabric.contrib.files import exists
+from fabric.api import settings, hide, env, sudo, put, run, execute, parallel
 from fabric.utils import abort
 from fabric.contrib.project import rsync_project
+from fabric.network import normalize
 
-from littlechef import cookbook_paths, whyrun, lib, solo, colors
+import littlechef
+from littlechef import cookbook_paths, whyrun, lib, solo, colors, codec, cache
+from littlechef import archive, attributes, fanout, hoststate, multiplex
+from littlechef import staging, timing
 from littlechef import LOGFILE, enable_logs as ENABLE_LOGS
 
 import gspread
@@ -38,26 +46,70 @@ import boto3
 # Path to local patch
 basedir = os.path.abspath(os.path.dirname(__file__).replace('\\', '/'))
 chef_tracker_bucket = 'chef-tracker.practicesimple.com'
+# Node data bag items built by previous runs
+NODE_ITEMS_DIR = os.path.join(cache.CACHE_DIR, 'node_data_bag')
+# File holding the hash of the kitchen archive last unpacked on a node
+KITCHEN_ARCHIVE_MARKER = '.littlechef-kitchen'
+# Manifest of the kitchen files, as shipped to nodes in the manifest mode
+MANIFEST_FILE = '.littlechef-manifest.json'
+# List of the paths to remove, shipped inside delta archives
+DELETED_LIST = '.littlechef-deleted'
+# Where the kitchen archive is distributed to, in the home directory
+FANOUT_ARCHIVE = '.littlechef-kitchen.tar.gz'
+FANOUT_SCRIPT = '.littlechef-fanout.sh'
+# Private key of the run, on the nodes which forward the archive
+FANOUT_KEY = '.littlechef-fanout-key'
+# Kitchen archives and manifests built by this process, keyed by the
+# synchronized paths
+_kitchen_archives = {}
+_kitchen_manifests = {}
+# Cookbook name to the names of the cookbooks it depends on
+_cookbook_dependencies = {}
+# sha1 of the distributed kitchen archive file and hosts holding a copy
+_fanout = {'digest': None, 'hosts': set()}
+# Node name to the names of the nodes whose 'node' data bag items it needs,
+# computed by build_node_data_bag() before nodes are configured in parallel
+_node_data_bag_scopes = {}
+# Role graph of this invocation, set up by build_node_data_bag() so that
+# forked workers inherit the roles it loaded and the run_lists it expanded
+_role_graph = []
 
 def save_config(node, force=False):
     """Saves node configuration
     if no nodes/hostname.json exists, or force=True, it creates one
-    it also saves to tmp_node.json
+    it also saves to tmp_node.json in the staging directory, whose path is
+    returned
+
+    """
+    _save_node_file(node, force)
+    return _save_tmp_node_file(node)
+
+
+def _save_node_file(node, force=False):
+    """Saves the node to nodes/hostname.json if there is no such file yet,
+    or force=True
 
     """
     filepath = os.path.join("nodes", env.host_string + ".json")
-    tmp_filename = 'tmp_{0}.json'.format(env.host_string)
-    files_to_create = [tmp_filename]
     if not os.path.exists(filepath) or force:
         # Only save to nodes/ if there is not already a file
         print "Saving node configuration to {0}...".format(filepath)
-        files_to_create.append(filepath)
-    for node_file in files_to_create:
-        with open(node_file, 'w') as f:
-            f.write(json.dumps(node, indent=4, sort_keys=True))
+        with open(filepath, 'w') as f:
+            f.write(codec.dumps_pretty(node))
+
+
+def _save_tmp_node_file(node):
+    """Saves the node to tmp_node.json in the staging directory, whose path
+    is returned
+
+    """
+    tmp_filename = staging.get_path('tmp_{0}.json'.format(env.host_string))
+    with open(tmp_filename, 'w') as f:
+        f.write(codec.dumps_pretty(node))
     return tmp_filename
 
 
+@timing.timed('get_ipaddress')
 def _get_ipaddress(node):
     """Adds the ipaddress attribute to the given node object if not already
     present and it is correctly given by ohai
@@ -69,7 +121,7 @@ def _get_ipaddress(node):
             output = sudo('ohai -l warn ipaddress')
         if output.succeeded:
             try:
-                node['ipaddress'] = json.loads(output)[0]
+                node['ipaddress'] = codec.loads(output)[0]
             except ValueError:
                 abort("Could not parse ohai's output for ipaddress"
                       ":\n  {0}".format(output))
@@ -100,13 +152,19 @@ def unlock_node(node):
 
 def chef_test():
     """Calls chef-solo on the remote node, returns True if successful,
-    False otherwise
+    False otherwise. Skipped while the version it reported is remembered
+    and the node's fingerprint, which covers the chef install, is unchanged
 
     """
+    state = hoststate.get(env.host_string)
+    if (state.get('chef_version') and state.get('fingerprint')
+            and solo.get_fingerprint() == state['fingerprint']):
+        return True
     cmd = "chef-solo --version"
     output = sudo(cmd, warn_only=True, quiet=True)
     if 'chef-solo: command not found' in output:
         return False
+    hoststate.update(env.host_string, chef_version=output.strip())
     return True
 
 def slack_notifier(message):
@@ -174,6 +232,7 @@ def chef_tracker_upload(name, data):
     )
 
 
+@timing.timed('record_chef_run')
 def record_chef_run(node, status, lock_note):
     user = os.environ['USER']
     branch = git_branch()
@@ -204,6 +263,7 @@ def record_chef_run(node, status, lock_note):
     payload = '{{"attachments": [ {{"color": "#00BD9D", "title": "Chef deploy messages", "text":"{0}", "mrkdwn": true}}]}}'.format(post_message) if status == "successful" else '{{"attachments": [ {{"color": "#E53D00", "title": "Chef deploy messages", "text":"{0}", "mrkdwn": true}}]}}'.format(post_message)
     slack_notifier(payload)
 
+@timing.timed('sync_node')
 def sync_node(node):
     """Builds, synchronizes and configures a node.
     It also injects the ipaddress to the node's config file if not already
@@ -219,16 +279,21 @@ def sync_node(node):
         content = json.loads(solo.get_lock_info(current_node))
         print colors.yellow("Skipping node {0}.\nLocked by {1}.\nReason: {2}".format(current_node['host_name'], content['author'], content['reason']))
         return False
-    # Always configure Chef Solo
-    solo.configure(current_node)
     ipaddress = _get_ipaddress(node)
+    # Always configure Chef Solo, which also uploads node.json
+    filepath = _save_tmp_node_file(node)
+    try:
+        solo.configure(current_node, filepath, env.encrypted_data_bag_secret)
+    finally:
+        # Remove local temporary node file
+        os.remove(filepath)
     # Everything was configured alright, so save the node configuration
     # This is done without credentials, so that we keep the node name used
     # by the user and not the hostname or IP translated by .ssh/config
-    filepath = save_config(node, ipaddress)
+    _save_node_file(node, ipaddress)
     try:
         # Synchronize the kitchen directory
-        _synchronize_node(filepath, node)
+        _synchronize_node(node)
         # Execute Chef Solo
         _configure_node(node)
     finally:
@@ -236,10 +301,11 @@ def sync_node(node):
     return True
 
 
-def _synchronize_node(configfile, node):
+@timing.timed('synchronize_node')
+def _synchronize_node(node):
     """Performs the Synchronize step of a Chef run:
     Uploads all cookbooks, all roles and all databags to a node and add the
-    patch for data bags
+    patch for data bags. node.json was already uploaded by solo.configure
 
     Returns the node object of the node which is about to be configured,
     or None if this node object cannot be found.
@@ -249,13 +315,6 @@ def _synchronize_node(configfile, node):
     if env.parallel:
         msg = "[{0}]: {1}".format(env.host_string, msg)
     print(msg)
-    # First upload node.json
-    remote_file = '/etc/chef/node.json'
-    put(configfile, remote_file, use_sudo=True, mode=400)
-    with hide('stdout'):
-        sudo('chown root:$(id -g -n root) {0}'.format(remote_file))
-    # Remove local temporary node file
-    os.remove(configfile)
     # Synchronize kitchen
     extra_opts = "-q"
     if env.follow_symlinks:
@@ -263,20 +322,14 @@ def _synchronize_node(configfile, node):
     ssh_opts = ""
     if env.ssh_config_path:
         ssh_opts += " -F %s" % os.path.expanduser(env.ssh_config_path)
-    if env.encrypted_data_bag_secret:
-        put(env.encrypted_data_bag_secret,
-            "/etc/chef/encrypted_data_bag_secret",
-            use_sudo=True,
-            mode=0600)
-        sudo('chown root:$(id -g -n root) /etc/chef/encrypted_data_bag_secret')
-
-    paths_to_sync = ['./data_bags', './roles', './environments']
-    for cookbook_path in cookbook_paths:
-        paths_to_sync.append('./{0}'.format(cookbook_path))
-
-    # Add berksfile directory to sync_list
-    if env.berksfile:
-        paths_to_sync.append(env.berksfile_cookbooks_directory)
+    if multiplex.enabled():
+        # With a gateway, rsync's ssh connects to the gateway itself
+        ssh_opts += " " + multiplex.get_ssh_options(
+            "{0}@{1}:{2}".format(*normalize(env.gateway or env.host_string)))
+    # rsync merges both data_bags directories into one on the node
+    paths_to_sync = _get_kitchen_paths()
+    paths_to_sync.insert(1, os.path.relpath(
+        os.path.dirname(get_node_data_bag_path())))
 
     if env.loglevel is "debug":
         extra_opts = ""
@@ -287,14 +340,12 @@ def _synchronize_node(configfile, node):
         ssh_opts += " " + env.gateway + " ssh -o StrictHostKeyChecking=no -i "
         ssh_opts += ssh_key_file
 
-    rsync_project(
-        env.node_work_path,
-        ' '.join(paths_to_sync),
-        exclude=('*.svn', '.bzr*', '.git*', '.hg*'),
-        delete=True,
-        extra_opts=extra_opts,
-        ssh_opts=ssh_opts
-    )
+    if littlechef.sync_mode == 'archive':
+        _upload_archives(node)
+    elif littlechef.sync_mode == 'manifest':
+        _upload_delta(node)
+    else:
+        _rsync_kitchen(node, paths_to_sync, extra_opts, ssh_opts)
 
     if env.sync_packages_dest_dir and env.sync_packages_local_dir:
         print("Uploading packages from {0} to remote server {2} directory "
@@ -315,6 +366,480 @@ def _synchronize_node(configfile, node):
     _add_environment_lib()  # NOTE: Chef 10 only
 
 
+def _get_kitchen_paths():
+    """Returns the kitchen directories synchronized to node_work_path"""
+    paths = ['./data_bags', './roles', './environments']
+    for cookbook_path in cookbook_paths:
+        paths.append('./{0}'.format(cookbook_path))
+
+    # Add berksfile directory to sync_list
+    if env.berksfile:
+        paths.append(env.berksfile_cookbooks_directory)
+    return paths
+
+
+def _rsync_kitchen(node, paths_to_sync, extra_opts, ssh_opts):
+    """Synchronizes the kitchen directories to the node with rsync"""
+    # Only ship the node data bag items in this node's scope, and the
+    # cookbooks it needs when pruning
+    filter_file = _write_sync_filter(node)
+    if filter_file:
+        extra_opts += " --filter={0} --delete-excluded".format(
+            pipes.quote('merge ' + filter_file))
+    try:
+        rsync_project(
+            env.node_work_path,
+            ' '.join(pipes.quote(path) for path in paths_to_sync),
+            exclude=archive.EXCLUDE,
+            delete=True,
+            extra_opts=extra_opts,
+            ssh_opts=ssh_opts
+        )
+    finally:
+        if filter_file:
+            os.remove(filter_file)
+
+
+def build_kitchen_archive():
+    """Packs the kitchen directories synchronized to nodes into a
+    content-addressed archive in the staging directory. It is built once per
+    invocation, before nodes are configured in parallel. Returns (hash, path)
+
+    """
+    paths = tuple(_get_kitchen_paths())
+    if paths not in _kitchen_archives:
+        entries = archive.list_files(paths, env.follow_symlinks)
+        _kitchen_archives[paths] = archive.build(
+            entries, staging.get_path('archives'), 'kitchen',
+            env.follow_symlinks)
+    return _kitchen_archives[paths]
+
+
+def distribute_kitchen_archive(hosts):
+    """Spreads the kitchen archive to the given hosts peer to peer, see
+    littlechef.fanout, before they are configured. The hosts known to hold
+    this kitchen already are left out. Returns the hosts which received a
+    good copy
+
+    """
+    digest, path = build_kitchen_archive()
+    targets = [host for host in hosts
+               if hoststate.get(host).get('kitchen_archive') != digest]
+    if len(targets) < 2:
+        # Not worth it, the workstation uploads it anyway
+        return []
+    key = _generate_fanout_key()
+    if key is None:
+        return []
+    key_path, public_key, marker = key
+    file_digest = archive.file_sha1(path)
+    seeds, children = fanout.build_tree(targets, littlechef.fanout_width)
+    addresses = {}
+    for host in targets:
+        user, hostname, port = normalize(host)
+        addresses[host] = ("{0}@{1}".format(user, hostname), port)
+    print("Distributing kitchen {0} to {1} nodes from {2} seeds...".format(
+          digest[:10], len(targets), len(seeds)))
+    try:
+        with hide('running'):
+            execute(_prepare_fanout, file_digest, seeds, children, addresses,
+                    key_path, public_key, hosts=targets)
+            results = execute(_seed_kitchen_archive, path, hosts=seeds)
+    finally:
+        with hide('running'):
+            execute(_clean_up_fanout, marker, hosts=targets)
+    distributed = set()
+    for result in results.values():
+        if isinstance(result, list):
+            distributed.update(result)
+    print("Kitchen {0} distributed to {1} of {2} nodes".format(
+          digest[:10], len(distributed), len(targets)))
+    _fanout['digest'] = file_digest
+    _fanout['hosts'] = distributed
+    return sorted(distributed)
+
+
+def _generate_fanout_key():
+    """Generates the key nodes log into each other with during this run, in
+    the staging directory. Returns (private key path, public key, marker),
+    or None when ssh-keygen is not available
+
+    """
+    path = staging.get_path('fanout_key')
+    for filename in (path, path + '.pub'):
+        if os.path.exists(filename):
+            os.remove(filename)
+    # Identifies the key in authorized_keys, to revoke it
+    marker = 'littlechef-fanout-' + os.path.basename(staging.get_path())
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-C', marker,
+                 '-f', path], stdout=devnull, stderr=devnull)
+        with open(path + '.pub', 'r') as f:
+            public_key = f.read()
+    except (OSError, IOError, subprocess.CalledProcessError) as e:
+        print("Warning: could not generate a key for the kitchen "
+              "distribution, uploading it to every node: {0}".format(e))
+        return None
+    return path, public_key, marker
+
+
+@parallel
+def _prepare_fanout(digest, seeds, children, addresses, key_path,
+                    public_key):
+    """Installs the node's fanout script, the run's private key when the
+    node forwards the archive, and authorizes the run's public key for the
+    script when the node receives the archive from another node
+
+    """
+    host = env.host_string
+    receive = host not in seeds
+    script = fanout.build_script(
+        host, children, addresses, FANOUT_ARCHIVE, digest, key=FANOUT_KEY,
+        ssh="ssh -T -o IdentitiesOnly=yes {0}".format(
+            littlechef.fanout_ssh_options),
+        receive=receive)
+    try:
+        with settings(hide('everything'), warn_only=True):
+            put(StringIO(script), FANOUT_SCRIPT, mode=0600)
+            if children.get(host):
+                put(key_path, FANOUT_KEY, mode=0600)
+            if receive:
+                run(fanout.authorize_command(public_key, FANOUT_SCRIPT))
+    except (Exception, SystemExit) as e:
+        # Its tree will get the kitchen from the workstation
+        print("Warning: could not prepare the kitchen distribution on {0}: "
+              "{1}".format(host, e))
+
+
+@parallel
+def _seed_kitchen_archive(path):
+    """Uploads the kitchen archive to a seed node, which forwards it to
+    the rest of its tree. Returns the hosts reported to hold a good copy
+
+    """
+    try:
+        with settings(hide('everything'), warn_only=True):
+            put(path, FANOUT_ARCHIVE)
+            output = run('sh {0}'.format(FANOUT_SCRIPT))
+    except (Exception, SystemExit) as e:
+        # Its tree will get the kitchen from the workstation
+        print("Warning: could not distribute the kitchen from {0}: {1}".format(
+              env.host_string, e))
+        return []
+    return fanout.get_distributed(output)
+
+
+@parallel
+def _clean_up_fanout(marker):
+    """Revokes the run's key and removes it and the fanout script"""
+    try:
+        with settings(hide('everything'), warn_only=True):
+            run('rm -f {0} {1}; {2}'.format(FANOUT_SCRIPT, FANOUT_KEY,
+                                            fanout.revoke_command(marker)))
+    except (Exception, SystemExit) as e:
+        print("Warning: could not revoke the kitchen distribution key on "
+              "{0}: {1}".format(env.host_string, e))
+
+
+def build_kitchen_manifest():
+    """Builds the manifest of the kitchen directories synchronized to
+    nodes and keeps it in the kitchen cache. It is built once per invocation,
+    before nodes are configured in parallel. Returns (hash, manifest,
+    dictionary of arcname to local path)
+
+    """
+    paths = tuple(_get_kitchen_paths())
+    if paths not in _kitchen_manifests:
+        entries = archive.list_files(paths, env.follow_symlinks)
+        manifest = archive.build_manifest(entries, env.follow_symlinks)
+        digest = archive.save_manifest(manifest)
+        if littlechef.kitchen_cache:
+            archive.prune_manifests(keep=[digest])
+        _kitchen_manifests[paths] = (digest, manifest, dict(entries))
+    return _kitchen_manifests[paths]
+
+
+def _get_node_item_entries(name):
+    """Returns the archive entries of the 'node' data bag items in the scope
+    of the given node
+
+    """
+    directory = get_node_data_bag_path()
+    filenames = sorted(os.listdir(directory))
+    names = _get_node_data_bag_scope(name)
+    if names is not None:
+        in_scope = set(os.path.basename(_node_item_path('', item))
+                       for item in names)
+        filenames = [f for f in filenames if f in in_scope]
+    entries = [('data_bags', os.path.dirname(directory)),
+               ('data_bags/node', directory)]
+    entries.extend(('data_bags/node/' + f, os.path.join(directory, f))
+                   for f in filenames)
+    return entries
+
+
+def _build_node_data_bag_archive(name):
+    """Packs the 'node' data bag items in the scope of the given node.
+    Returns (hash, path)
+
+    """
+    return archive.build(_get_node_item_entries(name),
+                         staging.get_path('archives'), 'node')
+
+
+def _upload_archives(node):
+    """Unpacks the kitchen archive into node_work_path, unless the node
+    already holds the same one, and then the node's data bag items
+
+    """
+    digest, path = build_kitchen_archive()
+    marker = os.path.join(env.node_work_path, KITCHEN_ARCHIVE_MARKER)
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        current = run('cat {0}'.format(marker))
+    if current.succeeded and current.strip() == digest:
+        msg = "Kitchen {0} is already present, skipping it".format(
+            digest[:10])
+        if env.parallel:
+            msg = "[{0}]: {1}".format(env.host_string, msg)
+        print(msg)
+    else:
+        # Same as rsync's --delete: remove what is not in the kitchen
+        dirnames = sorted(set(os.path.basename(p.rstrip('/'))
+                              for p in _get_kitchen_paths()))
+        before = "rm -rf {0} {1}".format(' '.join(dirnames), marker)
+        after = "echo {0} > {1}".format(digest, marker)
+        # Use the copy distributed by the other nodes, if still good
+        if (env.host_string not in _fanout['hosts'] or
+                _unpack_archive(path, before, after, warn_only=True,
+                                fanned_out=_fanout['digest']).failed):
+            _unpack_archive(path, before, after)
+    hoststate.update(env.host_string, kitchen_archive=digest)
+    node_digest, node_path = _build_node_data_bag_archive(node['name'])
+    _unpack_archive(node_path, "rm -rf data_bags/node")
+
+
+def _upload_delta(node):
+    """Ships the kitchen files which changed since the manifest the node
+    holds, together with the node's data bag items, in one archive
+
+    The manifest last shipped to the host is looked up in the kitchen cache
+    first. When the node doesn't hold it, the manifest is read from the node,
+    and when the node has none, the whole kitchen is shipped
+
+    """
+    digest, manifest, files = build_kitchen_manifest()
+    if littlechef.prune_cookbooks:
+        manifest = _prune_manifest(manifest, get_cookbook_closure(node))
+        digest = archive.save_manifest(manifest)
+    host = env.host_string
+    old_digest = archive.get_synced(host)
+    old = archive.load_manifest(old_digest) if old_digest else None
+    if old is None or not _unpack_delta(node, digest, manifest, files,
+                                        old_digest, old):
+        # Another workstation may have configured the node, ask the node
+        path = os.path.join(env.node_work_path, MANIFEST_FILE)
+        with settings(hide('running', 'stdout', 'warnings'),
+                      warn_only=True):
+            output = run('cat {0}'.format(path))
+        try:
+            old = codec.loads(output) if output.succeeded else None
+        except ValueError:
+            old = None
+        if old is None or not _unpack_delta(node, digest, manifest, files,
+                                            archive.manifest_hash(old), old):
+            _unpack_delta(node, digest, manifest, files, None, None)
+    archive.set_synced(host, digest)
+
+
+def _unpack_delta(node, digest, manifest, files, old_digest, old):
+    """Ships the changes between the old manifest and the kitchen manifest,
+    or the whole kitchen when old is None. Returns False when the node
+    doesn't hold the old manifest anymore
+
+    """
+    marker = os.path.join(env.node_work_path, KITCHEN_ARCHIVE_MARKER)
+    if old is None:
+        changed = sorted(manifest)
+        deleted = sorted(set(os.path.basename(p.rstrip('/'))
+                             for p in _get_kitchen_paths()))
+    else:
+        changed, deleted = archive.diff_manifests(old, manifest)
+    # Node data bag items are removed after every run
+    deleted.append('data_bags/node')
+    entries = [(name, files[name]) for name in changed]
+    if digest != old_digest:
+        entries.append((MANIFEST_FILE, _get_manifest_path(digest, manifest)))
+    entries.extend(_get_node_item_entries(node['name']))
+    fd, deleted_list = tempfile.mkstemp(dir=staging.get_path())
+    with os.fdopen(fd, 'w') as f:
+        f.write('\0'.join(deleted))
+    entries.append((DELETED_LIST, deleted_list))
+    try:
+        path = archive.build(entries, staging.get_path('archives'),
+                             'delta')[1]
+    finally:
+        os.remove(deleted_list)
+    msg = "Shipping {0} changed kitchen files".format(len(changed))
+    if env.parallel:
+        msg = "[{0}]: {1}".format(env.host_string, msg)
+    if env.verbose:
+        print(msg)
+    remote_path = _get_remote_archive_path(path)
+    # The marker is only written back once everything was unpacked
+    before = ('rm -f {0} && tar -xzf {1} {2} && xargs -0 rm -rf -- < {2}'
+              .format(marker, remote_path, DELETED_LIST))
+    if old_digest is not None:
+        # Only apply the changes on top of the manifest they were made for
+        before = ('{{ test "$(cat {0} 2>/dev/null)" = {1} || '
+                  '{{ rm -f {2}; exit 3; }}; }} && {3}'.format(
+                      marker, old_digest, remote_path, before))
+    after = 'rm -f {0} && echo {1} > {2}'.format(DELETED_LIST, digest, marker)
+    output = _unpack_archive(path, before, after, warn_only=True)
+    if output.return_code == 3:
+        return False
+    elif output.failed:
+        abort("Could not unpack the kitchen in {0}:\n{1}".format(
+              env.node_work_path, output))
+    return True
+
+
+def _get_manifest_path(digest, manifest):
+    """Returns the path of a file in the staging directory holding the
+    manifest, as shipped to nodes
+
+    """
+    path = staging.get_path('manifest-{0}.json'.format(digest))
+    if not os.path.exists(path):
+        fd, tmp_path = tempfile.mkstemp(dir=staging.get_path())
+        with os.fdopen(fd, 'w') as f:
+            f.write(codec.dumps(manifest))
+        os.rename(tmp_path, path)
+    return path
+
+
+def _get_cookbook_dirnames():
+    """Returns the names the cookbook paths are synchronized as"""
+    paths = list(cookbook_paths)
+    if env.get('berksfile'):
+        paths.append(env.berksfile_cookbooks_directory)
+    return set(os.path.basename(path.rstrip('/')) for path in paths)
+
+
+def _prune_manifest(manifest, cookbooks):
+    """Returns the manifest without the cookbooks not in the given set"""
+    dirnames = _get_cookbook_dirnames()
+    pruned = {}
+    for name, digest in manifest.items():
+        parts = name.split('/', 2)
+        if len(parts) > 1 and parts[0] in dirnames and (
+                parts[1] not in cookbooks):
+            continue
+        pruned[name] = digest
+    return pruned
+
+
+def get_cookbook_dependencies():
+    """Returns a dictionary of every cookbook name to the names of the
+    cookbooks it depends on, as listed in its metadata
+
+    """
+    if not _cookbook_dependencies:
+        for recipe in lib.get_recipes():
+            cookbook = recipe['name'].split('::')[0]
+            _cookbook_dependencies.setdefault(cookbook, set()).update(
+                recipe['dependencies'])
+    return _cookbook_dependencies
+
+
+def _get_role_graph():
+    """Returns the role graph of this invocation"""
+    if not _role_graph:
+        _role_graph.append(lib.RoleGraph())
+    return _role_graph[0]
+
+
+def get_cookbook_closure(node):
+    """Returns the names of the cookbooks of the node's expanded run_list,
+    and of all the cookbooks they depend on
+
+    """
+    dependencies = get_cookbook_dependencies()
+    recipes = _get_role_graph().expand_run_list(
+        node.get('run_list', []), node.get('chef_environment'))[1]
+    pending = [recipe.split('::')[0] for recipe in recipes]
+    closure = set()
+    while pending:
+        cookbook = pending.pop()
+        if cookbook not in closure:
+            closure.add(cookbook)
+            pending.extend(dependencies.get(cookbook, ()))
+    return closure
+
+
+def _get_remote_archive_path(path):
+    """Returns the path an archive is uploaded to on the node"""
+    return os.path.join(env.node_work_path, os.path.basename(path))
+
+
+def _unpack_archive(path, before, after=None, warn_only=False,
+                    fanned_out=None):
+    """Uploads an archive to node_work_path in a single transfer and
+    unpacks it there, running the given shell commands before and after.
+    Returns the output of the remote command
+
+    With the sha1 of the archive file as fanned_out, the copy distributed to
+    the home directory by distribute_kitchen_archive is unpacked instead,
+    and nothing is run unless its sha1 matches
+
+    """
+    remote_path = _get_remote_archive_path(path)
+    with hide('running', 'stdout'):
+        commands = ['cd {0}'.format(env.node_work_path)]
+        if fanned_out:
+            commands.extend([
+                '[ "$(sha1sum ~/{0} | cut -c 1-40)" = "{1}" ]'.format(
+                    FANOUT_ARCHIVE, fanned_out),
+                'mv ~/{0} {1}'.format(FANOUT_ARCHIVE, remote_path)])
+        else:
+            put(path, remote_path)
+        commands.extend([before, 'tar -xzf {0}'.format(remote_path),
+                         'rm -f {0}'.format(remote_path)])
+        if after:
+            commands.append(after)
+        with settings(warn_only=warn_only):
+            return run(' && '.join(commands))
+
+
+def _write_sync_filter(node):
+    """Writes an rsync filter file which only lets through the 'node' data
+    bag items in the scope of the given node and, with
+    littlechef.prune_cookbooks, the cookbooks it needs. Returns its path, or
+    None when everything is shipped
+
+    """
+    rules = []
+    names = _get_node_data_bag_scope(node['name'])
+    if names is not None:
+        for item in sorted(names):
+            rules.append("+ /data_bags/node/{0}".format(
+                         os.path.basename(_node_item_path('', item))))
+        rules.append("- /data_bags/node/*")
+    if littlechef.prune_cookbooks:
+        closure = sorted(get_cookbook_closure(node))
+        for dirname in sorted(_get_cookbook_dirnames()):
+            for cookbook in closure:
+                rules.append("+ /{0}/{1}/***".format(dirname, cookbook))
+            rules.append("- /{0}/*".format(dirname))
+    if not rules:
+        return None
+    fd, path = tempfile.mkstemp(prefix='littlechef-filter-')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(rules) + '\n')
+    return path
+
+
 def build_dct(dic, keys, value):
     """Builds a dictionary with arbitrary depth out of a key list"""
     key = keys.pop(0)
@@ -355,7 +880,72 @@ def _add_automatic_attributes(node):
     node['domain'] = ".".join(node['fqdn'].split('.')[1:])
 
 
-def _add_merged_attributes(node, all_recipes, all_roles):
+class AttributeCatalog(object):
+    """Recipes and roles keyed by name, for the attribute merge
+
+    The cookbook default attributes of every recipe are compiled once, and
+    the cookbook default tree of every distinct expanded recipe list is
+    built once and shared by the nodes as their lowest attribute layer
+
+    """
+    def __init__(self, all_recipes, all_roles):
+        self.recipes = {}
+        for recipe in all_recipes:
+            self.recipes.setdefault(recipe['name'], []).append(recipe)
+        self.roles = {}
+        for role in all_roles:
+            self.roles.setdefault(role['name'], []).append(role)
+        self._recipe_defaults = {}
+        self._trees = {}
+
+    def recipe_defaults(self, name):
+        """Returns the (keys, value) pairs of a recipe's cookbook default
+        attributes, None when the recipe does not exist
+
+        """
+        if name not in self._recipe_defaults:
+            defaults = None
+            if name in self.recipes:
+                defaults = []
+                for r in self.recipes[name]:
+                    for attr in r['attributes']:
+                        if r['attributes'][attr].get('type') == "hash":
+                            value = {}
+                        else:
+                            value = r['attributes'][attr].get('default')
+                        # Attribute dictionaries are defined as a single
+                        # compound key. Split and build proper dict
+                        defaults.append((attr.split("/"), value))
+            self._recipe_defaults[name] = defaults
+        return self._recipe_defaults[name]
+
+    def cookbook_defaults(self, node):
+        """Returns the cookbook default attribute tree for the node, which is
+        shared by all nodes with the same recipes and must not be modified
+
+        """
+        recipes = tuple(node['recipes'])
+        if recipes not in self._trees:
+            tree = {}
+            for recipe in recipes:
+                defaults = self.recipe_defaults(recipe)
+                if defaults is None:
+                    error = "Could not find recipe '{0}' while ".format(
+                        recipe)
+                    error += "building node data bag for '{0}'".format(
+                        node['name'])
+                    abort(error)
+                for keys, value in defaults:
+                    build_dct(tree, list(keys), value)
+            self._trees[recipes] = tree
+        return self._trees[recipes]
+
+    def get_roles(self, name):
+        """Returns the roles with the given name"""
+        return self.roles.get(name, [])
+
+
+def _add_merged_attributes(node, catalog):
     """Merges attributes from cookbooks, node and roles
 
     Chef Attribute precedence:
@@ -368,40 +958,25 @@ def _add_merged_attributes(node, all_recipes, all_roles):
         - Role override
         - Environment override
 
+    The precedence levels are layered, not copied: merged dictionaries are
+    added to the node as attributes.LayeredAttributes views, which are only
+    turned into plain dictionaries when the node item is serialized
+
     NOTE: In order for cookbook attributes to be read, they need to be
         correctly defined in its metadata.json
 
     """
     # Get cookbooks from extended recipes
-    attributes = {}
-    for recipe in node['recipes']:
-        # Find this recipe
-        found = False
-        for r in all_recipes:
-            if recipe == r['name']:
-                found = True
-                for attr in r['attributes']:
-                    if r['attributes'][attr].get('type') == "hash":
-                        value = {}
-                    else:
-                        value = r['attributes'][attr].get('default')
-                    # Attribute dictionaries are defined as a single
-                    # compound key. Split and build proper dict
-                    build_dct(attributes, attr.split("/"), value)
-        if not found:
-            error = "Could not find recipe '{0}' while ".format(recipe)
-            error += "building node data bag for '{0}'".format(node['name'])
-            abort(error)
+    layers = [catalog.cookbook_defaults(node)]
 
     # Get default role attributes
     for role in node['roles']:
-        for r in all_roles:
-            if role == r['name']:
-                update_dct(attributes, r.get('default_attributes', {}))
+        for r in catalog.get_roles(role):
+            layers.append(r.get('default_attributes', {}))
 
     # Get default environment attributes
-    environment = lib.get_environment(node['chef_environment'])
-    update_dct(attributes, environment.get('default_attributes', {}))
+    environment = lib.get_environment(node['chef_environment'], shared=True)
+    layers.append(environment.get('default_attributes', {}))
 
     # Get normal node attributes
     non_attribute_fields = [
@@ -411,22 +986,22 @@ def _add_merged_attributes(node, all_recipes, all_roles):
         if key in non_attribute_fields:
             continue
         node_attributes[key] = node[key]
-    update_dct(attributes, node_attributes)
+    layers.append(node_attributes)
 
     # Get override role attributes
     for role in node['roles']:
-        for r in all_roles:
-            if role == r['name']:
-                update_dct(attributes, r.get('override_attributes', {}))
+        for r in catalog.get_roles(role):
+            layers.append(r.get('override_attributes', {}))
 
     # Get override environment attributes
-    update_dct(attributes, environment.get('override_attributes', {}))
+    layers.append(environment.get('override_attributes', {}))
 
     # Merge back to the original node object
-    node.update(attributes)
+    node.update(attributes.LayeredAttributes(layers))
 
 
-def build_node_data_bag():
+@timing.timed('build_node_data_bag')
+def build_node_data_bag(hosts=None):
     """Builds one 'node' data bag item per file found in the 'nodes' directory
 
     Automatic attributes for a node item:
@@ -442,45 +1017,359 @@ def build_node_data_bag():
         All attributes found in nodes/<item>.json file
         Default and override attributes from all roles
 
+    Built items are kept in the kitchen cache, together with the fingerprint
+    of the files they were merged from. Only items for which any of those
+    files changed are built again
+
+    When the hosts about to be configured are given, only the items in the
+    node data bag scope of those hosts are built
+
     """
-    nodes = lib.get_nodes()
-    node_data_bag_path = os.path.join('data_bags', 'node')
-    # In case there are leftovers
+    # Older versions built it inside the kitchen, rsync would merge it
+    legacy_path = os.path.join('data_bags', 'node')
+    if os.path.exists(legacy_path):
+        shutil.rmtree(legacy_path)
+    node_data_bag_path = get_node_data_bag_path()
+    # In case it was already built by this invocation
     remove_local_node_data_bag()
     os.makedirs(node_data_bag_path)
-    all_recipes = lib.get_recipes()
-    all_roles = lib.get_roles()
-    for node in nodes:
-        # Dots are not allowed (only alphanumeric), substitute by underscores
-        node['id'] = node['name'].replace('.', '_')
-
-        # Build extended role list
-        node['role'] = lib.get_roles_in_node(node)
-        node['roles'] = node['role'][:]
-        for role in node['role']:
-            node['roles'].extend(lib.get_roles_in_role(role))
-        node['roles'] = list(set(node['roles']))
-
-        # Build extended recipe list
-        node['recipes'] = lib.get_recipes_in_node(node)
-        # Add recipes found inside each roles in the extended role list
-        for role in node['roles']:
-            node['recipes'].extend(lib.get_recipes_in_role(role))
-        node['recipes'] = list(set(node['recipes']))
-
-        # Add node attributes
-        _add_merged_attributes(node, all_recipes, all_roles)
-        _add_automatic_attributes(node)
-
-        # Save node data bag item
-        with open(os.path.join(
-                  'data_bags', 'node', node['id'] + '.json'), 'w') as f:
-            f.write(json.dumps(node))
+    use_cache = littlechef.kitchen_cache
+    if use_cache and not os.path.isdir(NODE_ITEMS_DIR):
+        try:
+            os.makedirs(NODE_ITEMS_DIR)
+        except OSError as e:
+            print("Warning: could not create {0}: {1}".format(
+                  NODE_ITEMS_DIR, e))
+            use_cache = False
+    with cache.lock('node_data_bag'):
+        _build_node_items(node_data_bag_path, hosts, use_cache)
+
+
+def _build_node_items(node_data_bag_path, hosts, use_cache):
+    """Builds the node data bag items into node_data_bag_path, reusing and
+    updating those kept in the kitchen cache when use_cache is True. Runs
+    with the cache's 'node_data_bag' lock held
+
+    """
+    store = cache.get_store('node_data_bag')
+    # Another invocation may have updated the cache in the meantime
+    store.reload()
+    # Roles may have changed since the last build
+    _role_graph[:] = [lib.RoleGraph()]
+    graph = _get_role_graph()
+    file_fingerprints = {}
+    handles = lib.get_node_handles()
+    in_scope = None
+    _node_data_bag_scopes.clear()
+    if hosts is not None and littlechef.node_data_bag_scope != 'all':
+        _node_data_bag_scopes.update(
+            _get_node_data_bag_scopes(hosts, lib.NodeIndex()))
+        in_scope = set()
+        for names in _node_data_bag_scopes.values():
+            in_scope.update(names)
+    # Reuse the items whose inputs didn't change. The fingerprints of the
+    # others are taken before merging them, so that a file changing in the
+    # meantime gets its items built again by the next run
+    pending = []
+    fingerprints = []
+    for handle in handles:
+        if in_scope is not None and handle.name not in in_scope:
+            continue
+        fingerprint = None
+        if use_cache:
+            cached_path = _node_item_path(NODE_ITEMS_DIR, handle.name)
+            fingerprint = _node_item_fingerprint(
+                handle, graph, file_fingerprints)
+            if (store.is_fresh(handle.name, fingerprint)
+                    and os.path.exists(cached_path)):
+                _link_or_copy(cached_path,
+                              _node_item_path(node_data_bag_path, handle.name))
+                continue
+        pending.append(handle)
+        fingerprints.append(fingerprint)
+    if pending:
+        all_recipes, all_roles = lib.get_recipes(), lib.get_roles()
+        if use_cache:
+            # Loading recipes may have regenerated metadata.json files
+            cookbook_fingerprints = {}
+            fingerprints = [_refresh_cookbook_fingerprints(
+                            fingerprint, cookbook_fingerprints)
+                            for fingerprint in fingerprints]
+        directory = NODE_ITEMS_DIR if use_cache else node_data_bag_path
+        items = _write_node_items([h.name for h in pending], directory,
+                                  all_recipes, all_roles)
+        for handle, fingerprint, name in izip(pending, fingerprints, items):
+            if use_cache:
+                store.put(handle.name, fingerprint,
+                          handle.name.replace('.', '_'))
+                _link_or_copy(_node_item_path(NODE_ITEMS_DIR, name),
+                              _node_item_path(node_data_bag_path, name))
+    if use_cache:
+        store.retain([handle.name for handle in handles])
+        item_files = set(os.path.basename(_node_item_path('', handle.name))
+                         for handle in handles)
+        for filename in os.listdir(NODE_ITEMS_DIR):
+            # Leave items being written by other invocations alone
+            if filename not in item_files and not filename.startswith('.tmp'):
+                os.remove(os.path.join(NODE_ITEMS_DIR, filename))
+        store.flush()
+
+
+def get_node_data_bag_names(hosts, index=None):
+    """Returns the names of the nodes whose 'node' data bag items the given
+    hosts need, according to littlechef.node_data_bag_scope:
+        * all: every node, None is returned
+        * environment: the nodes in the same chef_environment as any of the
+          hosts, or in the one given with --env
+        * search: the hosts themselves and the nodes matching any of the
+          littlechef.node_data_bag_search terms
+
+    """
+    if littlechef.node_data_bag_scope == 'all':
+        return None
+    names = set()
+    for host_names in _get_node_data_bag_scopes(
+            hosts, index or lib.NodeIndex()).values():
+        names.update(host_names)
+    return names
+
+
+def _get_node_data_bag_scope(name):
+    """Returns get_node_data_bag_names() for the given node alone, as
+    computed by build_node_data_bag() when it is one of the hosts being
+    configured
+
+    """
+    if littlechef.node_data_bag_scope == 'all':
+        return None
+    if name not in _node_data_bag_scopes:
+        _node_data_bag_scopes.update(
+            _get_node_data_bag_scopes([name], lib.NodeIndex()))
+    return _node_data_bag_scopes[name]
+
+
+def _get_node_data_bag_scopes(hosts, index):
+    """Returns a dictionary of every host name to the frozenset of names
+    get_node_data_bag_names() returns for it alone. Hosts with the same
+    scope share the same set, so that the whole dictionary stays small
+
+    """
+    names = [host.split('@')[-1] for host in hosts]
+    scopes = {}
+    if littlechef.node_data_bag_scope == 'environment':
+        environments = {}
+        for name in names:
+            summary = index.summaries.get(name)
+            environment = env.chef_environment or (
+                summary['chef_environment'] if summary else '_default')
+            if environment not in environments:
+                environments[environment] = frozenset(
+                    index.search('environment', environment))
+            scopes[name] = environments[environment]
+        return scopes
+    matched = set()
+    for term in littlechef.node_data_bag_search:
+        field, value = term.split(':', 1) if ':' in term else ('node', term)
+        if field == 'node':
+            matched.update(n for n in index.names
+                           if n == value or (value.endswith('*') and
+                                             n.startswith(value.rstrip('*'))))
+        elif field in index.FIELDS:
+            matched.update(index.search(field, value))
+        else:
+            abort('Unknown field "{0}" in node_data_bag search term '
+                  '"{1}"'.format(field, term))
+    matched = frozenset(matched)
+    for name in names:
+        if name in index.summaries and name not in matched:
+            scopes[name] = matched | frozenset([name])
+        else:
+            scopes[name] = matched
+    return scopes
+
+
+def _node_item_path(directory, name):
+    """Returns the path of a node's data bag item in the given directory"""
+    # Dots are not allowed (only alphanumeric), substitute by underscores
+    return os.path.join(directory, name.replace('.', '_') + '.json')
+
+
+def _write_node_items(names, directory, all_recipes, all_roles):
+    """Merges the given nodes and writes their data bag items to directory,
+    one node at a time. Yields every node name once its item is written, in
+    the given order. Node bodies are read through the kitchen index, which
+    doesn't keep them in memory, so only the node being merged is held
+
+    With littlechef.merge_workers set to more than one, nodes are sharded
+    across that many worker processes
+
+    """
+    workers = littlechef.merge_workers
+    pool = None
+    if workers > 1 and len(names) > 1:
+        try:
+            pool = multiprocessing.Pool(workers, _init_node_item_writer,
+                                        (all_recipes, all_roles))
+        except (OSError, ImportError):
+            pool = None
+    jobs = ((name, directory) for name in names)
+    if pool is None:
+        _init_node_item_writer(all_recipes, all_roles)
+        for name in imap(_write_node_item, jobs):
+            yield name
+        return
+    try:
+        chunksize = max(1, len(names) // (workers * 4))
+        for name, built in pool.imap(_write_node_item_in_worker, jobs,
+                                     chunksize):
+            if not built:
+                abort("Could not build node data bag item for '{0}'".format(
+                      name))
+            yield name
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+# Recipes, roles and run_list expansions of the current process, used by
+# _write_node_item()
+_node_item_writer = {}
+
+
+def _init_node_item_writer(all_recipes, all_roles):
+    """Sets up the current process to build node data bag items"""
+    _node_item_writer['catalog'] = AttributeCatalog(all_recipes, all_roles)
+    _node_item_writer['graph'] = lib.RoleGraph()
+
+
+def _write_node_item(job):
+    """Merges a node and atomically writes its data bag item"""
+    name, directory = job
+    node = lib.get_node(name)
+    _build_node_item(node, _node_item_writer['graph'],
+                     _node_item_writer['catalog'])
+    data = codec.dumps(attributes.materialize(node))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, _node_item_path(directory, name))
+    return name
+
+
+def _write_node_item_in_worker(job):
+    """Runs _write_node_item() in a pool worker, where abort() must not end
+    the process. Returns (name, built)
+
+    """
+    try:
+        return _write_node_item(job), True
+    except SystemExit:
+        return job[0], False
+
+
+def _build_node_item(node, graph, catalog):
+    """Turns a node into its merged node data bag item"""
+    node['id'] = node['name'].replace('.', '_')
+
+    # Build extended role and recipe lists, in run_list order
+    node['role'] = lib.get_roles_in_node(node)
+    roles, recipes = graph.expand_run_list(
+        node.get('run_list', []), node.get('chef_environment'))
+    node['roles'], node['recipes'] = list(roles), list(recipes)
+
+    # Add node attributes
+    _add_merged_attributes(node, catalog)
+    _add_automatic_attributes(node)
+
+
+def _node_item_fingerprint(handle, graph, file_fingerprints):
+    """Returns the fingerprint of every file the node item is merged from:
+    the node file, the roles and environment it uses and the metadata of the
+    cookbooks its recipes come from. file_fingerprints memoizes those of
+    files shared by many nodes
+
+    """
+    def fingerprint(key, function, *args):
+        if key not in file_fingerprints:
+            file_fingerprints[key] = function(*args)
+        return file_fingerprints[key]
+
+    summary = handle.get_summary()
+    environment = summary['chef_environment']
+    roles, recipes = graph.expand_run_list(summary['run_list'], environment)
+    inputs = [littlechef.__version__, _file_fingerprint(handle.path)]
+    if environment != '_default':
+        filename = os.path.join('environments', environment + '.json')
+        inputs.append(fingerprint(filename, _file_fingerprint, filename))
+    for role in roles:
+        filename = os.path.join('roles', role + '.json')
+        inputs.append(fingerprint(filename, _file_fingerprint, filename))
+    inputs.extend(_cookbook_fingerprints(recipes, file_fingerprints))
+    return (tuple(roles), tuple(recipes), tuple(inputs))
+
+
+def _cookbook_fingerprints(recipes, file_fingerprints):
+    """Returns the fingerprints of the metadata of the cookbooks the given
+    recipes come from, in order, memoized in file_fingerprints
+
+    """
+    cookbooks = []
+    for recipe in recipes:
+        cookbook = recipe.split('::')[0]
+        if cookbook not in cookbooks:
+            cookbooks.append(cookbook)
+    fingerprints = []
+    for cookbook in cookbooks:
+        key = ('cookbook', cookbook)
+        if key not in file_fingerprints:
+            file_fingerprints[key] = lib.get_cookbook_fingerprint(cookbook)
+        fingerprints.append(file_fingerprints[key])
+    return fingerprints
+
+
+def _refresh_cookbook_fingerprints(fingerprint, file_fingerprints):
+    """Returns a node item fingerprint with the cookbook metadata part,
+    which comes last, taken again
+
+    """
+    roles, recipes, inputs = fingerprint
+    cookbooks = _cookbook_fingerprints(recipes, file_fingerprints)
+    return (roles, recipes,
+            inputs[:len(inputs) - len(cookbooks)] + tuple(cookbooks))
+
+
+def _file_fingerprint(filename):
+    """Returns the (mtime, size) of a file, None when it doesn't exist"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def _link_or_copy(source, destination):
+    """Hard links source to destination, copying it where links fail"""
+    try:
+        os.link(source, destination)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, destination)
+
+
+def get_node_data_bag_path():
+    """Returns the path of the generated 'node' data bag, in the staging
+    directory of this invocation
+
+    """
+    return staging.get_path('data_bags', 'node')
 
 
 def remove_local_node_data_bag():
     """Removes generated 'node' data_bag locally"""
-    node_data_bag_path = os.path.join('data_bags', 'node')
+    node_data_bag_path = get_node_data_bag_path()
     if os.path.exists(node_data_bag_path):
         shutil.rmtree(node_data_bag_path)
 
@@ -514,23 +1403,24 @@ def ensure_berksfile_cookbooks_are_installed():
             print stdout, stderr
 
 
-def _remove_remote_node_data_bag():
-    """Removes generated 'node' data_bag from the remote node"""
-    node_data_bag_path = os.path.join(env.node_work_path, 'data_bags', 'node')
-    if exists(node_data_bag_path):
-        sudo("rm -rf {0}".format(node_data_bag_path))
-
-
+@timing.timed('node_cleanup')
 def _node_cleanup():
+    """Removes node.json, the generated 'node' data_bag and the encrypted
+    data bag secret from the remote node, in a single call
+
+    """
     if env.loglevel is not "debug":
+        paths = [
+            os.path.join(env.node_work_path, 'data_bags', 'node'),
+            '/etc/chef/node.json',
+            os.path.join(env.node_work_path, "nodes",
+                         env.host_string.split('.')[0] + ".json"),
+        ]
+        if env.encrypted_data_bag_secret:
+            paths.append('/etc/chef/encrypted_data_bag_secret')
         with hide('running', 'stdout'):
-            _remove_remote_node_data_bag()
             with settings(warn_only=True):
-                sudo("rm '/etc/chef/node.json'")
-                solo_node_cnf_file = os.path.join(env.node_work_path, "nodes", env.host_string.split('.')[0] + ".json")
-                sudo("rm -f {0}".format(solo_node_cnf_file))
-                if env.encrypted_data_bag_secret:
-                    sudo("rm '/etc/chef/encrypted_data_bag_secret'")
+                sudo("rm -rf {0}".format(' '.join(paths)))
 
 
 def _add_environment_lib():
@@ -539,16 +1429,18 @@ def _add_environment_lib():
     NOTE: Chef 10 only
 
     """
-    # Create extra cookbook dir
     lib_path = os.path.join(env.node_work_path, cookbook_paths[0],
                             'chef_solo_envs', 'libraries')
+    # Add the environment patch left by solo.configure to the node's
+    # cookbooks, creating the extra cookbook dir. Not as root, so that the
+    # kitchen stays owned by the user even when the chown -R is skipped
     with hide('running', 'stdout'):
-        sudo('mkdir -p {0}'.format(lib_path))
-    # Add environment patch to the node's cookbooks
-    put(os.path.join(basedir, 'environment.rb'),
-        os.path.join(lib_path, 'environment.rb'), use_sudo=True)
+        run('mkdir -p {0} && cp {1} {2}'.format(
+             lib_path, solo.get_environment_lib_path(),
+             os.path.join(lib_path, 'environment.rb')))
 
 
+@timing.timed('configure_node')
 def _configure_node(node):
     """Exectutes chef-solo to apply roles and recipes to a node"""
     print("")
@@ -556,11 +1448,8 @@ def _configure_node(node):
     if env.parallel:
         msg = "[{0}]: {1}".format(env.host_string, msg)
     print(msg)
-    # Backup last report
-    with settings(hide('stdout', 'warnings', 'running'), warn_only=True):
-        sudo("mv {0} {0}.1".format(LOGFILE))
-    # Build chef-solo command
-    cmd = "RUBYOPT=-Ku chef-solo"
+    # Backup last report and build chef-solo command
+    cmd = "mv -f {0} {0}.1 2>/dev/null; RUBYOPT=-Ku chef-solo".format(LOGFILE)
     if whyrun:
         cmd += " --why-run"
     cmd += ' -l {0} -j /etc/chef/node.json'.format(env.loglevel)
@@ -0,0 +1,83 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""JSON decoding and encoding of kitchen files
+
+All kitchen reads and writes go through this module, which picks the
+fastest JSON library available at runtime and falls back to the standard
+library:
+    * Decoding: simplejson, json. Only decoders which reject the same
+      documents as the standard library may be used: ujson, for instance,
+      accepts trailing commas and numbers with leading zeros, so that
+      invalid kitchen files would go unnoticed until chef-solo runs
+    * Encoding: json. simplejson's encoder is slower than the standard
+      library's C encoder
+
+Encoding with the standard library also means that files which are meant
+to be committed (nodes/*.json) don't depend on which libraries happen to
+be installed. Setting the LITTLECHEF_JSON environment variable to 'json'
+disables the faster decoders.
+
+"""
+import os
+import json
+
+_decoders = ['simplejson']
+if os.environ.get('LITTLECHEF_JSON') == 'json':
+    _decoders = []
+
+
+def _import_first(names):
+    """Returns the first module of the list that can be imported"""
+    for name in names:
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+    return json
+
+_decoder = _import_first(_decoders)
+
+DECODER = _decoder.__name__
+ENCODER = json.__name__
+
+_loads = _decoder.loads
+
+
+def loads(string):
+    """Parses a JSON document.
+    Raises ValueError with the standard library's message on invalid JSON
+
+    """
+    try:
+        return _loads(string)
+    except (ValueError, OverflowError):
+        # The standard library gives better error messages, and parses what
+        # faster libraries may refuse, like integers wider than 64 bits
+        return json.loads(string)
+
+
+def dumps(obj):
+    """Serializes to compact JSON, for generated files"""
+    return json.dumps(obj)
+
+
+def dumps_pretty(obj):
+    """Serializes to indented JSON with sorted keys, for committed files"""
+    return json.dumps(obj, indent=4, sort_keys=True)
+
+
+def dumps_metadata(obj):
+    """Serializes cookbook metadata the way knife writes metadata.json"""
+    return json.dumps(obj, indent=2, separators=(',', ': '))
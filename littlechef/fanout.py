@@ -0,0 +1,108 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Peer to peer distribution of a file to the nodes about to be configured
+
+The workstation only uploads the file to the first few nodes, the seeds.
+Every node then forwards it to the next ones, so that it spreads as a tree
+whose nodes have up to 'width' children each. A node checks the sha1 of the
+copy it received before keeping and forwarding it, and reports the ones it
+holds in status lines. Nodes which did not get a good copy are simply not
+reported, and get the file from the workstation.
+
+Nodes log into each other with a key generated for the run, not with the
+operator's ssh agent. The key is only authorized for a forced command,
+which receives the file on its standard input and runs the node's own
+script, and it is revoked once the file is distributed.
+
+"""
+# Marks the output lines reporting the nodes which hold a good copy
+STATUS = 'littlechef-fanout:'
+# Everything a node that logs in with the run's key is allowed to do
+KEY_OPTIONS = ('no-agent-forwarding,no-port-forwarding,no-pty,no-user-rc,'
+               'no-X11-forwarding')
+AUTHORIZED_KEYS = '.ssh/authorized_keys'
+
+
+def build_tree(hosts, width):
+    """Returns (seeds, children): the hosts the workstation uploads to and a
+    dictionary of host to the hosts it forwards to. The first width hosts are
+    the seeds, and the host at index i forwards to those from index
+    width * (i + 1) on
+
+    """
+    width = max(1, width)
+    children = {}
+    for i, host in enumerate(hosts):
+        start = width * (i + 1)
+        children[host] = hosts[start:start + width]
+    return hosts[:width], children
+
+
+def build_script(host, children, addresses, path, digest, key=None,
+                 ssh='ssh', receive=False):
+    """Returns the shell script run on host, from its home directory. With
+    receive, it first reads path, relative to the home directory, from its
+    standard input. It checks the sha1 digest of path, then sends it to its
+    children concurrently, logging in with the private key file key, where
+    the forced command of the key runs their own script. addresses maps
+    hosts to their (user@hostname, port)
+
+    """
+    lines = ['f={0}'.format(path)]
+    if receive:
+        lines.append('(umask 077 && cat > "$f.tmp") && mv -f "$f.tmp" "$f" '
+                     '|| { rm -f "$f.tmp"; exit 0; }')
+    lines.extend([
+        'if [ "$(sha1sum "$f" 2>/dev/null | cut -c 1-40)" != "{0}" ]; '
+        'then rm -f "$f"; exit 0; fi'.format(digest),
+        'echo "{0} ok {1}"'.format(STATUS, host),
+    ])
+    for child in children.get(host, []):
+        destination, port = addresses[child]
+        lines.append('{0} -i {1} -p {2} {3} < "$f" &'.format(
+                     ssh, key, port, destination))
+    lines.append('wait')
+    return '\n'.join(lines) + '\n'
+
+
+def authorize_command(public_key, script):
+    """Returns the shell command authorizing the given public key, in the
+    home directory of the user running it, only to run sh script
+
+    """
+    line = 'command="sh {0}",{1} {2}'.format(script, KEY_OPTIONS,
+                                             public_key.strip())
+    return ("mkdir -p .ssh && chmod 700 .ssh && "
+            "echo '{0}' >> {1} && chmod 600 {1}".format(line, AUTHORIZED_KEYS))
+
+
+def revoke_command(marker):
+    """Returns the shell command removing the authorized keys whose line
+    contains marker, the comment of the run's key
+
+    """
+    return ('k={0}; if [ -f $k ]; then grep -v -F "{1}" $k > $k.lc; '
+            '[ $? -le 1 ] && cat $k.lc > $k; rm -f $k.lc; fi'.format(
+                AUTHORIZED_KEYS, marker))
+
+
+def get_distributed(output):
+    """Returns the hosts reported to hold a good copy"""
+    hosts = []
+    for line in str(output).splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[:2] == [STATUS, 'ok']:
+            hosts.append(fields[2])
+    return hosts
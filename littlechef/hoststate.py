@@ -0,0 +1,102 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""What is known of the setup of every node, to skip redundant setup work
+
+For each host, a file of the kitchen cache records the digests of the
+bootstrap steps last run successfully on it, the chef-solo version it
+reported and the fingerprint of the remote state the bootstrap left behind.
+The state is only trusted for remote_state_ttl seconds after being checked,
+and not at all with 'fix --refresh-remote-state'.
+
+"""
+import os
+import json
+import time
+import tempfile
+
+import littlechef
+from littlechef import cache
+
+STATE_DIR = os.path.join(cache.CACHE_DIR, 'hosts')
+
+# Hosts whose state was updated by this process, thus checked during the run
+_updated = set()
+
+
+def _state_path(host):
+    return os.path.join(STATE_DIR, host.replace(os.sep, '_') + '.json')
+
+
+def enabled():
+    """Returns True when known host states may be used"""
+    return bool(littlechef.kitchen_cache and littlechef.remote_state_ttl
+                and not littlechef.refresh_remote_state)
+
+
+def get(host):
+    """Returns the state recorded for host, or an empty dictionary when
+    unknown, expired or not to be used
+
+    """
+    if not host or not enabled():
+        return {}
+    state = _read(host)
+    if time.time() - state.get('checked', 0) > littlechef.remote_state_ttl:
+        return {}
+    return state
+
+
+def _read(host):
+    try:
+        with open(_state_path(host), 'r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def update(host, **values):
+    """Records the given values for host, which were just checked. Safe to
+    call from parallel worker processes
+
+    """
+    if not host or not littlechef.kitchen_cache:
+        return
+    # Only keep what was checked during this run or is still to be trusted
+    state = _read(host) if host in _updated else get(host)
+    state.update(values)
+    state['checked'] = time.time()
+    path = _state_path(host)
+    try:
+        if not os.path.isdir(STATE_DIR):
+            os.makedirs(STATE_DIR)
+        fd, tmp_path = tempfile.mkstemp(dir=STATE_DIR, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(state, sort_keys=True))
+        os.rename(tmp_path, path)
+        _updated.add(host)
+    except (IOError, OSError) as e:
+        # The cache is an optimization, never fail a run because of it
+        print("Warning: could not write host state {0}: {1}".format(path, e))
+
+
+def clear(host):
+    """Forgets everything known about host"""
+    if not host:
+        return
+    _updated.discard(host)
+    try:
+        os.remove(_state_path(host))
+    except OSError:
+        pass
@@ -14,19 +14,17 @@
 #
 """Library for parsing and printing role, cookbook and node information"""
 import os
-import json
-import subprocess
+import bisect
 import imp
 
 from fabric.api import env
 from fabric.contrib.console import confirm
 from fabric.utils import abort
 
-from littlechef import cookbook_paths, colors
+from littlechef import cookbook_paths, colors, cache, codec, metadata
+from littlechef import runlist, staging
 from littlechef.exceptions import FileNotFoundError
 
-knife_installed = True
-
 
 def _resolve_hostname(name):
     """Returns resolved hostname using the ssh config"""
@@ -59,19 +57,27 @@ def env_from_template(name):
     }
 
 
-def get_environment(name):
-    """Returns a JSON environment file as a dictionary"""
+_default_environment = env_from_template("_default")
+
+
+def get_environment(name, shared=False):
+    """Returns a JSON environment file as a dictionary
+    * shared: True returns the per process copy of the environment, which
+      must not be modified, instead of a new one
+
+    """
     if name == "_default":
-        return env_from_template(name)
+        return _default_environment if shared else env_from_template(name)
     filename = os.path.join("environments", name + ".json")
+    index = cache.get_index('environments')
     try:
-        with open(filename) as f:
-            try:
-                return json.loads(f.read())
-            except ValueError as e:
-                msg = 'LittleChef found the following error in'
-                msg += ' "{0}":\n                {1}'.format(filename, str(e))
-                abort(msg)
+        if shared:
+            return index.get_shared(filename)
+        return index.get(filename)
+    except ValueError as e:
+        msg = 'LittleChef found the following error in'
+        msg += ' "{0}":\n                {1}'.format(filename, str(e))
+        abort(msg)
     except IOError:
         raise FileNotFoundError('File {0} not found'.format(filename))
 
@@ -79,30 +85,40 @@ def get_environment(name):
 def get_environments():
     """Gets all environments found in the 'environments' directory"""
     envs = []
+    filenames = []
     for root, subfolders, files in os.walk('environments'):
         for filename in files:
             if filename.endswith(".json"):
+                filenames.append(os.path.join(root, filename))
                 path = os.path.join(
                     root[len('environments'):], filename[:-len('.json')])
                 envs.append(get_environment(path))
+    index = cache.get_index('environments')
+    index.retain(filenames)
+    index.flush()
     return sorted(envs, key=lambda x: x['name'])
 
 
 def get_node(name, merged=False):
     """Returns a JSON node file as a dictionary"""
     if merged:
-        node_path = os.path.join("data_bags", "node", name.replace('.', '_') + ".json")
+        node_path = staging.get_path(
+            "data_bags", "node", name.replace('.', '_') + ".json")
     else:
         node_path = os.path.join("nodes", name + ".json")
     if os.path.exists(node_path):
         # Read node.json
-        with open(node_path, 'r') as f:
-            try:
-                node = json.loads(f.read())
-            except ValueError as e:
-                msg = 'LittleChef found the following error in'
-                msg += ' "{0}":\n                {1}'.format(node_path, str(e))
-                abort(msg)
+        try:
+            if merged:
+                # Generated on every run, not worth indexing
+                with open(node_path, 'r') as f:
+                    node = codec.loads(f.read())
+            else:
+                node = _nodes_cache().get(node_path)
+        except ValueError as e:
+            msg = 'LittleChef found the following error in'
+            msg += ' "{0}":\n                {1}'.format(node_path, str(e))
+            abort(msg)
     else:
         print "Creating new node file '{0}.json'".format(name)
         node = {'run_list': []}
@@ -113,20 +129,233 @@ def get_node(name, merged=False):
     return node
 
 
-def get_nodes(environment=None):
-    """Gets all nodes found in the nodes/ directory"""
+def _summarize_node(node):
+    """Returns the node fields needed to search for nodes"""
+    virtualization = node.get('virtualization') or {}
+    guests = []
+    if virtualization.get('role') == 'host':
+        guests = [g.get('fqdn') for g in virtualization.get('guests', [])]
+    return {
+        'chef_environment': node.get('chef_environment') or '_default',
+        'run_list': node.get('run_list', []),
+        'tags': node.get('tags', []),
+        'fqdn': node.get('fqdn'),
+        'guests': guests,
+    }
+
+
+def _nodes_cache():
+    """Returns the kitchen index for node files"""
+    return cache.get_index('nodes', summarize=_summarize_node)
+
+
+def _get_node_filenames():
+    """Returns the sorted names of all node files in the nodes/ directory"""
     if not os.path.exists('nodes'):
         return []
-    nodes = []
-    for filename in sorted(
-            [f for f in os.listdir('nodes')
-             if (not os.path.isdir(f)
-                 and f.endswith(".json") and not f.startswith('.'))]):
-        fqdn = ".".join(filename.split('.')[:-1])  # Remove .json from name
-        node = get_node(fqdn)
-        if environment is None or node.get('chef_environment') == environment:
-            nodes.append(node)
-    return nodes
+    return sorted(
+        [f for f in os.listdir('nodes')
+         if (not os.path.isdir(f)
+             and f.endswith(".json") and not f.startswith('.'))])
+
+
+class LazyNode(object):
+    """Handle to a node file which only parses the node body when one of its
+    attributes is accessed
+
+    The name, path and environment are all that is kept per node, and the
+    environment is read from the kitchen index node summary
+
+    """
+    __slots__ = ('name', 'path', '_environment', '_node')
+
+    def __init__(self, name, environment=None):
+        self.name = name
+        self.path = os.path.join("nodes", name + ".json")
+        self._environment = environment
+        self._node = None
+
+    def __repr__(self):
+        return "<LazyNode {0}>".format(self.name)
+
+    @property
+    def chef_environment(self):
+        if self._environment is None:
+            self._environment = self.get_summary()['chef_environment']
+        return self._environment
+
+    def get_summary(self):
+        """Returns the read-only kitchen index summary of the node"""
+        try:
+            return _nodes_cache().get_summary(self.path)
+        except (IOError, ValueError):
+            # Let get_node() report the problem
+            return _summarize_node(self._get_node())
+
+    def load(self):
+        """Returns a newly parsed node dictionary, which is not kept"""
+        return get_node(self.name)
+
+    def _get_node(self):
+        if self._node is None:
+            self._node = self.load()
+        return self._node
+
+    def __getitem__(self, key):
+        if key == 'name':
+            return self.name
+        elif key == 'chef_environment':
+            return self.chef_environment
+        return self._get_node()[key]
+
+    def __contains__(self, key):
+        return key in ('name', 'chef_environment') or key in self._get_node()
+
+    def get(self, key, default=None):
+        if key == 'name':
+            return self.name
+        elif key == 'chef_environment':
+            return self.chef_environment
+        return self._get_node().get(key, default)
+
+    def keys(self):
+        return self._get_node().keys()
+
+
+def get_node_handles(environment=None):
+    """Returns a LazyNode for every node found in the nodes/ directory,
+    optionally only those in the given environment.
+    No node body is parsed unless the node file changed since the last run
+
+    """
+    filenames = _get_node_filenames()
+    paths = [os.path.join('nodes', f) for f in filenames]
+    index = _nodes_cache()
+    index.prefetch(paths)
+    handles = []
+    for filename, path in zip(filenames, paths):
+        name = filename[:-len('.json')]
+        try:
+            node_env = index.get_summary(path)['chef_environment']
+        except ValueError as e:
+            msg = 'LittleChef found the following error in'
+            msg += ' "{0}":\n                {1}'.format(path, str(e))
+            abort(msg)
+        if environment is None or node_env == environment:
+            handles.append(LazyNode(name, node_env))
+    index.retain(paths)
+    index.flush()
+    return handles
+
+
+def get_nodes(environment=None):
+    """Gets all nodes found in the nodes/ directory"""
+    return [handle.load() for handle in get_node_handles(environment)]
+
+
+class NodeIndex(object):
+    """Inverted index from roles, recipes, tags and environments to the
+    names of the nodes that have them
+
+    Roles and recipes are those of the expanded run_list. Terms are kept
+    sorted so that prefix searches are a range scan. It is built from the
+    node summaries of the kitchen index, so node files are only parsed
+    when they changed since the last run
+
+    """
+    FIELDS = ('role', 'recipe', 'tag', 'environment')
+
+    def __init__(self, graph=None):
+        self.graph = graph or RoleGraph()
+        # Node names in nodes/ listing order, postings refer to positions
+        self.names = []
+        self.summaries = {}
+        self._postings = dict((field, {}) for field in self.FIELDS)
+        index = _nodes_cache()
+        filenames = _get_node_filenames()
+        index.prefetch([os.path.join('nodes', f) for f in filenames])
+        for filename in filenames:
+            path = os.path.join('nodes', filename)
+            try:
+                summary = index.get_summary(path)
+            except ValueError as e:
+                msg = 'LittleChef found the following error in'
+                msg += ' "{0}":\n                {1}'.format(path, str(e))
+                abort(msg)
+            self._add(filename[:-len('.json')], summary)
+        self._terms = dict((field, sorted(self._postings[field]))
+                           for field in self.FIELDS)
+        index.retain([os.path.join('nodes', f) for f in filenames])
+        index.flush()
+
+    def _add(self, name, summary):
+        position = len(self.names)
+        self.names.append(name)
+        self.summaries[name] = summary
+        roles, recipes = self.graph.expand_run_list(
+            summary['run_list'], summary['chef_environment'])
+        terms = {
+            'role': roles,
+            'recipe': recipes,
+            'tag': summary['tags'],
+            'environment': [summary['chef_environment']],
+        }
+        for field, values in terms.items():
+            postings = self._postings[field]
+            for value in values:
+                postings.setdefault(value, set()).add(position)
+
+    def _positions(self, field, term):
+        """Returns the set of node positions matching the term.
+        A trailing '*' makes it a prefix search
+
+        """
+        postings = self._postings[field]
+        if not term.endswith("*"):
+            return set(postings.get(term, ()))
+        prefix = term.rstrip("*")
+        terms = self._terms[field]
+        positions = set()
+        for i in xrange(bisect.bisect_left(terms, prefix), len(terms)):
+            if not terms[i].startswith(prefix):
+                break
+            positions.update(postings[terms[i]])
+        return positions
+
+    def search(self, field, term, environment=None):
+        """Returns the names of the nodes matching the given term, in
+        nodes/ directory order. Prefix searches are supported
+
+        """
+        positions = self._positions(field, term)
+        if environment is not None:
+            positions &= self._positions('environment', environment)
+        return [self.names[i] for i in sorted(positions)]
+
+    def search_tag(self, tag, environment=None, include_guests=False):
+        """Returns the names of the nodes with the given tag. With
+        include_guests, the guests of tagged virtualization hosts follow
+        each host
+
+        """
+        if environment is None:
+            nodes_mapping = set(self.names)
+        else:
+            nodes_mapping = set(self.search('environment', environment))
+        names = []
+        for name in self.search('tag', tag, environment):
+            # Remove from node mapping so it doesn't get added twice by
+            # guest walking below
+            nodes_mapping.discard(self.summaries[name]['fqdn'])
+            names.append(name)
+            # Walk guest if it is a host
+            if include_guests:
+                for guest in self.summaries[name]['guests']:
+                    # we ignore guests which are not in the same
+                    # chef environments than their hosts for now
+                    if guest in nodes_mapping:
+                        names.append(guest)
+        return names
 
 
 def get_nodes_with_role(role_name, environment=None):
@@ -134,41 +363,14 @@ def get_nodes_with_role(role_name, environment=None):
     prefix-searches are also supported
 
     """
-    prefix_search = role_name.endswith("*")
-    if prefix_search:
-        role_name = role_name.rstrip("*")
-    for n in get_nodes(environment):
-        roles = get_roles_in_node(n, recursive=True)
-        if prefix_search:
-            if any(role.startswith(role_name) for role in roles):
-                yield n
-        else:
-            if role_name in roles:
-                yield n
+    for name in NodeIndex().search('role', role_name, environment):
+        yield get_node(name)
 
 
 def get_nodes_with_tag(tag, environment=None, include_guests=False):
     """Get all nodes which include a given tag"""
-    nodes = get_nodes(environment)
-    nodes_mapping = dict((n['name'], n) for n in nodes)
-    for n in nodes:
-        if tag in n.get('tags', []):
-            # Remove from node mapping so it doesn't get added twice by
-            # guest walking below
-            try:
-                del nodes_mapping[n['fqdn']]
-            except KeyError:
-                pass
-            yield n
-            # Walk guest if it is a host
-            if include_guests and n.get('virtualization', {}).get('role') == 'host':
-                for guest in n['virtualization'].get('guests', []):
-                    try:
-                        yield nodes_mapping[guest['fqdn']]
-                    except KeyError:
-                        # we ignore guests which are not in the same
-                        # chef environments than their hosts for now
-                        pass
+    for name in NodeIndex().search_tag(tag, environment, include_guests):
+        yield get_node(name)
 
 
 def get_nodes_with_recipe(recipe_name, environment=None):
@@ -176,19 +378,8 @@ def get_nodes_with_recipe(recipe_name, environment=None):
     prefix-searches are also supported
 
     """
-    prefix_search = recipe_name.endswith("*")
-    if prefix_search:
-        recipe_name = recipe_name.rstrip("*")
-    for n in get_nodes(environment):
-        recipes = get_recipes_in_node(n)
-        for role in get_roles_in_node(n, recursive=True):
-            recipes.extend(get_recipes_in_role(role))
-        if prefix_search:
-            if any(recipe.startswith(recipe_name) for recipe in recipes):
-                yield n
-        else:
-            if recipe_name in recipes:
-                yield n
+    for name in NodeIndex().search('recipe', recipe_name, environment):
+        yield get_node(name)
 
 
 def print_node(node, detailed=False):
@@ -227,51 +418,66 @@ def print_nodes(nodes, detailed=False):
 
 def _generate_metadata(path, cookbook_path, name):
     """Checks whether metadata.rb has changed and regenerate metadata.json"""
-    global knife_installed
-    if not knife_installed:
-        return
-    metadata_path_rb = os.path.join(path, 'metadata.rb')
-    metadata_path_json = os.path.join(path, 'metadata.json')
-    if (os.path.exists(metadata_path_rb) and
-            (not os.path.exists(metadata_path_json) or
-             os.stat(metadata_path_rb).st_mtime >
-             os.stat(metadata_path_json).st_mtime)):
-        error_msg = "Warning: metadata.json for {0}".format(name)
-        error_msg += " in {0} is older that metadata.rb".format(cookbook_path)
-        error_msg += ", cookbook attributes could be out of date\n\n"
-        try:
-            proc = subprocess.Popen(
-                ['knife', 'cookbook', 'metadata', '-o', cookbook_path, name],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            resp, error = proc.communicate()
-            if ('ERROR:' in resp or 'FATAL:' in resp
-                    or 'Generating metadata for' not in resp):
-                if("No user specified, pass via -u or specifiy 'node_name'"
-                        in error):
-                    error_msg += "You need to have an up-to-date (>=0.10.x)"
-                    error_msg += " version of knife installed locally in order"
-                    error_msg += " to generate metadata.json.\nError "
-                else:
-                    error_msg += "Unkown error "
-                error_msg += "while executing knife to generate "
-                error_msg += "metadata.json for {0}".format(path)
-                print(error_msg)
-                print resp
-            if env.loglevel == 'debug':
-                print "\n".join(resp.split("\n")[:2])
-        except OSError:
-            knife_installed = False
-            error_msg += "If you locally install Chef's knife tool, LittleChef"
-            error_msg += " will regenerate metadata.json files automatically\n"
-            print(error_msg)
-        else:
-            print("Generated metadata.json for {0}\n".format(path))
+    metadata.generate([(path, cookbook_path, name)])
+
+
+def get_cookbook_fingerprint(name):
+    """Returns the (mtime, size) of the metadata files and recipes directory
+    of a cookbook in every cookbook path, which change whenever the
+    cookbook's recipe list has to be rebuilt
+
+    """
+    fingerprint = []
+    for cookbook_path in cookbook_paths:
+        path = os.path.join(cookbook_path, name)
+        for filename in ['metadata.json', 'metadata.rb', 'recipes']:
+            try:
+                st = os.stat(os.path.join(path, filename))
+            except OSError:
+                fingerprint.append((cookbook_path, filename, None))
+            else:
+                fingerprint.append(
+                    (cookbook_path, filename, st.st_mtime, st.st_size))
+    return tuple(fingerprint)
+
 
+def _metadata_is_outdated(name):
+    """Returns True when any metadata.rb of the cookbook is newer than its
+    metadata.json
 
-def get_recipes_in_cookbook(name):
+    """
+    for cookbook_path in cookbook_paths:
+        if metadata.is_outdated(os.path.join(cookbook_path, name)):
+            return True
+    return False
+
+
+def get_recipes_in_cookbook(name, fingerprint=None):
     """Gets the name of all recipes present in a cookbook
     Returns a list of dictionaries
 
+    Recipes are read from the compiled recipe catalog unless the cookbook's
+    metadata or recipes directory changed. The cookbook fingerprint is
+    computed when not given
+
+    """
+    catalog = cache.get_store('recipes')
+    if fingerprint is None:
+        fingerprint = get_cookbook_fingerprint(name)
+    recipes = catalog.get_fresh(name, fingerprint)
+    if recipes is not None:
+        return recipes
+    recipes = _build_recipes_in_cookbook(name)
+    # Don't keep recipes built from metadata that could not be regenerated
+    if not _metadata_is_outdated(name):
+        catalog.put(name, get_cookbook_fingerprint(name), recipes)
+    return recipes
+
+
+def _build_recipes_in_cookbook(name):
+    """Reads the metadata and recipes directory of a cookbook
+    Returns a list of recipe dictionaries
+
     """
     recipes = {}
     path = None
@@ -288,35 +494,33 @@ def get_recipes_in_cookbook(name):
         _generate_metadata(path, cookbook_path, name)
 
         # Now try to open metadata.json
+        metadata_path = os.path.join(path, 'metadata.json')
         try:
-            with open(os.path.join(path, 'metadata.json'), 'r') as f:
-                try:
-                    cookbook = json.loads(f.read())
-                except ValueError as e:
-                    msg = "Little Chef found the following error in your"
-                    msg += " {0} file:\n  {1}".format(
-                        os.path.join(path, 'metadata.json'), e)
-                    abort(msg)
-                # Add each recipe defined in the cookbook
-                metadata_exists = True
-                recipe_defaults = {
-                    'description': '',
-                    'version': cookbook.get('version'),
-                    'dependencies': cookbook.get('dependencies', {}).keys(),
-                    'attributes': cookbook.get('attributes', {})
-                }
-                for recipe in cookbook.get('recipes', []):
-                    recipes[recipe] = dict(
-                        recipe_defaults,
-                        name=recipe,
-                        description=cookbook['recipes'][recipe]
-                    )
-            # Cookbook metadata.json was found, don't try next cookbook path
-            # because metadata.json in site-cookbooks has preference
-            break
+            cookbook = cache.get_index('metadata').get(metadata_path)
+        except ValueError as e:
+            msg = "Little Chef found the following error in your"
+            msg += " {0} file:\n  {1}".format(metadata_path, e)
+            abort(msg)
         except IOError:
             # metadata.json was not found, try next cookbook_path
-            pass
+            continue
+        # Add each recipe defined in the cookbook
+        metadata_exists = True
+        recipe_defaults = {
+            'description': '',
+            'version': cookbook.get('version'),
+            'dependencies': cookbook.get('dependencies', {}).keys(),
+            'attributes': cookbook.get('attributes', {})
+        }
+        for recipe in cookbook.get('recipes', []):
+            recipes[recipe] = dict(
+                recipe_defaults,
+                name=recipe,
+                description=cookbook['recipes'][recipe]
+            )
+        # Cookbook metadata.json was found, don't try next cookbook path
+        # because metadata.json in site-cookbooks has preference
+        break
     if not cookbook_exists:
         abort('Unable to find cookbook "{0}"'.format(name))
     elif not metadata_exists:
@@ -356,12 +560,7 @@ def get_recipes_in_role(rolename):
 
 def get_recipes_in_node(node):
     """Gets the name of all recipes present in the run_list of a node"""
-    recipes = []
-    for elem in node.get('run_list', []):
-        if elem.startswith("recipe"):
-            recipe = elem.split('[')[1].split(']')[0]
-            recipes.append(recipe)
-    return recipes
+    return runlist.get_recipes(node.get('run_list', []))
 
 
 def get_recipes():
@@ -370,9 +569,29 @@ def get_recipes():
     for path in cookbook_paths:
         dirnames.update([d for d in os.listdir(path) if os.path.isdir(
                             os.path.join(path, d)) and not d.startswith('.')])
+    dirnames = sorted(dirnames)
+    catalog = cache.get_store('recipes')
+    fingerprints = dict((d, get_cookbook_fingerprint(d)) for d in dirnames)
+    outdated = [d for d in dirnames
+                if not catalog.is_fresh(d, fingerprints[d])]
+    # Regenerate all outdated metadata.json files in one go
+    stale = [(os.path.join(path, d), path, d)
+             for d in outdated for path in cookbook_paths
+             if metadata.is_outdated(os.path.join(path, d))]
+    if stale:
+        metadata.generate(stale)
+        for d in set(cookbook[2] for cookbook in stale):
+            fingerprints[d] = get_cookbook_fingerprint(d)
+    index = cache.get_index('metadata')
+    index.prefetch([os.path.join(path, d, 'metadata.json')
+                    for path in cookbook_paths for d in outdated])
     recipes = []
     for dirname in dirnames:
-        recipes.extend(get_recipes_in_cookbook(dirname))
+        recipes.extend(get_recipes_in_cookbook(dirname, fingerprints[dirname]))
+    index.retain([os.path.join(path, d, 'metadata.json')
+                  for path in cookbook_paths for d in dirnames])
+    catalog.retain(dirnames)
+    cache.flush()
     return sorted(recipes, key=lambda x: x['name'])
 
 
@@ -390,24 +609,24 @@ def get_roles_in_role(rolename):
     return get_roles_in_node(_get_role(rolename))
 
 
-def get_roles_in_node(node, recursive=False, depth=0):
+def get_roles_in_node(node, recursive=False, graph=None):
     """Returns a list of roles found in the run_list of a node
-    * recursive: True feches roles recursively
-    * depth: Keeps track of recursion depth
+    * recursive: True fetches roles recursively, in run_list order
+    * graph: RoleGraph to expand nested roles with. A new one is used when
+      none is given
 
     """
-    LIMIT = 5
-    roles = []
-    for elem in node.get('run_list', []):
-        if elem.startswith("role"):
-            role = elem.split('[')[1].split(']')[0]
-            if role not in roles:
-                roles.append(role)
-                if recursive and depth <= LIMIT:
-                    roles.extend(get_roles_in_node(_get_role(role),
-                                                   recursive=True,
-                                                   depth=depth + 1))
-    return list(set(roles))
+    if recursive:
+        graph = graph or RoleGraph()
+        return list(graph.expand_run_list(node.get('run_list', []),
+                                          node.get('chef_environment'))[0])
+    return runlist.get_roles(node.get('run_list', []))
+
+
+class RoleGraph(runlist.Expander):
+    """run_list expander loading roles from the kitchen's roles directory"""
+    def __init__(self):
+        super(RoleGraph, self).__init__(lambda name: _get_role(name))
 
 
 def _get_role(rolename):
@@ -415,26 +634,31 @@ def _get_role(rolename):
     path = os.path.join('roles', rolename + '.json')
     if not os.path.exists(path):
         abort("Couldn't read role file {0}".format(path))
-    with open(path, 'r') as f:
-        try:
-            role = json.loads(f.read())
-        except ValueError as e:
-            msg = "Little Chef found the following error in your"
-            msg += " {0}.json file:\n  {1}".format(rolename, str(e))
-            abort(msg)
-        role['fullname'] = rolename
-        return role
+    try:
+        role = cache.get_index('roles').get(path)
+    except ValueError as e:
+        msg = "Little Chef found the following error in your"
+        msg += " {0}.json file:\n  {1}".format(rolename, str(e))
+        abort(msg)
+    role['fullname'] = rolename
+    return role
 
 
 def get_roles():
     """Gets all roles found in the 'roles' directory"""
-    roles = []
+    rolenames = []
+    filenames = []
     for root, subfolders, files in os.walk('roles'):
         for filename in files:
             if filename.endswith(".json"):
-                path = os.path.join(
-                    root[len('roles'):], filename[:-len('.json')])
-                roles.append(_get_role(path))
+                filenames.append(os.path.join(root, filename))
+                rolenames.append(os.path.join(
+                    root[len('roles'):], filename[:-len('.json')]))
+    index = cache.get_index('roles')
+    index.prefetch(filenames)
+    roles = [_get_role(rolename) for rolename in rolenames]
+    index.retain(filenames)
+    index.flush()
     return sorted(roles, key=lambda x: x['fullname'])
 
 
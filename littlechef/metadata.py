@@ -0,0 +1,511 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Generation of cookbook metadata.json files out of metadata.rb
+
+Outdated cookbooks are regenerated together: either by evaluating their
+metadata.rb in Python, which understands the common subset of the metadata
+DSL, or by running 'knife cookbook metadata' in a bounded pool of workers.
+
+"""
+import os
+import re
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+
+from fabric.api import env
+
+import littlechef
+from littlechef import codec
+
+knife_installed = True
+# Cookbook paths which generation was already attempted for in this process
+_attempted = set()
+
+
+class UnsupportedMetadata(Exception):
+    """metadata.rb uses Ruby the Python evaluator doesn't understand"""
+    pass
+
+
+def is_outdated(path):
+    """Returns True when the cookbook in path has a metadata.rb newer than
+    its metadata.json
+
+    """
+    metadata_path_rb = os.path.join(path, 'metadata.rb')
+    metadata_path_json = os.path.join(path, 'metadata.json')
+    return (os.path.exists(metadata_path_rb) and
+            (not os.path.exists(metadata_path_json) or
+             os.stat(metadata_path_rb).st_mtime >
+             os.stat(metadata_path_json).st_mtime))
+
+
+def generate(cookbooks):
+    """Regenerates metadata.json for the outdated cookbooks among the given
+    (path, cookbook_path, name) tuples
+
+    With littlechef.metadata_evaluator set to 'python', metadata.rb files
+    are evaluated in Python first. knife is only run for the rest, using up
+    to littlechef.metadata_workers processes at a time
+
+    """
+    pending = [c for c in cookbooks
+               if c[0] not in _attempted and is_outdated(c[0])]
+    _attempted.update(c[0] for c in pending)
+    if littlechef.metadata_evaluator == 'python':
+        remaining = []
+        for cookbook in pending:
+            path = cookbook[0]
+            try:
+                write_metadata_json(path)
+            except UnsupportedMetadata as e:
+                if env.loglevel == 'debug':
+                    print("Could not evaluate {0}/metadata.rb in Python: "
+                          "{1}".format(path, e))
+                remaining.append(cookbook)
+            else:
+                print("Generated metadata.json for {0}\n".format(path))
+        pending = remaining
+    if not pending or not knife_installed:
+        return
+    # Run the first one alone, to find out whether knife is installed
+    if not _print_knife_result(_run_knife(pending[0])):
+        return
+    pending = pending[1:]
+    if not pending:
+        return
+    workers = littlechef.metadata_workers or multiprocessing.cpu_count()
+    pool = ThreadPool(min(workers, len(pending)))
+    try:
+        results = pool.map(_run_knife, pending)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        _print_knife_result(result)
+
+
+def _run_knife(cookbook):
+    """Runs knife to generate the metadata.json of a cookbook.
+    Returns (cookbook, stdout, stderr), with None outputs when knife is not
+    installed
+
+    """
+    path, cookbook_path, name = cookbook
+    try:
+        proc = subprocess.Popen(
+            ['knife', 'cookbook', 'metadata', '-o', cookbook_path, name],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return cookbook, None, None
+    resp, error = proc.communicate()
+    return cookbook, resp, error
+
+
+def _print_knife_result(result):
+    """Reports the outcome of a knife run.
+    Returns False when knife is not installed
+
+    """
+    global knife_installed
+    (path, cookbook_path, name), resp, error = result
+    error_msg = "Warning: metadata.json for {0}".format(name)
+    error_msg += " in {0} is older that metadata.rb".format(cookbook_path)
+    error_msg += ", cookbook attributes could be out of date\n\n"
+    if resp is None:
+        knife_installed = False
+        error_msg += "If you locally install Chef's knife tool, LittleChef"
+        error_msg += " will regenerate metadata.json files automatically\n"
+        print(error_msg)
+        return False
+    if ('ERROR:' in resp or 'FATAL:' in resp
+            or 'Generating metadata for' not in resp):
+        if("No user specified, pass via -u or specifiy 'node_name'"
+                in error):
+            error_msg += "You need to have an up-to-date (>=0.10.x)"
+            error_msg += " version of knife installed locally in order"
+            error_msg += " to generate metadata.json.\nError "
+        else:
+            error_msg += "Unkown error "
+        error_msg += "while executing knife to generate "
+        error_msg += "metadata.json for {0}".format(path)
+        print(error_msg)
+        print(resp)
+    if env.loglevel == 'debug':
+        print("\n".join(resp.split("\n")[:2]))
+    print("Generated metadata.json for {0}\n".format(path))
+    return True
+
+
+def write_metadata_json(path):
+    """Evaluates path/metadata.rb and writes path/metadata.json
+    Raises UnsupportedMetadata when metadata.rb can't be evaluated
+
+    """
+    metadata_path_rb = os.path.join(path, 'metadata.rb')
+    with open(metadata_path_rb, 'r') as f:
+        metadata = evaluate(f.read(), metadata_path_rb)
+    if metadata['name'] is None:
+        metadata['name'] = os.path.basename(os.path.abspath(path))
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        f.write(codec.dumps_metadata(metadata))
+
+
+def evaluate(source, filename='metadata.rb'):
+    """Evaluates the source of a metadata.rb file.
+    Returns the metadata as knife would write it to metadata.json
+
+    """
+    metadata = _Metadata()
+    _Parser(_tokenize(source), filename, metadata).parse()
+    return metadata.to_dict()
+
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>[ \t\r]+|\\\n|\#[^\n]*)
+  | (?P<newline>\n|;)
+  | (?P<words>%[wW](?:\{[^}]*\}|\([^)]*\)|\[[^\]]*\]))
+  | (?P<dstring>"(?:[^"\\]|\\.)*")
+  | (?P<sstring>'(?:[^'\\]|\\.)*')
+  | (?P<label>[A-Za-z_]\w*:(?=\s))
+  | (?P<symbol>:[A-Za-z_]\w*[?!]?)
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<method>\.[A-Za-z_]\w*)
+  | (?P<ident>[A-Za-z_]\w*(?:(?:\.|::)[A-Za-z_]\w*)*[?!]?)
+  | (?P<op>=>|[()\[\]{},|])
+""", re.VERBOSE)
+
+_ESCAPES = {'n': '\n', 't': '\t', 's': ' ', '0': '\0', 'e': '\x1b'}
+
+
+def _tokenize(source):
+    """Splits metadata.rb source into (kind, value) tokens"""
+    tokens = []
+    pos = 0
+    while pos < len(source):
+        match = _TOKEN_RE.match(source, pos)
+        if match is None:
+            raise UnsupportedMetadata(
+                "unexpected {0!r}".format(source[pos:pos + 20]))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'space':
+            continue
+        elif kind == 'dstring':
+            if '#{' in value:
+                raise UnsupportedMetadata("string interpolation")
+            value = re.sub(r'\\(.)', lambda m: _ESCAPES.get(m.group(1),
+                                                           m.group(1)),
+                           value[1:-1])
+            kind = 'string'
+        elif kind == 'sstring':
+            value = re.sub(r"\\([\\'])", r'\1', value[1:-1])
+            kind = 'string'
+        elif kind == 'words':
+            value = value[3:-1].split()
+        elif kind == 'label':
+            value = value[:-1]
+        elif kind == 'symbol':
+            value = value[1:]
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        tokens.append((kind, value))
+    tokens.append(('newline', '\n'))
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent evaluator for the metadata.rb subset made of
+    method calls with literal arguments, IO.read of files next to
+    metadata.rb and 'each' loops over literal lists
+
+    """
+    CONSTANTS = {'true': True, 'false': False, 'nil': None}
+
+    def __init__(self, tokens, filename, metadata):
+        self.tokens = tokens
+        self.pos = 0
+        self.filename = filename
+        self.metadata = metadata
+        self.variables = {}
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise UnsupportedMetadata(
+                "expected {0} but found {1!r}".format(value or kind, token[1]))
+        return token[1]
+
+    def at(self, kind, value=None):
+        token = self.peek()
+        return token[0] == kind and (value is None or token[1] == value)
+
+    def at_closing(self, end):
+        """Returns True when the next token closes a block or call"""
+        if end == 'end':
+            return self.at('ident', 'end')
+        return end is not None and self.at('op', end)
+
+    def skip_newlines(self):
+        while self.pos < len(self.tokens) - 1 and self.at('newline'):
+            self.pos += 1
+
+    def parse(self):
+        self.statements(end=None)
+
+    def statements(self, end):
+        """Evaluates statements until the given closing token"""
+        while True:
+            self.skip_newlines()
+            if self.pos >= len(self.tokens) - 1:
+                if end is not None:
+                    raise UnsupportedMetadata("missing '{0}'".format(end))
+                return
+            if end is not None and self.at_closing(end):
+                self.pos += 1
+                return
+            self.statement()
+
+    def statement(self):
+        kind, value = self.peek()
+        if kind == 'ident' and value not in self.variables and (
+                value not in self.CONSTANTS):
+            self.pos += 1
+            self.metadata.call(value, *self.arguments())
+            return
+        # A loop over a literal list: %w{a b}.each do |x| ... end
+        items = self.value()
+        if not isinstance(items, list):
+            raise UnsupportedMetadata("unexpected {0!r}".format(value))
+        self.expect('method', '.each')
+        if self.at('ident', 'do'):
+            self.pos += 1
+            end = 'end'
+        else:
+            self.expect('op', '{')
+            end = '}'
+        self.expect('op', '|')
+        variable = self.expect('ident')
+        self.expect('op', '|')
+        start = self.pos
+        for item in items:
+            self.pos = start
+            self.variables[variable] = item
+            self.statements(end)
+        if not items:
+            raise UnsupportedMetadata("loop over an empty list")
+        del self.variables[variable]
+
+    def arguments(self):
+        """Parses the arguments of a method call. Trailing 'key => value'
+        pairs are collected into a dictionary
+
+        """
+        parenthesized = self.at('op', '(')
+        if parenthesized:
+            self.pos += 1
+        args = []
+        options = OrderedDict()
+        closing = ')' if parenthesized else None
+        while not (self.at('newline') or self.at_closing(closing) or
+                   self.at_closing('end') or self.at_closing('}')):
+            if self.at('label'):
+                key = self.next()[1]
+                self.skip_newlines()
+                options[key] = self.value()
+            else:
+                value = self.value()
+                if self.at('op', '=>'):
+                    self.pos += 1
+                    self.skip_newlines()
+                    options[value] = self.value()
+                else:
+                    args.append(value)
+            if not self.at('op', ','):
+                break
+            self.pos += 1
+            self.skip_newlines()
+        if parenthesized:
+            self.expect('op', ')')
+        if options:
+            args.append(options)
+        return args
+
+    def value(self):
+        kind, value = self.next()
+        if kind in ('string', 'number', 'words', 'symbol'):
+            return value
+        elif kind == 'ident' and value in self.CONSTANTS:
+            return self.CONSTANTS[value]
+        elif kind == 'ident' and value in self.variables:
+            return self.variables[value]
+        elif kind == 'op' and value == '[':
+            items = []
+            self.skip_newlines()
+            while not self.at('op', ']'):
+                items.append(self.value())
+                self.skip_newlines()
+                if not self.at('op', ','):
+                    break
+                self.pos += 1
+                self.skip_newlines()
+            self.expect('op', ']')
+            return items
+        elif kind == 'op' and value == '{':
+            options = OrderedDict()
+            self.skip_newlines()
+            while not self.at('op', '}'):
+                if self.at('label'):
+                    key = self.next()[1]
+                else:
+                    key = self.value()
+                    self.expect('op', '=>')
+                self.skip_newlines()
+                options[key] = self.value()
+                self.skip_newlines()
+                if not self.at('op', ','):
+                    break
+                self.pos += 1
+                self.skip_newlines()
+            self.expect('op', '}')
+            return options
+        elif kind == 'ident':
+            return self.file_expression(value)
+        raise UnsupportedMetadata("unexpected {0!r}".format(value))
+
+    def file_expression(self, function):
+        """Evaluates the file functions used to read a README"""
+        if function == '__FILE__':
+            return self.filename
+        if function not in ('IO.read', 'File.read', 'File.join',
+                            'File.dirname', 'File.expand_path'):
+            raise UnsupportedMetadata("unknown method '{0}'".format(function))
+        self.expect('op', '(')
+        args = []
+        while not self.at('op', ')'):
+            args.append(self.value())
+            if not self.at('op', ','):
+                break
+            self.pos += 1
+        self.expect('op', ')')
+        try:
+            if function in ('IO.read', 'File.read'):
+                with open(args[0], 'r') as f:
+                    return f.read()
+            elif function == 'File.join':
+                return os.path.join(*args)
+            elif function == 'File.dirname':
+                return os.path.dirname(args[0])
+            elif len(args) == 1:
+                return os.path.abspath(args[0])
+            else:
+                return os.path.normpath(os.path.join(args[1], args[0]))
+        except (IOError, IndexError, TypeError) as e:
+            raise UnsupportedMetadata(str(e))
+
+
+class _Metadata(object):
+    """Collects metadata the way Chef::Cookbook::Metadata does"""
+    STRINGS = ('name', 'description', 'long_description', 'maintainer',
+               'maintainer_email', 'license', 'version', 'source_url',
+               'issues_url')
+    # DSL method => metadata.json key of its {name: version constraint} hash
+    CONSTRAINTS = {
+        'supports': 'platforms',
+        'depends': 'dependencies',
+        'recommends': 'recommendations',
+        'suggests': 'suggestions',
+        'conflicts': 'conflicting',
+        'provides': 'providing',
+        'replaces': 'replacing',
+    }
+
+    def __init__(self):
+        self.data = OrderedDict([
+            ('name', None),
+            ('description', ''),
+            ('long_description', ''),
+            ('maintainer', None),
+            ('maintainer_email', None),
+            ('license', 'All rights reserved'),
+            ('platforms', OrderedDict()),
+            ('dependencies', OrderedDict()),
+            ('recommendations', OrderedDict()),
+            ('suggestions', OrderedDict()),
+            ('conflicting', OrderedDict()),
+            ('providing', OrderedDict()),
+            ('replacing', OrderedDict()),
+            ('attributes', OrderedDict()),
+            ('groupings', OrderedDict()),
+            ('recipes', OrderedDict()),
+            ('version', '0.0.0'),
+        ])
+
+    def call(self, method, *args):
+        if method in self.STRINGS:
+            if len(args) != 1 or not isinstance(args[0], basestring):
+                raise UnsupportedMetadata(
+                    "'{0}' expects a string".format(method))
+            if method == 'version' and not re.match(
+                    r'^\d+\.\d+(\.\d+)?$', args[0]):
+                raise UnsupportedMetadata(
+                    "invalid version '{0}'".format(args[0]))
+            self.data[method] = args[0]
+        elif method in self.CONSTRAINTS:
+            if not args or len(args) > 2:
+                raise UnsupportedMetadata(
+                    "'{0}' expects a name and a version".format(method))
+            constraint = args[1] if len(args) == 2 else '>= 0.0.0'
+            self.data[self.CONSTRAINTS[method]][args[0]] = constraint
+        elif method == 'recipe':
+            if len(args) != 2:
+                raise UnsupportedMetadata("'recipe' expects two arguments")
+            self.data['recipes'][args[0]] = args[1]
+        elif method == 'attribute':
+            self.attribute(*args)
+        elif method == 'grouping':
+            if len(args) != 2 or not isinstance(args[1], dict):
+                raise UnsupportedMetadata("'grouping' expects options")
+            self.data['groupings'][args[0]] = args[1]
+        else:
+            raise UnsupportedMetadata("unknown method '{0}'".format(method))
+
+    def attribute(self, name=None, options=None):
+        if not isinstance(name, basestring) or not isinstance(options, dict):
+            raise UnsupportedMetadata("'attribute' expects a name and options")
+        options = OrderedDict(options)
+        for key, default in [('choice', []), ('calculated', False),
+                             ('type', 'string'), ('required', 'optional'),
+                             ('recipes', [])]:
+            options.setdefault(key, default)
+        if options['required'] is True:
+            options['required'] = 'required'
+        elif options['required'] is False:
+            options['required'] = 'optional'
+        self.data['attributes'][name] = options
+
+    def to_dict(self):
+        return self.data
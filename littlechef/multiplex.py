@@ -0,0 +1,100 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""OpenSSH connection multiplexing for rsync and other out-of-band transfers
+
+Fabric talks to nodes through paramiko, whose connection can't be shared
+with the ssh processes started by rsync. Instead, the first ssh process
+started for a destination becomes a ControlMaster listening on a socket in
+a private directory, and the following ssh processes to that destination
+reuse its connection instead of doing their own TCP and key exchange
+handshakes. The masters are stopped and the directory removed when the
+process which created it exits.
+
+The gain depends on how many ssh processes go to the same destination. In
+the rsync sync mode a node gets one rsync, two with package syncing, so
+only the second one is spared a handshake. Through a gateway, the rsyncs of
+all nodes connect to the gateway and share a single master.
+
+"""
+import os
+import stat
+import atexit
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+import littlechef
+
+# Seconds an idle master stays around. Masters are stopped at exit, this
+# only bounds how long one outlives a run killed before it could do so
+CONTROL_PERSIST = 30
+
+# (pid of the creating process, directory of the control sockets)
+_control = []
+
+
+def enabled():
+    """Returns True when ssh connections are to be multiplexed"""
+    # Not supported by the Windows OpenSSH client
+    return bool(littlechef.ssh_multiplexing) and os.name != 'nt'
+
+
+def get_control_dir():
+    """Returns the private directory of the control sockets of this
+    invocation, which is created on first use
+
+    """
+    if not _control:
+        # Kept short: socket paths are limited to about 100 characters
+        directory = tempfile.mkdtemp(prefix='lc-ssh-')
+        _control.append((os.getpid(), directory))
+    return _control[0][1]
+
+
+def get_ssh_options(destination):
+    """Returns the ssh options which make all ssh processes connecting to
+    the given [user@]host[:port] destination share one connection
+
+    """
+    if not enabled():
+        return ""
+    path = os.path.join(get_control_dir(),
+                        hashlib.sha1(destination).hexdigest()[:12])
+    return ("-o ControlMaster=auto -o ControlPath={0} "
+            "-o ControlPersist={1}".format(path, CONTROL_PERSIST))
+
+
+def close():
+    """Stops the master connections and removes the control directory, only
+    from the process which created it and not from forked workers
+
+    """
+    if not _control or _control[0][0] != os.getpid():
+        return
+    directory = _control[0][1]
+    with open(os.devnull, 'w') as devnull:
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                # The host is ignored, the master is found by its socket
+                subprocess.call(['ssh', '-o', 'ControlPath=' + path,
+                                 '-O', 'exit', 'littlechef'],
+                                stdout=devnull, stderr=devnull)
+    shutil.rmtree(directory, ignore_errors=True)
+    del _control[:]
+
+
+atexit.register(close)
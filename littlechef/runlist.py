@@ -0,0 +1,145 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""run_list parsing and expansion
+
+Entries are parsed once into RunListItem tuples. Expansions are memoized
+per (run_list, environment), so that nodes sharing a run_list are only
+expanded once, and per (role, environment) for nested roles.
+
+"""
+from collections import namedtuple
+
+from fabric.utils import abort
+
+RunListItem = namedtuple('RunListItem', ['type', 'name', 'version'])
+
+_items = {}
+
+
+def parse_item(entry):
+    """Parses a run_list entry like 'role[base]', 'recipe[apache2::mod]',
+    'recipe[vim@1.0.0]' or a bare 'vim', which Chef takes as a recipe
+
+    """
+    item = _items.get(entry)
+    if item is None:
+        # Memoized under the entry as given, surrounding whitespace included
+        text = entry.strip()
+        if text.endswith(']') and '[' in text:
+            kind, name = text[:-1].split('[', 1)
+        else:
+            kind, name = 'recipe', text
+        version = None
+        if kind == 'recipe' and '@' in name:
+            name, version = name.split('@', 1)
+        item = RunListItem(kind, name, version)
+        _items[entry] = item
+    return item
+
+
+def parse(run_list):
+    """Returns the run_list as a tuple of RunListItems"""
+    return tuple(parse_item(entry) for entry in run_list)
+
+
+def get_roles(run_list):
+    """Returns the roles listed directly in the run_list, in order"""
+    return _unique(item.name for item in parse(run_list)
+                   if item.type == 'role')
+
+
+def get_recipes(run_list):
+    """Returns the recipes listed directly in the run_list, in order"""
+    return [item.name for item in parse(run_list) if item.type == 'recipe']
+
+
+def _unique(names):
+    result = []
+    seen = set()
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            result.append(name)
+    return result
+
+
+class Expander(object):
+    """Expands run_lists the way Chef does, with every role replaced by its
+    own (environment specific, if it has one) run_list in place.
+    Each role is loaded only once, through the get_role function
+
+    """
+    def __init__(self, get_role):
+        self.load_role = get_role
+        self._roles = {}
+        self._closures = {}
+        self._expansions = {}
+
+    def get_role(self, rolename):
+        """Returns the parsed role, loading it only the first time"""
+        if rolename not in self._roles:
+            self._roles[rolename] = self.load_role(rolename)
+        return self._roles[rolename]
+
+    def role_run_list(self, rolename, environment=None):
+        """Returns the run_list Chef uses for a role in an environment"""
+        role = self.get_role(rolename)
+        env_run_lists = role.get('env_run_lists') or {}
+        if environment in env_run_lists:
+            return env_run_lists[environment]
+        return role.get('run_list', [])
+
+    def expand_role(self, rolename, environment=None, _path=()):
+        """Returns a (roles, recipes) tuple with all roles and recipes the
+        given role includes, directly or through nested roles, in run_list
+        order and without duplicates. Aborts when roles include each other
+
+        """
+        if rolename in _path:
+            cycle = _path[_path.index(rolename):] + (rolename,)
+            abort("Found a cycle in role dependencies: {0}".format(
+                  " -> ".join(cycle)))
+        key = (rolename, environment)
+        if key not in self._closures:
+            self._closures[key] = self._expand(
+                parse(self.role_run_list(rolename, environment)),
+                environment, _path + (rolename,))
+        return self._closures[key]
+
+    def expand_run_list(self, run_list, environment=None):
+        """Returns the ordered (roles, recipes) expansion of a run_list.
+        The returned lists are shared by every caller expanding the same
+        run_list, copy them before making changes
+
+        """
+        key = (tuple(run_list), environment)
+        expansion = self._expansions.get(key)
+        if expansion is None:
+            expansion = self._expand(parse(run_list), environment, ())
+            self._expansions[key] = expansion
+        return expansion
+
+    def _expand(self, items, environment, path):
+        roles, recipes = [], []
+        for item in items:
+            if item.type == 'recipe':
+                recipes.append(item.name)
+            elif item.type == 'role':
+                nested_roles, nested_recipes = self.expand_role(
+                    item.name, environment, path)
+                roles.append(item.name)
+                roles.extend(nested_roles)
+                recipes.extend(nested_recipes)
+        return _unique(roles), _unique(recipes)
@@ -24,7 +24,7 @@ from fabric.contrib.console import confirm
 from paramiko.config import SSHConfig as _SSHConfig
 
 import littlechef
-from littlechef import solo, lib, chef
+from littlechef import solo, lib, chef, codec, hoststate, multiplex, timing
 
 # Fabric settings
 import fabric
@@ -92,8 +92,7 @@ def new_kitchen():
 
 def nodes_with_role(rolename):
     """Configures a list of nodes that have the given role in their run list"""
-    nodes = [n['name'] for n in
-             lib.get_nodes_with_role(rolename, env.chef_environment)]
+    nodes = lib.NodeIndex().search('role', rolename, env.chef_environment)
     if not len(nodes):
         print("No nodes found with role '{0}'".format(rolename))
         sys.exit(0)
@@ -103,8 +102,8 @@ def nodes_with_role(rolename):
 def nodes_with_recipe(recipename):
     """Configures a list of nodes that have the given recipe in their run list
     """
-    nodes = [n['name'] for n in
-             lib.get_nodes_with_recipe(recipename, env.chef_environment)]
+    nodes = lib.NodeIndex().search('recipe', recipename,
+                                   env.chef_environment)
     if not len(nodes):
         print("No nodes found with recipe '{0}'".format(recipename))
         sys.exit(0)
@@ -113,9 +112,8 @@ def nodes_with_recipe(recipename):
 
 def nodes_with_tag(tag):
     """Sets a list of nodes that have the given tag assigned and calls node()"""
-    nodes = lib.get_nodes_with_tag(tag, env.chef_environment,
-                                   littlechef.include_guests)
-    nodes = [n['name'] for n in nodes]
+    nodes = lib.NodeIndex().search_tag(tag, env.chef_environment,
+                                       littlechef.include_guests)
     if not len(nodes):
         print("No nodes found with tag '{0}'".format(tag))
         sys.exit(0)
@@ -124,13 +122,12 @@ def nodes_with_tag(tag):
 
 def node(*nodes):
     """Selects and configures a list of nodes. 'all' configures all nodes"""
-    chef.build_node_data_bag()
     if not len(nodes) or nodes[0] == '':
         abort('No node was given')
     elif nodes[0] == 'all':
         # Fetch all nodes and add them to env.hosts
-        for node in lib.get_nodes(env.chef_environment):
-            env.hosts.append(node['name'])
+        for node in lib.get_node_handles(env.chef_environment):
+            env.hosts.append(node.name)
         if not len(env.hosts):
             abort('No nodes found in /nodes/')
         message = "Are you sure you want to configure all nodes ({0})".format(
@@ -145,6 +142,17 @@ def node(*nodes):
         # A list of nodes was given
         env.hosts = list(nodes)
     env.all_hosts = list(env.hosts)  # Shouldn't be needed
+    chef.build_node_data_bag(env.hosts)
+    # Pack the kitchen once, before nodes are configured in parallel
+    if littlechef.sync_mode == 'archive':
+        chef.build_kitchen_archive()
+    elif littlechef.sync_mode == 'manifest':
+        chef.build_kitchen_manifest()
+    if littlechef.prune_cookbooks:
+        chef.get_cookbook_dependencies()
+    if multiplex.enabled():
+        # Shared by the nodes configured in parallel, removed at exit
+        multiplex.get_control_dir()
 
     # Check whether another command was given in addition to "node:"
     if not(littlechef.__cooking__ and
@@ -154,6 +162,9 @@ def node(*nodes):
            'nodes_with_tag:' not in sys.argv[-1]):
         # If user didn't type recipe:X, role:Y or deploy_chef,
         # configure the nodes
+        if (littlechef.sync_mode == 'archive' and
+                littlechef.fanout_width and not __testing__):
+            chef.distribute_kitchen_archive(env.hosts)
         with settings():
             execute(_node_runner)
         chef.remove_local_node_data_bag()
@@ -199,6 +210,7 @@ def deploy_chef(ask="yes", version="13.12.14"):
 
     if not __testing__:
         solo.install(version)
+        hoststate.clear(env.host_string)
         solo.configure()
 
         # Build a basic node file if there isn't one already
@@ -207,7 +219,7 @@ def deploy_chef(ask="yes", version="13.12.14"):
             output = sudo('ohai -l warn')
         if output.succeeded:
             try:
-                ohai = json.loads(output)
+                ohai = codec.loads(output)
             except ValueError:
                 abort("Could not parse ohai's output"
                       ":\n  {0}".format(output))
@@ -289,13 +301,16 @@ def plugin(name):
 @hosts('api')
 def list_nodes():
     """List all configured nodes"""
-    lib.print_nodes(lib.get_nodes(env.chef_environment))
+    lib.print_nodes(node.load() for node in
+                    lib.get_node_handles(env.chef_environment))
 
 
 @hosts('api')
 def list_nodes_detailed():
     """Show a detailed list of all nodes"""
-    lib.print_nodes(lib.get_nodes(env.chef_environment), detailed=True)
+    lib.print_nodes((node.load() for node in
+                     lib.get_node_handles(env.chef_environment)),
+                    detailed=True)
 
 
 @hosts('api')
@@ -378,6 +393,7 @@ def _check_appliances():
     return (not bool(missing)), missing
 
 
+@timing.timed('readconfig')
 def _readconfig():
     """Configures environment variables"""
     config = ConfigParser.SafeConfigParser()
@@ -514,6 +530,116 @@ def _readconfig():
         if not env.node_work_path:
             abort('The "node_work_path" option cannot be empty')
 
+    # Persistent index of parsed kitchen files
+    try:
+        littlechef.kitchen_cache = config.getboolean('kitchen', 'cache')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "cache" option must be true or false')
+
+    # Number of changed kitchen files above which they are parsed in parallel
+    try:
+        littlechef.parallel_load_threshold = config.getint(
+            'kitchen', 'parallel_load_threshold')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "parallel_load_threshold" option must be a number')
+
+    # How metadata.json is generated out of metadata.rb
+    try:
+        littlechef.metadata_evaluator = config.get('kitchen',
+                                                   'metadata_evaluator')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    else:
+        if littlechef.metadata_evaluator not in ('knife', 'python'):
+            abort('The "metadata_evaluator" option must be either "knife" '
+                  'or "python"')
+    try:
+        littlechef.sync_mode = config.get('kitchen', 'sync_mode')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    else:
+        if littlechef.sync_mode not in ('rsync', 'archive', 'manifest'):
+            abort('The "sync_mode" option must be one of "rsync", '
+                  '"archive" or "manifest"')
+    try:
+        littlechef.metadata_workers = config.getint('kitchen',
+                                                    'metadata_workers')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "metadata_workers" option must be a number')
+
+    # Number of processes merging node data bag items
+    try:
+        littlechef.merge_workers = config.getint('kitchen', 'merge_workers')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "merge_workers" option must be a number')
+
+    # Which node data bag items are built and shipped to every node
+    try:
+        littlechef.node_data_bag_scope = config.get('node_data_bag', 'scope')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    else:
+        if littlechef.node_data_bag_scope not in ('all', 'environment',
+                                                  'search'):
+            abort('The node_data_bag "scope" option must be one of "all", '
+                  '"environment" or "search"')
+    try:
+        littlechef.node_data_bag_search = [
+            term.strip() for term in
+            config.get('node_data_bag', 'search').split(',') if term.strip()]
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
+    # Share one ssh connection per node between rsync processes
+    try:
+        littlechef.ssh_multiplexing = config.getboolean('connection',
+                                                        'multiplexing')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "multiplexing" option must be true or false')
+
+    # Distribute the kitchen archive from node to node
+    try:
+        littlechef.fanout_width = config.getint('kitchen', 'fanout')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "fanout" option must be a number')
+    if littlechef.fanout_width and littlechef.sync_mode != 'archive':
+        abort('The "fanout" option needs "sync_mode = archive"')
+    try:
+        littlechef.fanout_ssh_options = config.get('kitchen',
+                                                   'fanout_ssh_options')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
+    # Seconds the known setup of a node is trusted
+    try:
+        littlechef.remote_state_ttl = config.getint('kitchen',
+                                                    'remote_state_ttl')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "remote_state_ttl" option must be a number')
+
+    # Only ship the cookbooks each node needs
+    try:
+        littlechef.prune_cookbooks = config.getboolean('kitchen',
+                                                       'prune_cookbooks')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        abort('The "prune_cookbooks" option must be true or false')
+
     # Follow symlinks
     try:
         env.follow_symlinks = config.getboolean('kitchen', 'follow_symlinks')
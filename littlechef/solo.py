@@ -14,6 +14,8 @@
 #
 """Chef Solo deployment"""
 import os
+import base64
+import hashlib
 import subprocess
 
 from fabric.api import *
@@ -22,12 +24,24 @@ from fabric.contrib.files import exists, upload_template
 from fabric.utils import abort
 
 from StringIO import StringIO
+from jinja2 import Environment, FileSystemLoader
 
-from littlechef import cookbook_paths, colors
+from littlechef import cookbook_paths, colors, hoststate, timing
 from littlechef import LOGFILE
 
 # Path to local patch
 BASEDIR = os.path.abspath(os.path.dirname(__file__).replace('\\', '/'))
+GEM = '/opt/chef/embedded/bin/gem'
+# Uploaded to the home directory of the deployment user
+BOOTSTRAP_FILE = '.littlechef-bootstrap.sh'
+BOOTSTRAP_STATUS = 'littlechef-bootstrap:'
+BOOTSTRAP_EOF = 'LITTLECHEF_EOF'
+# Where the bootstrap script leaves environment.rb, in node_work_path
+ENVIRONMENT_LIB = '.littlechef-environment.rb'
+# Bootstrap steps skipped when the node is known to be set up the same way.
+# Not chown, as every chef-solo run leaves root owned files in the cache dir
+CACHEABLE_STEPS = ('cache_dir', 'logging_path', 'etc_chef', 'formatter',
+                   'solo_rb', 'environment_lib')
 
 
 def install(version):
@@ -43,41 +57,102 @@ def install(version):
             sudo('rm /tmp/install.sh')
 
 
-def configure(current_node=None):
-    """Deploy chef-solo specific files"""
+@timing.timed('solo_configure')
+def configure(current_node=None, node_file=None, data_bag_secret=None):
+    """Deploy chef-solo specific files, and the node.json file and the
+    encrypted data bag secret when given
+
+    Everything is done by a single bootstrap script, uploaded together with
+    the files it installs in one transfer and run with one sudo call. The
+    steps already done by the last bootstrap are skipped when the node's
+    fingerprint shows it was not changed since
+
+    """
     current_node = current_node or {}
-    # Ensure that the /tmp/chef-solo/cache directory exist
+    host = env.host_string
     cache_dir = "{0}/cache".format(env.node_work_path)
+    logging_path = os.path.dirname(LOGFILE)
+    steps = [
+        # Ensure that the /tmp/chef-solo/cache directory exist
+        ('cache_dir', 'mkdir -p {0}'.format(cache_dir), None),
+        # Change ownership of /tmp/chef-solo/ so that we can rsync
+        ('chown', 'chown -R {0} {1}'.format(env.user, env.node_work_path),
+         None),
+        ('logging_path', 'mkdir -p {0}'.format(logging_path), None),
+        ('etc_chef', 'mkdir -m 774 -p /etc/chef', None),
+        ('formatter', '{0} list -eqi chef-formatters-simple | grep -q true'
+         ' || {0} install chef-formatters-simple'.format(GEM), None),
+        ('solo_rb', 'write /etc/chef/solo.rb 644',
+         _render_solo_rb(current_node)),
+        # NOTE: Chef 10 only, installed into the cookbooks after syncing
+        ('environment_lib', 'write {0} 644'.format(get_environment_lib_path()),
+         _read(os.path.join(BASEDIR, 'environment.rb'))),
+    ]
+    if node_file:
+        steps.append(('node_json', 'write /etc/chef/node.json 400',
+                      _read(node_file)))
+    if data_bag_secret:
+        steps.append(('data_bag_secret',
+                      'write /etc/chef/encrypted_data_bag_secret 600',
+                      _read(os.path.expanduser(data_bag_secret))))
+    digests = dict((name, hashlib.sha1(command + '\0' + (payload or ''))
+                    .hexdigest()) for name, command, payload in steps
+                   if name in CACHEABLE_STEPS)
+    state = hoststate.get(host)
+    known = state.get('steps', {})
+    cached = [name for name in digests if known.get(name) == digests[name]]
+    script = build_bootstrap(steps, _get_fingerprint_command(),
+                             state.get('fingerprint'), cached)
+    try:
+        output = _run_bootstrap(script, steps)
+    except BaseException:
+        # Whatever ran may have changed the node
+        hoststate.clear(host)
+        raise
+    before, after = get_bootstrap_fingerprints(output)
+    values = {'fingerprint': after, 'steps': digests}
+    if state.get('fingerprint') and before != state['fingerprint']:
+        # Changed behind our back, chef may be gone as well
+        values['chef_version'] = None
+    hoststate.update(host, **values)
+
+
+def _run_bootstrap(script, steps):
+    """Uploads and runs the bootstrap script, aborts unless all steps
+    succeeded. Returns its output
+
+    """
     # First remote call, could go wrong
     try:
-        cache_exists = exists(cache_dir)
+        with settings(hide('everything')):
+            remote_path = put(StringIO(script), BOOTSTRAP_FILE, mode=0600)[0]
     except EOFError as e:
         abort("Could not login to node, got: {0}".format(e))
-    if not cache_exists:
-        with settings(hide('running', 'stdout'), warn_only=True):
-            output = sudo('mkdir -p {0}'.format(cache_dir))
-        if output.failed:
-            error = "Could not create {0} dir. ".format(env.node_work_path)
-            error += "Do you have sudo rights?"
-            abort(error)
-    # Change ownership of /tmp/chef-solo/ so that we can rsync
-    with hide('running', 'stdout'):
-        with settings(warn_only=True):
-            output = sudo(
-                'chown -R {0} {1}'.format(env.user, env.node_work_path))
-        if output.failed:
-            error = "Could not modify {0} dir. ".format(env.node_work_path)
-            error += "Do you have sudo rights?"
-            abort(error)
-    # Set up chef solo configuration
-    logging_path = os.path.dirname(LOGFILE)
-    if not exists(logging_path):
-        sudo('mkdir -p {0}'.format(logging_path))
-    if not exists('/etc/chef'):
-        sudo('mkdir -m 774 -p /etc/chef')
-    if not "true" in run("/opt/chef/embedded/bin/gem list -eqi chef-formatters-simple", quiet=True):
-        sudo('/opt/chef/embedded/bin/gem install chef-formatters-simple')
-    # Set parameters and upload solo.rb template
+    except SystemExit:
+        error = ("Failed to upload '/etc/chef/solo.rb'\nThis "
+                 "can happen when the deployment user does not have a "
+                 "home directory, which is needed as a temporary location")
+        abort(error)
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = sudo('sh {0}'.format(remote_path))
+    status = get_bootstrap_status(output)
+    if status is None:
+        # The script did not run, it removes itself otherwise
+        with settings(hide('everything'), warn_only=True):
+            run('rm -f {0}'.format(remote_path))
+        status = ('failed', 'cache_dir', None)
+    if status[0] != 'ok':
+        abort(_get_bootstrap_error(steps, *status[1:]))
+    return output
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _render_solo_rb(current_node):
+    """Returns the contents of solo.rb for the given node"""
     reversed_cookbook_paths = cookbook_paths[:]
     reversed_cookbook_paths.reverse()
     cookbook_paths_list = '[{0}]'.format(', '.join(
@@ -93,18 +168,149 @@ def configure(current_node=None):
         'no_proxy': env.no_proxy,
         'formatter': env.formatter
     }
-    with settings(hide('everything')):
-        try:
-            upload_template('client.rb.j2', '/etc/chef/solo.rb',
-                            context=data, use_sudo=True, backup=False,
-                            template_dir=BASEDIR, use_jinja=True, mode=0644)
-        except SystemExit:
-            error = ("Failed to upload '/etc/chef/solo.rb'\nThis "
-                     "can happen when the deployment user does not have a "
-                     "home directory, which is needed as a temporary location")
-            abort(error)
-    with hide('stdout'):
-        sudo('chown root:$(id -g -n root) {0}'.format('/etc/chef/solo.rb'))
+    jenv = Environment(loader=FileSystemLoader(BASEDIR))
+    return jenv.get_template('client.rb.j2').render(**data).encode('utf-8')
+
+
+def get_environment_lib_path():
+    """Returns the path the bootstrap script leaves environment.rb at,
+    out of the synchronized kitchen directories
+    NOTE: Chef 10 only
+
+    """
+    return os.path.join(env.node_work_path, ENVIRONMENT_LIB)
+
+
+def _get_fingerprint_command():
+    """Returns a shell command whose output changes whenever the state left
+    by the cacheable bootstrap steps, or the chef installation, changes
+
+    """
+    dirs = [env.node_work_path, "{0}/cache".format(env.node_work_path),
+            os.path.dirname(LOGFILE), '/etc/chef']
+    return ("stat -c '%n %U %F' {0}; sha1sum /etc/chef/solo.rb {1}; "
+            "stat -c '%n %i %Y' /opt/chef/bin/chef-solo; "
+            "ls -d /opt/chef/embedded/lib/ruby/gems/*/gems/"
+            "chef-formatters-simple-*".format(' '.join(dirs),
+                                               get_environment_lib_path()))
+
+
+def get_fingerprint():
+    """Returns the current fingerprint of the node, as reported by the
+    bootstrap script
+
+    """
+    with settings(hide('everything'), warn_only=True):
+        output = sudo(_fingerprint_pipeline(_get_fingerprint_command()))
+    return output.strip() if output.succeeded else None
+
+
+def _fingerprint_pipeline(command):
+    """Returns a shell command printing the checksum of the output of the
+    given fingerprint command
+
+    """
+    return '{{ {0}; }} 2>/dev/null | cksum | cut -d " " -f 1'.format(command)
+
+
+def build_bootstrap(steps, fingerprint=None, known=None, cached=()):
+    """Returns a shell script running the given (name, command, payload)
+    steps in order. A payload is fed to the standard input of its command,
+    and 'write <path> <mode>' installs it as a root owned file.
+
+    The script stops at the first step which fails, and its last output
+    line is a status line: 'ok', or 'failed' with the name and exit code of
+    the step.
+
+    When a fingerprint command is given, the script reports the fingerprint
+    of the node before and after running the steps in 'fingerprint' status
+    lines, and skips the cached steps if the first one is the known one
+
+    """
+    lines = [
+        "#!/bin/sh",
+        "# LittleChef bootstrap, only lives until run",
+        'rm -f "$0"',
+        'fail() {{ echo "{0} failed $1 $2"; exit 1; }}'.format(
+            BOOTSTRAP_STATUS),
+        'write() {',
+        '  (umask 077 && base64 -d > "$1.tmp") &&',
+        '  chown root:$(id -g -n root) "$1.tmp" && chmod $2 "$1.tmp" &&',
+        '  mv -f "$1.tmp" "$1"',
+        '}',
+    ]
+    if fingerprint:
+        lines.extend([
+            'fingerprint() {{ {0}; }}'.format(
+                _fingerprint_pipeline(fingerprint)),
+            'before=$(fingerprint)',
+            'cached=',
+            'echo "{0} fingerprint $before"'.format(BOOTSTRAP_STATUS),
+        ])
+    if fingerprint and known and cached:
+        lines.append('[ "$before" = "{0}" ] && cached=1'.format(known))
+    for name, command, payload in steps:
+        skip = '[ -n "$cached" ] || ' if name in cached else ''
+        if payload is None:
+            lines.append("{0}{{ {1}; }} || fail {2} $?".format(
+                skip, command, name))
+        else:
+            lines.append("{0}{{ {1}; }} <<'{2}' || fail {3} $?".format(
+                skip, command, BOOTSTRAP_EOF, name))
+            lines.append(base64.encodestring(payload).rstrip('\n'))
+            lines.append(BOOTSTRAP_EOF)
+    if fingerprint:
+        lines.append('echo "{0} fingerprint $(fingerprint)"'.format(
+            BOOTSTRAP_STATUS))
+    lines.append('echo "{0} ok"'.format(BOOTSTRAP_STATUS))
+    return '\n'.join(lines) + '\n'
+
+
+def get_bootstrap_status(output):
+    """Returns the status of a bootstrap script run from its output:
+    ('ok', None, None), ('failed', step, exit code) or None when the script
+    did not run
+
+    """
+    for fields in reversed(_get_status_lines(output)):
+        if fields == ['ok']:
+            return ('ok', None, None)
+        elif len(fields) == 3 and fields[0] == 'failed':
+            return ('failed', fields[1], fields[2])
+    return None
+
+
+def get_bootstrap_fingerprints(output):
+    """Returns the fingerprints of the node before and after a bootstrap
+    script run, None when not reported
+
+    """
+    fingerprints = [fields[1] for fields in _get_status_lines(output)
+                    if len(fields) == 2 and fields[0] == 'fingerprint']
+    return tuple((fingerprints + [None, None])[:2])
+
+
+def _get_status_lines(output):
+    return [line[len(BOOTSTRAP_STATUS):].split()
+            for line in str(output).splitlines()
+            if line.startswith(BOOTSTRAP_STATUS)]
+
+
+def _get_bootstrap_error(steps, step, code):
+    """Returns the error message for a failed bootstrap step, the same
+    given when the steps were run one by one
+
+    """
+    if step == 'cache_dir':
+        error = "Could not create {0} dir. ".format(env.node_work_path)
+        return error + "Do you have sudo rights?"
+    elif step == 'chown':
+        error = "Could not modify {0} dir. ".format(env.node_work_path)
+        return error + "Do you have sudo rights?"
+    command = dict((name, cmd) for name, cmd, _ in steps)[step]
+    return ("sudo() received nonzero return code {0} while executing!"
+            "\n\nRequested: {1}".format(code, command))
+
 
 # Lock node
 def lock(current_node, reason):
@@ -0,0 +1,114 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Private staging directory for the files generated by one invocation
+
+The node data bag and the node.json files uploaded to nodes are written to
+.littlechef/staging/<pid>-<random>, never to the kitchen itself, so that
+several 'fix' processes can run at the same time from the same kitchen.
+The directory is removed when the process that created it exits, or by a
+later invocation once its lock file is no longer held, should that process
+have been killed. Without fcntl (Windows) abandoned directories are kept.
+
+"""
+import os
+import errno
+import atexit
+import shutil
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    # Windows, where abandoned staging directories are not removed
+    fcntl = None
+
+STAGING_DIR = os.path.join('.littlechef', 'staging')
+# Every staging directory has a lock file of the same name, locked for as
+# long as the process which created it, or its forked workers, run
+LOCK_SUFFIX = '.lock'
+
+# (pid of the creating process, absolute path, lock file descriptor)
+_staging = []
+
+
+def get_path(*parts):
+    """Returns the absolute path of the given file or directory inside the
+    staging directory of this invocation, which is created on first use
+
+    """
+    if not _staging:
+        try:
+            os.makedirs(STAGING_DIR)
+        except OSError as e:
+            # Created by another invocation in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+        _remove_abandoned()
+        # The lock is held before the directory exists, so that no other
+        # invocation can take the directory for an abandoned one
+        fd, lock_path = tempfile.mkstemp(dir=STAGING_DIR, suffix=LOCK_SUFFIX,
+                                         prefix='{0}-'.format(os.getpid()))
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        path = os.path.abspath(lock_path[:-len(LOCK_SUFFIX)])
+        os.mkdir(path, 0700)
+        _staging.append((os.getpid(), path, fd))
+    return os.path.join(_staging[0][1], *parts)
+
+
+def _remove_abandoned():
+    """Removes the staging directories whose lock is no longer held"""
+    if fcntl is None:
+        return
+    for filename in os.listdir(STAGING_DIR):
+        if not filename.endswith(LOCK_SUFFIX):
+            continue
+        lock_path = os.path.join(STAGING_DIR, filename)
+        try:
+            fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            # Removed by another invocation
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Still in use
+            pass
+        else:
+            shutil.rmtree(lock_path[:-len(LOCK_SUFFIX)], ignore_errors=True)
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+        finally:
+            os.close(fd)
+
+
+def remove():
+    """Removes the staging directory, only from the process which created
+    it and not from forked workers
+
+    """
+    if _staging and _staging[0][0] == os.getpid():
+        pid, path, fd = _staging[0]
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.remove(path + LOCK_SUFFIX)
+        except OSError:
+            pass
+        os.close(fd)
+        del _staging[:]
+
+
+atexit.register(remove)
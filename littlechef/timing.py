@@ -0,0 +1,197 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Per-phase timing of a run, enabled with 'fix --profile'
+
+Every timed phase appends a record to a file of the staging directory, one
+file per process, so that the phases of hosts configured in parallel by
+Fabric's worker processes are collected as well. When the process which
+started the run exits, the records are aggregated into a JSON report with
+fleet-wide percentiles and the slowest hosts of every phase.
+
+"""
+import os
+import sys
+import json
+import time
+import math
+import atexit
+from functools import wraps
+
+from fabric.api import env
+
+import littlechef
+from littlechef import staging
+
+PROFILE_DIR = os.path.join('.littlechef', 'profile')
+PERCENTILES = (50, 90, 95, 99)
+# Number of slowest hosts listed per phase
+SLOWEST = 5
+
+# Pid of the process which writes the report and time the run started
+_owner = os.getpid()
+_started = time.time()
+
+
+def timed(phase):
+    """Decorator which records the duration of every call as the given phase,
+    for the host being configured if any, when profiling is enabled
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not littlechef.profile:
+                return func(*args, **kwargs)
+            start = time.time()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record(phase, start, time.time() - start, failed)
+        return wrapper
+    return decorator
+
+
+def _records_path():
+    return staging.get_path('profile', '{0}.json'.format(os.getpid()))
+
+
+def record(phase, start, seconds, failed=False):
+    """Appends a timing record for the current host"""
+    path = _records_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    data = {'phase': phase, 'host': env.host_string or None,
+            'start': start, 'seconds': seconds, 'failed': failed}
+    with open(path, 'a') as f:
+        f.write(json.dumps(data) + '\n')
+
+
+def get_records():
+    """Returns the records written by all processes of this run"""
+    directory = staging.get_path('profile')
+    records = []
+    if not os.path.isdir(directory):
+        return records
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def build_report(records, wall=None):
+    """Aggregates timing records into a report dictionary:
+    * run: total seconds of every phase which ran outside of a host
+    * phases: count, total, min, max, mean, percentiles and slowest hosts of
+      every per-host phase
+    * hosts: seconds of every phase for each host
+
+    """
+    run = {}
+    hosts = {}
+    for rec in records:
+        if rec['host'] is None:
+            run[rec['phase']] = run.get(rec['phase'], 0) + rec['seconds']
+        else:
+            phases = hosts.setdefault(rec['host'], {})
+            # A phase can run more than once per host
+            phases[rec['phase']] = (phases.get(rec['phase'], 0) +
+                                    rec['seconds'])
+    by_phase = {}
+    for host, phases in hosts.items():
+        for phase, seconds in phases.items():
+            by_phase.setdefault(phase, []).append((seconds, host))
+    phases = {}
+    for phase, timings in by_phase.items():
+        timings.sort(reverse=True)
+        values = sorted(seconds for seconds, _ in timings)
+        summary = {
+            'count': len(values),
+            'total': sum(values),
+            'min': values[0],
+            'max': values[-1],
+            'mean': sum(values) / len(values),
+            'slowest': [{'host': host, 'seconds': seconds}
+                        for seconds, host in timings[:SLOWEST]],
+        }
+        for percent in PERCENTILES:
+            summary['p{0}'.format(percent)] = percentile(values, percent)
+        phases[phase] = summary
+    failed = sorted(set(rec['host'] for rec in records
+                        if rec['failed'] and rec['host'] is not None))
+    return {
+        'command': ' '.join(sys.argv),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                 time.localtime(_started)),
+        'wall': wall,
+        'parallel': bool(env.parallel),
+        'host_count': len(hosts),
+        'failed_hosts': failed,
+        'run': run,
+        'phases': phases,
+        'hosts': hosts,
+    }
+
+
+def print_report(report):
+    """Prints a summary table of the per-host phases"""
+    print("\nProfile of {0} hosts, {1:.2f}s:".format(
+          report['host_count'], report['wall'] or 0))
+    for phase, seconds in sorted(report['run'].items()):
+        print("  {0:<22}{1:>9.3f}s".format(phase, seconds))
+    if not report['phases']:
+        return
+    print("  {0:<22}{1:>10}{2:>10}{3:>10}{4:>10}  {5}".format(
+          "phase", "p50", "p95", "max", "total", "slowest host"))
+    for phase, summary in sorted(report['phases'].items(),
+                                 key=lambda p: -p[1]['total']):
+        print("  {0:<22}{1:>9.3f}s{2:>9.3f}s{3:>9.3f}s{4:>9.3f}s  {5}".format(
+              phase, summary['p50'], summary['p95'], summary['max'],
+              summary['total'], summary['slowest'][0]['host']))
+
+
+def write_report():
+    """Writes the report of this run, only from the process which started
+    it. Returns the path of the report
+
+    """
+    if not littlechef.profile or os.getpid() != _owner:
+        return None
+    report = build_report(get_records(), time.time() - _started)
+    path = littlechef.profile
+    if path is True:
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        path = os.path.join(PROFILE_DIR, time.strftime(
+            '%Y%m%d-%H%M%S', time.localtime(_started)) + '.json')
+    with open(path, 'w') as f:
+        f.write(json.dumps(report, indent=2, sort_keys=True))
+    print_report(report)
+    print("Profile report saved to {0}".format(path))
+    return path
+
+
+# Registered after the staging directory removal, so that it runs before it
+atexit.register(write_report)
@@ -0,0 +1,85 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from littlechef import archive
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.kitchen = tempfile.mkdtemp()
+        os.chdir(self.kitchen)
+        for path in ['roles', 'cookbooks/vim/recipes', 'cookbooks/.git']:
+            os.makedirs(path)
+        self._write('roles/base.json', '{}')
+        self._write('cookbooks/vim/recipes/default.rb', 'package "vim"')
+        self._write('cookbooks/.git/HEAD', 'ref: master')
+        self.paths = ['./roles', './cookbooks']
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_list_files(self):
+        """Should lay out directories under their own name, like rsync"""
+        entries = archive.list_files(self.paths + ['./missing'])
+        self.assertEqual([arcname for arcname, _ in entries], [
+            'cookbooks', 'cookbooks/vim', 'cookbooks/vim/recipes',
+            'cookbooks/vim/recipes/default.rb', 'roles', 'roles/base.json'])
+
+    def test_content_hash(self):
+        """Should only change when the contents change"""
+        first = archive.content_hash(archive.list_files(self.paths))
+        os.utime('roles/base.json', (0, 0))
+        self.assertEqual(archive.content_hash(archive.list_files(self.paths)),
+                         first)
+        self._write('roles/base.json', '{"name": "base"}')
+        self.assertNotEqual(
+            archive.content_hash(archive.list_files(self.paths)), first)
+
+    def test_build(self):
+        """Should write the archive once, named after its hash"""
+        entries = archive.list_files(self.paths)
+        digest, path = archive.build(entries, 'out', 'kitchen')
+        self.assertEqual(os.path.basename(path),
+                         'kitchen-{0}.tar.gz'.format(digest))
+        tar = tarfile.open(path)
+        self.assertEqual(sorted(tar.getnames()),
+                         sorted(arcname for arcname, _ in entries))
+        tar.close()
+        os.utime(path, (0, 0))
+        self.assertEqual(archive.build(entries, 'out', 'kitchen'),
+                         (digest, path))
+        self.assertEqual(os.path.getmtime(path), 0)
+        self.assertEqual(os.listdir('out'), [os.path.basename(path)])
+
+    def test_diff_manifests(self):
+        """Should list changed files, and removed or retyped ones to delete"""
+        old = {'roles': 'd', 'roles/a.json': 'f644:1', 'roles/b.json': 'f644:2',
+               'roles/c': 'd', 'roles/d.json': 'f644:4'}
+        new = {'roles': 'd', 'roles/a.json': 'f644:1', 'roles/b.json': 'f644:3',
+               'roles/c': 'l:a.json', 'roles/e.json': 'f644:5'}
+        self.assertEqual(archive.diff_manifests(old, new),
+                         (['roles/b.json', 'roles/c', 'roles/e.json'],
+                          ['roles/c', 'roles/d.json']))
+        self.assertEqual(archive.diff_manifests(new, new), ([], []))
@@ -0,0 +1,67 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import unittest
+from copy import deepcopy
+
+from littlechef import chef
+from littlechef.attributes import LayeredAttributes, materialize
+
+
+class TestLayeredAttributes(unittest.TestCase):
+    def setUp(self):
+        self.layers = [
+            {'apache': {'port': 80, 'modules': ['ssl'], 'conf': {'a': 1}},
+             'users': {}},
+            {'apache': {'port': 8080, 'conf': {'b': 2}}},
+            {'apache': {'conf': 'inline'}, 'users': {'tom': {'uid': 1}}},
+            {'apache': {'conf': {}}, 'debug': True},
+        ]
+
+    def _update_dct(self, layers):
+        merged = {}
+        for layer in deepcopy(layers):
+            chef.update_dct(merged, layer)
+        return merged
+
+    def test_same_as_update_dct(self):
+        """Should resolve keys the way update_dct merges the layers"""
+        view = LayeredAttributes(self.layers)
+        self.assertEqual(view.materialize(), self._update_dct(self.layers))
+        self.assertEqual(view['apache']['port'], 8080)
+        self.assertEqual(view['apache']['conf'], 'inline')
+        self.assertEqual(sorted(view['users'].keys()), ['tom'])
+
+    def test_layers_are_not_modified(self):
+        """Should write to a private layer"""
+        original = deepcopy(self.layers)
+        view = LayeredAttributes(self.layers)
+        view['apache']['port'] = 443
+        view['users']['tom']['gid'] = 4
+        view['new'] = 'value'
+        self.assertEqual(self.layers, original)
+        self.assertEqual(view['apache']['port'], 443)
+        self.assertEqual(view['users']['tom'], {'uid': 1, 'gid': 4})
+        self.assertEqual(view['new'], 'value')
+        self.assertEqual(LayeredAttributes(self.layers)['apache']['port'],
+                         8080)
+
+    def test_materialize(self):
+        """Should replace layered values by plain dictionaries"""
+        node = {'name': 'node1'}
+        node.update(LayeredAttributes(self.layers))
+        data = materialize(node)
+        self.assertEqual(type(data['apache']), dict)
+        self.assertEqual(data['apache']['modules'], ['ssl'])
+        self.assertEqual(data['name'], 'node1')
+        self.assertTrue(data['debug'])
@@ -0,0 +1,174 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import littlechef
+from littlechef import cache
+
+
+class TestKitchenIndex(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.kitchen = tempfile.mkdtemp()
+        os.chdir(self.kitchen)
+        os.mkdir('nodes')
+        self.filename = os.path.join('nodes', 'node1.json')
+        self._write({'run_list': ['recipe[vim]']})
+        cache.clear()
+
+    def tearDown(self):
+        littlechef.parallel_load_threshold = 500
+        littlechef.kitchen_cache = True
+        cache.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def _write(self, data):
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(data))
+
+    def test_get(self):
+        """Should return the parsed file contents"""
+        index = cache.get_index('nodes')
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+
+    def test_get_returns_copies(self):
+        """Should return a fresh copy on every lookup"""
+        index = cache.get_index('nodes')
+        index.get(self.filename)['run_list'].append('recipe[man]')
+        self.assertEqual(index.get(self.filename)['run_list'], ['recipe[vim]'])
+
+    def test_get_missing_file(self):
+        """Should raise IOError when the file does not exist"""
+        index = cache.get_index('nodes')
+        self.assertRaises(IOError, index.get, 'nodes/idontexist.json')
+
+    def test_get_invalid_json(self):
+        """Should raise ValueError when the file can't be parsed"""
+        with open(self.filename, 'w') as f:
+            f.write('{"run_list": [')
+        self.assertRaises(ValueError, cache.get_index('nodes').get,
+                          self.filename)
+
+    def test_persisted_index_is_reused(self):
+        """Should not parse an unchanged file again in a new process"""
+        cache.get_index('nodes').get(self.filename)
+        cache.flush()
+        self.assertTrue(os.path.exists(cache.get_index('nodes').path))
+        cache.clear()
+
+        def fail(data):
+            raise AssertionError("file should not be parsed again")
+        index = cache.get_index('nodes')
+        index.parse = fail
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+
+    def test_changed_file_is_parsed(self):
+        """Should parse the file again when its size or mtime changes"""
+        index = cache.get_index('nodes')
+        index.get(self.filename)
+        self._write({'run_list': ['recipe[vim]', 'recipe[man]']})
+        self.assertEqual(index.get(self.filename)['run_list'],
+                         ['recipe[vim]', 'recipe[man]'])
+
+    def test_corrupt_index_is_discarded(self):
+        """Should start with an empty index when the stored one is corrupt"""
+        index = cache.get_index('nodes')
+        os.makedirs(cache.CACHE_DIR)
+        with open(index.path, 'w') as f:
+            f.write('garbage')
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+
+    def test_retain(self):
+        """Should drop entries of files which no longer exist"""
+        index = cache.get_index('nodes')
+        index.get(self.filename)
+        index.retain([])
+        self.assertEqual(index.entries, {})
+
+    def test_summarized_bodies(self):
+        """Should keep the summaries in the index and the contents apart"""
+        summarize = lambda data: {'length': len(data['run_list'])}
+        index = cache.get_index('nodes', summarize)
+        self.assertEqual(index.get_summary(self.filename), {'length': 1})
+        self.assertEqual(index.entries[self.filename][1], None)
+        body_path = index._body_path(self.filename)
+        self.assertTrue(os.path.exists(body_path))
+        cache.flush()
+        cache.clear()
+
+        def fail(data):
+            raise AssertionError("file should not be parsed again")
+        index = cache.get_index('nodes', summarize)
+        index.parse = fail
+        self.assertEqual(index.get_summary(self.filename), {'length': 1})
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+        index.retain([])
+        self.assertFalse(os.path.exists(body_path))
+
+    def test_summarized_bodies_without_cache(self):
+        """Should not keep the contents when the kitchen cache is disabled"""
+        littlechef.kitchen_cache = False
+        index = cache.get_index('nodes', lambda data: {})
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+        self.assertEqual(index.entries[self.filename], (
+            index.entries[self.filename][0], None, {}))
+        self.assertFalse(os.path.exists(index.bodies_dir))
+        self.assertEqual(index.get(self.filename), {'run_list': ['recipe[vim]']})
+
+    def test_prefetch(self):
+        """Should parse out of date files in worker processes"""
+        littlechef.parallel_load_threshold = 2
+        filenames = []
+        for i in range(4):
+            filename = os.path.join('nodes', 'node{0}.json'.format(i))
+            with open(filename, 'w') as f:
+                f.write(json.dumps({'run_list': ['recipe[vim{0}]'.format(i)]}))
+            filenames.append(filename)
+        index = cache.get_index('nodes')
+        with patch.object(cache.multiprocessing, 'cpu_count') as mock_count:
+            mock_count.return_value = 2
+            index.prefetch(filenames)
+        self.assertEqual(sorted(index.entries), sorted(filenames))
+
+        def fail(data):
+            raise AssertionError("file should not be parsed again")
+        index.parse = fail
+        for i, filename in enumerate(filenames):
+            self.assertEqual(index.get(filename)['run_list'],
+                             ['recipe[vim{0}]'.format(i)])
+
+    def test_prefetch_invalid_json(self):
+        """Should leave files which can't be parsed to get()"""
+        littlechef.parallel_load_threshold = 1
+        with open(self.filename, 'w') as f:
+            f.write('{"run_list": [')
+        index = cache.get_index('nodes')
+        with patch.object(cache.multiprocessing, 'cpu_count') as mock_count:
+            mock_count.return_value = 2
+            index.prefetch([self.filename])
+        self.assertEqual(index.entries, {})
+        self.assertRaises(ValueError, index.get, self.filename)
+
+    def test_prefetch_below_threshold(self):
+        """Should not start worker processes for a few changed files"""
+        index = cache.get_index('nodes')
+        index.prefetch([self.filename])
+        self.assertEqual(index.entries, {})
@@ -0,0 +1,60 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import json
+import unittest
+
+from littlechef import codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_loads(self):
+        """Should parse JSON documents"""
+        self.assertEqual(codec.loads('{"run_list": ["recipe[vim]"], "a": 0.1}'),
+                         {'run_list': ['recipe[vim]'], 'a': 0.1})
+
+    def test_loads_error_message(self):
+        """Should raise ValueError with the standard library's message"""
+        bad = '{"run_list": ['
+        try:
+            json.loads(bad)
+        except ValueError as e:
+            expected = str(e)
+        try:
+            codec.loads(bad)
+        except ValueError as e:
+            self.assertEqual(str(e), expected)
+        else:
+            self.fail("ValueError not raised")
+
+    def test_loads_trailing_comma(self):
+        """Should refuse a trailing comma, like the standard library"""
+        self.assertRaises(ValueError, codec.loads,
+                          '{"run_list": ["role[base]"],}')
+        self.assertRaises(ValueError, codec.loads, '["role[base]",]')
+
+    def test_loads_leading_zero(self):
+        """Should refuse numbers with leading zeros"""
+        self.assertRaises(ValueError, codec.loads, '{"port": 0080}')
+
+    def test_loads_big_integer(self):
+        """Should parse integers wider than 64 bits"""
+        self.assertEqual(codec.loads('[123456789012345678901234567890]'),
+                         [123456789012345678901234567890])
+
+    def test_dumps_pretty(self):
+        """Should write committed files exactly like json.dumps"""
+        node = {"run_list": ["role[base]"], "b": {"z": 1.0 / 3, "a": u"caf\xe9"}}
+        self.assertEqual(codec.dumps_pretty(node),
+                         json.dumps(node, indent=4, sort_keys=True))
+        self.assertEqual(codec.loads(codec.dumps(node)), node)
@@ -1,3 +1,4 @@
+import imp
 import unittest
 import subprocess
 import os
@@ -46,6 +47,34 @@ class BaseTest(unittest.TestCase):
         return proc.communicate()
 
 
+class TestArguments(unittest.TestCase):
+    def parse(self, *args):
+        """Returns the options parsed by fix from the given arguments"""
+        dont_write_bytecode = sys.dont_write_bytecode
+        argv = sys.argv
+        sys.dont_write_bytecode = True
+        try:
+            fix_module = imp.load_source('fix', join(littlechef_top, 'fix'))
+            sys.argv = ['fix'] + list(args)
+            return fix_module.parse_arguments()[1]
+        finally:
+            sys.argv = argv
+            sys.dont_write_bytecode = dont_write_bytecode
+
+    def test_profile(self):
+        """Should not take the command following --profile as a file"""
+        args = self.parse('--profile', 'node:web1')
+        self.assertEqual(args['commands'], ['node:web1'])
+        self.assertTrue(args['profile'])
+        self.assertEqual(args['profile_file'], None)
+
+    def test_profile_file(self):
+        """Should save the profile to the file given to --profile-file"""
+        args = self.parse('--profile-file', 'profile.json', 'node:web1')
+        self.assertEqual(args['commands'], ['node:web1'])
+        self.assertEqual(args['profile_file'], 'profile.json')
+
+
 class TestConfig(BaseTest):
 
     def tearDown(self):
@@ -0,0 +1,133 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+from littlechef import fanout
+
+# Local stand-in for ssh, where every host is a directory of ROOT and the
+# forced command of the run's key runs the host's script, corrupting the
+# copies sent to 'bad'
+FAKE_SSH = """#!/bin/sh
+# fake_ssh [options] user@host < file
+for destination; do :; done
+host=${destination#*@}
+if [ "$host" = bad ]; then
+    { cat; echo; } | (cd "$ROOT/$host" && sh fanout.sh)
+else
+    cd "$ROOT/$host" && exec sh fanout.sh
+fi
+"""
+
+
+class TestFanout(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bin = tempfile.mkdtemp()
+        self.ssh = os.path.join(self.bin, 'ssh')
+        with open(self.ssh, 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(self.ssh, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.bin)
+
+    def _distribute(self, hosts, width):
+        """Installs the scripts of the hosts, uploads a file to the seeds and
+        runs their scripts, returns the hosts reported to hold a good copy
+
+        """
+        content = 'kitchen archive\n' * 100
+        digest = hashlib.sha1(content).hexdigest()
+        addresses = dict((host, ('root@' + host, 22)) for host in hosts)
+        seeds, children = fanout.build_tree(hosts, width)
+        for host in hosts:
+            os.mkdir(os.path.join(self.root, host))
+            script = fanout.build_script(
+                host, children, addresses, 'kitchen.tgz', digest,
+                key='key', ssh=self.ssh, receive=host not in seeds)
+            with open(os.path.join(self.root, host, 'fanout.sh'), 'w') as f:
+                f.write(script)
+        reported = []
+        for seed in seeds:
+            with open(os.path.join(self.root, seed, 'kitchen.tgz'), 'w') as f:
+                f.write(content)
+            process = subprocess.Popen(
+                ['sh', 'fanout.sh'], cwd=os.path.join(self.root, seed),
+                env=dict(os.environ, ROOT=self.root), stdout=subprocess.PIPE)
+            reported.extend(fanout.get_distributed(
+                process.communicate()[0]))
+        holding = [host for host in hosts if os.path.exists(
+                   os.path.join(self.root, host, 'kitchen.tgz'))]
+        return sorted(reported), holding
+
+    def test_build_tree(self):
+        """Should give every host up to width children"""
+        hosts = ['node{0}'.format(i) for i in range(8)]
+        seeds, children = fanout.build_tree(hosts, 2)
+        self.assertEqual(seeds, ['node0', 'node1'])
+        self.assertEqual(children['node0'], ['node2', 'node3'])
+        self.assertEqual(children['node1'], ['node4', 'node5'])
+        self.assertEqual(children['node2'], ['node6', 'node7'])
+        self.assertEqual(children['node3'], [])
+        # Every host is reached exactly once
+        reached = seeds + sum(children.values(), [])
+        self.assertEqual(sorted(reached), hosts)
+
+    def test_distribute(self):
+        """Should forward the file to every host through the tree"""
+        hosts = ['node{0}'.format(i) for i in range(10)]
+        reported, holding = self._distribute(hosts, 2)
+        self.assertEqual(reported, sorted(hosts))
+        self.assertEqual(holding, hosts)
+
+    def test_corrupt_copy(self):
+        """Should drop a corrupt copy and not forward it"""
+        hosts = ['node0', 'node1', 'bad', 'node3', 'node4', 'node5',
+                 'node6', 'node7']
+        # bad is the one forwarding to node6 and node7
+        reported, holding = self._distribute(hosts, 2)
+        self.assertEqual(reported, ['node0', 'node1', 'node3', 'node4',
+                                    'node5'])
+        self.assertEqual(holding, ['node0', 'node1', 'node3', 'node4',
+                                   'node5'])
+
+    def test_authorized_key(self):
+        """Should authorize the run's key for the script only, and revoke it
+        """
+        home = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(home, '.ssh'))
+            keys = os.path.join(home, '.ssh', 'authorized_keys')
+            with open(keys, 'w') as f:
+                f.write('ssh-ed25519 AAAAother operator\n')
+            subprocess.check_call(['sh', '-c', fanout.authorize_command(
+                'ssh-ed25519 AAAArun littlechef-fanout-1\n', 'fanout.sh')],
+                cwd=home)
+            with open(keys) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[1], 'command="sh fanout.sh",'
+                             + fanout.KEY_OPTIONS +
+                             ' ssh-ed25519 AAAArun littlechef-fanout-1')
+            subprocess.check_call(['sh', '-c', fanout.revoke_command(
+                'littlechef-fanout-1')], cwd=home)
+            with open(keys) as f:
+                self.assertEqual(f.read(), 'ssh-ed25519 AAAAother operator\n')
+        finally:
+            shutil.rmtree(home)
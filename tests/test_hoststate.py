@@ -0,0 +1,88 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import littlechef
+from littlechef import hoststate
+
+
+class TestHostState(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.kitchen = tempfile.mkdtemp()
+        os.chdir(self.kitchen)
+        hoststate._updated.clear()
+        littlechef.remote_state_ttl = 3600
+
+    def tearDown(self):
+        littlechef.remote_state_ttl = 0
+        littlechef.refresh_remote_state = False
+        hoststate._updated.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def test_update(self):
+        """Should merge the values recorded for a host"""
+        self.assertEqual(hoststate.get('node1'), {})
+        hoststate.update('node1', fingerprint='123')
+        hoststate.update('node1', chef_version='Chef: 13.12.14')
+        state = hoststate.get('node1')
+        self.assertEqual(state['fingerprint'], '123')
+        self.assertEqual(state['chef_version'], 'Chef: 13.12.14')
+        self.assertEqual(hoststate.get('node2'), {})
+        hoststate.clear('node1')
+        self.assertEqual(hoststate.get('node1'), {})
+
+    def test_expired(self):
+        """Should not trust a state checked longer than the TTL ago"""
+        hoststate.update('node1', fingerprint='123')
+        littlechef.remote_state_ttl = 60
+        path = hoststate._state_path('node1')
+        with open(path, 'r') as f:
+            state = json.loads(f.read())
+        state['checked'] = time.time() - 120
+        with open(path, 'w') as f:
+            f.write(json.dumps(state))
+        hoststate._updated.clear()
+        self.assertEqual(hoststate.get('node1'), {})
+        # What was not checked again is dropped
+        hoststate.update('node1', chef_version='Chef: 13.12.14')
+        self.assertEqual(sorted(hoststate.get('node1')),
+                         ['checked', 'chef_version'])
+
+    def test_refresh(self):
+        """Should ignore known states but keep those checked in the run"""
+        hoststate.update('node1', fingerprint='123')
+        hoststate._updated.clear()
+        littlechef.refresh_remote_state = True
+        self.assertFalse(hoststate.enabled())
+        self.assertEqual(hoststate.get('node1'), {})
+        hoststate.update('node1', chef_version='Chef: 13.12.14')
+        hoststate.update('node1', fingerprint='456')
+        littlechef.refresh_remote_state = False
+        self.assertEqual(hoststate.get('node1')['fingerprint'], '456')
+        self.assertEqual(hoststate.get('node1')['chef_version'],
+                         'Chef: 13.12.14')
+
+    def test_disabled(self):
+        """Should not use known states with a TTL of 0, the default"""
+        hoststate.update('node1', fingerprint='123')
+        littlechef.remote_state_ttl = 0
+        self.assertFalse(hoststate.enabled())
+        self.assertEqual(hoststate.get('node1'), {})
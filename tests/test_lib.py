@@ -13,8 +13,14 @@
 #
 import os
 import json
+import shlex
+import shutil
+import tarfile
+import tempfile
+import subprocess
 
 from fabric.api import env
+from fabric.operations import _AttributeString
 from mock import patch
 from nose.tools import raises
 
@@ -22,7 +28,8 @@ import sys
 env_path = "/".join(os.path.dirname(os.path.abspath(__file__)).split('/')[:-1])
 sys.path.insert(0, env_path)
 
-from littlechef import chef, lib, solo, exceptions
+import littlechef
+from littlechef import chef, lib, solo, exceptions, cache, staging, archive
 from test_base import BaseTest
 
 littlechef_src = os.path.split(os.path.normpath(os.path.abspath(__file__)))[0]
@@ -30,24 +37,135 @@ littlechef_top = os.path.normpath(os.path.join(littlechef_src, '..'))
 
 
 class TestSolo(BaseTest):
+    def setUp(self):
+        super(TestSolo, self).setUp()
+        env.node_work_path = '/tmp/chef-solo'
+        env.http_proxy = env.https_proxy = env.no_proxy = None
+
     def test_configure_no_sudo_rights(self):
         """Should abort when user has no sudo rights"""
         env.host_string = "extranode"
-        with patch.object(solo, 'exists') as mock_exists:
-            mock_exists.return_value = False
+        with patch.object(solo, 'put') as mock_put:
             with patch.object(solo, 'sudo') as mock_sudo:
                 mock_sudo.failed = True
-                self.assertRaises(SystemExit, solo.configure)
+                with patch.object(solo, 'run') as mock_run:
+                    self.assertRaises(SystemExit, solo.configure)
+                    # Removes the bootstrap script, which did not run
+                    self.assertTrue(mock_run.called)
 
     @raises(SystemExit)
-    @patch('littlechef.solo.exists')
-    def test_configure_bad_credentials(self, mock_exists):
+    @patch('littlechef.solo.put')
+    def test_configure_bad_credentials(self, mock_put):
         """Should return True when node has been synced"""
-        mock_exists.side_effect = EOFError(
+        mock_put.side_effect = EOFError(
             '/usr/lib64/python2.6/getpass.py:83: GetPassWarning: '
             'Can not control echo on the terminal.')
         solo.configure()
 
+    @patch('littlechef.hoststate.clear')
+    @patch('littlechef.solo.sudo')
+    @patch('littlechef.solo.put')
+    def test_configure_interrupted(self, mock_put, mock_sudo, mock_clear):
+        """Should forget the known state of a node whose setup broke off"""
+        env.host_string = "extranode"
+        mock_put.return_value = ['.littlechef-bootstrap.sh']
+        mock_sudo.side_effect = KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, solo.configure)
+        mock_clear.assert_called_with('extranode')
+
+    def test_bootstrap(self):
+        """Should run the steps in order and stop at the first failure"""
+        directory = tempfile.mkdtemp()
+        try:
+            script = os.path.join(directory, 'bootstrap.sh')
+            steps = [
+                ('first', 'base64 -d > {0}/payload'.format(directory),
+                 'line 1\n\0line 2'),
+                ('second', 'false', None),
+                ('third', 'touch {0}/third'.format(directory), None),
+            ]
+            with open(script, 'w') as f:
+                f.write(solo.build_bootstrap(steps))
+            output = subprocess.Popen(['sh', script],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            self.assertEqual(solo.get_bootstrap_status(output),
+                             ('failed', 'second', '1'))
+            with open(os.path.join(directory, 'payload'), 'rb') as f:
+                self.assertEqual(f.read(), 'line 1\n\0line 2')
+            self.assertFalse(os.path.exists(os.path.join(directory, 'third')))
+            # The script removes itself, as it may hold secrets
+            self.assertFalse(os.path.exists(script))
+            self.assertEqual(solo.get_bootstrap_status(
+                "littlechef-bootstrap: ok\n"), ('ok', None, None))
+            self.assertEqual(solo.get_bootstrap_status("sudo: no"), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bootstrap_cached(self):
+        """Should skip the cached steps while the fingerprint is the known one
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            script = os.path.join(directory, 'bootstrap.sh')
+            counter = os.path.join(directory, 'count')
+            steps = [('count', 'echo >> {0}'.format(counter), None)]
+            fingerprint = 'cat {0}/state'.format(directory)
+
+            def bootstrap(known=None, cached=()):
+                with open(script, 'w') as f:
+                    f.write(solo.build_bootstrap(steps, fingerprint, known,
+                                                 cached))
+                output = subprocess.Popen(
+                    ['sh', script], stdout=subprocess.PIPE).communicate()[0]
+                self.assertEqual(solo.get_bootstrap_status(output)[0], 'ok')
+                with open(counter) as f:
+                    return len(f.readlines()), \
+                        solo.get_bootstrap_fingerprints(output)
+
+            count, (before, after) = bootstrap()
+            self.assertEqual(count, 1)
+            self.assertEqual(before, after)
+            self.assertEqual(bootstrap(after, ['count'])[0], 1)
+            self.assertEqual(bootstrap(after)[0], 2)
+            with open(os.path.join(directory, 'state'), 'w') as f:
+                f.write('changed')
+            count, (before, _) = bootstrap(after, ['count'])
+            self.assertEqual(count, 3)
+            self.assertNotEqual(before, after)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bootstrap_errors(self):
+        """Should give the same errors as when running the steps one by one"""
+        env.host_string = "extranode"
+        steps = [('chown', 'chown -R me /tmp/chef-solo', None),
+                 ('etc_chef', 'mkdir -m 774 -p /etc/chef', None)]
+        self.assertEqual(solo._get_bootstrap_error(steps, 'chown', '1'),
+                         "Could not modify /tmp/chef-solo dir. "
+                         "Do you have sudo rights?")
+        self.assertEqual(solo._get_bootstrap_error(steps, 'etc_chef', '1'),
+                         "sudo() received nonzero return code 1 while "
+                         "executing!\n\nRequested: mkdir -m 774 -p /etc/chef")
+
+    @patch('littlechef.chef.sudo')
+    @patch('littlechef.solo.get_fingerprint')
+    @patch('littlechef.hoststate.get')
+    def test_chef_test_fingerprint(self, mock_state, mock_fingerprint,
+                                   mock_sudo):
+        """Should only trust the known chef version while the node's
+        fingerprint is unchanged
+
+        """
+        env.host_string = 'extranode'
+        mock_state.return_value = {'chef_version': 'Chef: 13.12.14',
+                                   'fingerprint': '123'}
+        mock_fingerprint.return_value = '123'
+        self.assertTrue(chef.chef_test())
+        self.assertFalse(mock_sudo.called)
+        mock_fingerprint.return_value = '456'
+        mock_sudo.return_value = 'sudo: chef-solo: command not found'
+        self.assertFalse(chef.chef_test())
+        self.assertTrue(mock_sudo.called)
 
 class TestLib(BaseTest):
 
@@ -89,6 +207,26 @@ class TestLib(BaseTest):
         self.assertEqual(len(lib.get_nodes("production")), 3)
         self.assertEqual(len(lib.get_nodes("staging")), 1)
 
+    def test_get_node_handles(self):
+        """Should return lazy handles without parsing unchanged nodes"""
+        lib.get_node_handles()
+        nodes_cache = lib._nodes_cache()
+        with patch.object(nodes_cache, 'parse') as mock_parse:
+            handles = lib.get_node_handles('production')
+            self.assertEqual([h.name for h in handles],
+                             ['testnode1', 'testnode3.mydomain.com', 'testnode4'])
+            self.assertEqual(handles[0]['chef_environment'], 'production')
+        self.assertFalse(mock_parse.called)
+
+    def test_lazy_node_attributes(self):
+        """Should parse the node body when an attribute is accessed"""
+        handle = lib.get_node_handles('staging')[0]
+        self.assertEqual(handle['name'], 'testnode2')
+        self.assertEqual(handle['run_list'], ['role[all_you_can_eat]'])
+        self.assertEqual(handle.get('tags', []), [])
+        self.assertTrue('subversion' in handle)
+        self.assertEqual(handle.load(), lib.get_node('testnode2'))
+
     def test_nodes_with_role(self):
         """Should return nodes when role is present in the explicit run_list"""
         nodes = list(lib.get_nodes_with_role('all_you_can_eat'))
@@ -187,6 +325,80 @@ class TestLib(BaseTest):
         nodes = list(lib.get_nodes_with_tag('top', '_default'))
         self.assertEqual(len(nodes), 1)
 
+    def test_get_roles_in_node_recursive(self):
+        """Should return all nested roles in run_list order"""
+        node = lib.get_node('nestedroles1')
+        self.assertEqual(lib.get_roles_in_node(node), ['top_level_role'])
+        self.assertEqual(lib.get_roles_in_node(node, recursive=True),
+                         ['top_level_role', 'sub_role', 'sub_sub_role', 'base'])
+
+    def test_role_graph_loads_roles_once(self):
+        """Should read each role file only once per graph"""
+        graph = lib.RoleGraph()
+        with patch.object(lib, '_get_role', wraps=lib._get_role) as mock_get:
+            for name in ['nestedroles1', 'testnode2', 'nestedroles1']:
+                graph.expand_run_list(lib.get_node(name)['run_list'])
+        loaded = [c[0][0] for c in mock_get.call_args_list]
+        self.assertEqual(sorted(loaded), sorted(set(loaded)))
+
+    def test_role_graph_expand_run_list(self):
+        """Should return ordered, deduplicated roles and recipes"""
+        graph = lib.RoleGraph()
+        roles, recipes = graph.expand_run_list(
+            ['recipe[vim]', 'role[all_you_can_eat]', 'recipe[man]'])
+        self.assertEqual(roles, ['all_you_can_eat', 'base'])
+        self.assertEqual(recipes, ['vim', 'man', 'subversion'])
+
+    def test_role_graph_cycle(self):
+        """Should abort when roles include each other"""
+        graph = lib.RoleGraph()
+        graph._roles = {
+            'a': {'run_list': ['role[b]']},
+            'b': {'run_list': ['recipe[vim]', 'role[a]']},
+        }
+        self.assertRaises(SystemExit, graph.expand_run_list, ['role[a]'])
+
+    def test_node_index_search(self):
+        """Should find nodes by expanded role, recipe, tag and environment"""
+        index = lib.NodeIndex()
+        self.assertEqual(index.search('role', 'base'),
+                         ['nestedroles1', 'testnode2'])
+        self.assertEqual(index.search('recipe', 'man'), ['testnode2', 'testnode4'])
+        self.assertEqual(index.search('tag', 'dummy'), ['testnode4'])
+        self.assertEqual(index.search('environment', 'production'),
+                         ['testnode1', 'testnode3.mydomain.com', 'testnode4'])
+        self.assertEqual(index.search('recipe', 'man', 'staging'), ['testnode2'])
+        self.assertEqual(index.search('role', 'idontexist'), [])
+
+    def test_node_index_prefix_search(self):
+        """Should return nodes with any term starting with the prefix"""
+        index = lib.NodeIndex()
+        self.assertEqual(index.search('role', 'sub_*'), ['nestedroles1'])
+        self.assertEqual(index.search('recipe', 'subversion*'),
+                         ['nestedroles1', 'testnode1', 'testnode2',
+                          'testnode3.mydomain.com'])
+        self.assertEqual(index.search('role', 'zzz*'), [])
+
+    def test_node_index_does_not_parse_unchanged_nodes(self):
+        """Should build the index from stored node summaries"""
+        lib.NodeIndex()
+        nodes_cache = lib._nodes_cache()
+        with patch.object(nodes_cache, 'parse') as mock_parse:
+            lib.NodeIndex()
+        self.assertFalse(mock_parse.called)
+
+    def test_node_index_search_tag_guests(self):
+        """Should add the guests of tagged virtualization hosts"""
+        index = lib.NodeIndex()
+        index.summaries['testnode4'] = dict(
+            index.summaries['testnode4'], guests=['testnode1', 'testnode2'])
+        self.assertEqual(index.search_tag('dummy'), ['testnode4'])
+        self.assertEqual(index.search_tag('dummy', include_guests=True),
+                         ['testnode4', 'testnode1', 'testnode2'])
+        self.assertEqual(
+            index.search_tag('dummy', 'production', include_guests=True),
+            ['testnode4', 'testnode1'])
+
     def test_list_recipes(self):
         recipes = lib.get_recipes()
         self.assertEqual(len(recipes), 6)
@@ -199,6 +411,24 @@ class TestLib(BaseTest):
         self.assertEqual(recipes[3]['name'], 'subversion::server')
         self.assertIn('subversion::testrecipe', [r['name'] for r in recipes])
 
+    @patch('littlechef.lib._metadata_is_outdated')
+    def test_recipe_catalog(self, mock_outdated):
+        """Should only rebuild the recipes of cookbooks that changed"""
+        mock_outdated.return_value = False
+        expected = lib.get_recipes()
+        with patch.object(lib, '_build_recipes_in_cookbook',
+                          wraps=lib._build_recipes_in_cookbook) as mock_build:
+            self.assertEqual(lib.get_recipes(), expected)
+            self.assertFalse(mock_build.called)
+            recipes_dir = os.path.join('cookbooks', 'vim', 'recipes')
+            st = os.stat(recipes_dir)
+            try:
+                os.utime(recipes_dir, (st.st_atime, st.st_mtime + 1))
+                self.assertEqual(lib.get_recipes(), expected)
+            finally:
+                os.utime(recipes_dir, (st.st_atime, st.st_mtime))
+        mock_build.assert_called_once_with('vim')
+
     def test_import_plugin(self):
         """Should import the given plugin"""
         plugin = lib.import_plugin("dummy")
@@ -238,6 +468,14 @@ class TestLib(BaseTest):
         }
         self.assertEqual(lib.get_environment('_default'), expected)
 
+    def test_get_shared_environment(self):
+        """Should parse a shared environment only once per process"""
+        environment = lib.get_environment('production', shared=True)
+        self.assertTrue(
+            lib.get_environment('production', shared=True) is environment)
+        self.assertFalse(lib.get_environment('production') is environment)
+        self.assertEqual(lib.get_environment('production'), environment)
+
     @raises(exceptions.FileNotFoundError)
     def test_get_nonexisting_environment(self):
         """Should raise FileNotFoundError when environment does not exist"""
@@ -245,6 +483,13 @@ class TestLib(BaseTest):
 
 
 class TestChef(BaseTest):
+    def setUp(self):
+        super(TestChef, self).setUp()
+        # Merge every node item, instead of reusing those of previous runs
+        if os.path.exists(chef.NODE_ITEMS_DIR):
+            shutil.rmtree(chef.NODE_ITEMS_DIR)
+        cache.get_store('node_data_bag').retain([])
+
     def tearDown(self):
         chef.remove_local_node_data_bag()
         super(TestChef, self).tearDown()
@@ -273,6 +518,41 @@ class TestChef(BaseTest):
             # It should *NOT* have "base" assigned
             self.assertEqual(data['run_list'], ["recipe[subversion]"])
 
+    def test_save_config_staging(self):
+        """Should write tmp_node.json to the invocation's staging directory"""
+        env.host_string = 'extranode'
+        tmp_file = chef.save_config({"run_list": []})
+        self.assertFalse(os.path.exists('tmp_extranode.json'))
+        self.assertEqual(os.path.dirname(tmp_file), staging.get_path())
+        self.assertTrue(os.path.exists(tmp_file))
+
+    def test_staging_is_private(self):
+        """Should give every invocation its own staging directory"""
+        chef.build_node_data_bag()
+        first = chef.get_node_data_bag_path()
+        self.assertFalse(os.path.exists(os.path.join('data_bags', 'node')))
+        # What a second process would see
+        saved = staging._staging[:]
+        del staging._staging[:]
+        try:
+            chef.build_node_data_bag()
+            self.assertNotEqual(chef.get_node_data_bag_path(), first)
+            self.assertTrue(os.path.exists(first))
+            staging.remove()
+        finally:
+            staging._staging[:] = saved
+
+    def test_staging_remove_abandoned(self):
+        """Should only remove staging directories whose lock is not held"""
+        path = staging.get_path()
+        abandoned = os.path.join(staging.STAGING_DIR, '1-abandoned')
+        os.mkdir(abandoned)
+        open(abandoned + staging.LOCK_SUFFIX, 'w').close()
+        staging._remove_abandoned()
+        self.assertTrue(os.path.isdir(path))
+        self.assertFalse(os.path.exists(abandoned))
+        self.assertFalse(os.path.exists(abandoned + staging.LOCK_SUFFIX))
+
     def test_get_ipaddress(self):
         """Should add ipaddress attribute when ohai returns correct IP address
         """
@@ -315,7 +595,7 @@ class TestChef(BaseTest):
     def test_build_node_data_bag(self):
         """Should create a node data bag with one item per node"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode1.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode1.json')
         self.assertTrue(os.path.exists(item_path))
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
@@ -325,16 +605,359 @@ class TestChef(BaseTest):
             'recipes' in data and data['recipes'] == ['subversion'])
         self.assertTrue(
             'recipes' in data and data['role'] == [])
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         self.assertTrue(os.path.exists(item_path))
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('id' in data and data['id'] == 'testnode2')
         self.assertTrue('recipes' in data)
-        self.assertEqual(data['recipes'], [u'subversion', u'man'])
+        self.assertEqual(data['recipes'], [u'man', u'subversion'])
         self.assertTrue('recipes' in data)
         self.assertEqual(data['role'], [u'all_you_can_eat'])
-        self.assertEqual(data['roles'], [u'base', u'all_you_can_eat'])
+        self.assertEqual(data['roles'], [u'all_you_can_eat', u'base'])
+
+    def test_build_node_data_bag_nested_roles(self):
+        """Should expand roles and recipes at any nesting level"""
+        chef.build_node_data_bag()
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'nestedroles1.json')
+        with open(item_path, 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual(data['role'], ['top_level_role'])
+        self.assertEqual(data['roles'],
+                         ['top_level_role', 'sub_role', 'sub_sub_role', 'base'])
+        self.assertEqual(data['recipes'], ['subversion'])
+
+    def _read_node_data_bag(self):
+        items = {}
+        path = chef.get_node_data_bag_path()
+        for filename in os.listdir(path):
+            with open(os.path.join(path, filename), 'rb') as f:
+                items[filename] = f.read()
+        return items
+
+    def test_build_node_data_bag_incremental(self):
+        """Should only rebuild changed items, identical to a full rebuild"""
+        chef.build_node_data_bag()
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["role[base]"]})
+        with patch.object(chef, '_add_merged_attributes',
+                          wraps=chef._add_merged_attributes) as mock_merge:
+            chef.build_node_data_bag()
+        self.assertEqual(mock_merge.call_count, 1)
+        self.assertEqual(mock_merge.call_args[0][0]['name'], 'extranode')
+        incremental = self._read_node_data_bag()
+
+        littlechef.kitchen_cache = False
+        try:
+            chef.build_node_data_bag()
+        finally:
+            littlechef.kitchen_cache = True
+        self.assertEqual(incremental, self._read_node_data_bag())
+
+        # Items of removed nodes are dropped, not those being written by
+        # another invocation
+        os.remove(os.path.join('nodes', 'extranode.json'))
+        in_progress = os.path.join(chef.NODE_ITEMS_DIR, '.tmpabc')
+        open(in_progress, 'w').close()
+        chef.build_node_data_bag()
+        self.assertFalse('extranode.json' in self._read_node_data_bag())
+        self.assertFalse(os.path.exists(
+            os.path.join(chef.NODE_ITEMS_DIR, 'extranode.json')))
+        self.assertTrue(os.path.exists(in_progress))
+
+    def test_build_node_data_bag_changed_while_merging(self):
+        """Should build an item again when its node changed while merging"""
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["role[base]"]})
+        write_node_items = chef._write_node_items
+
+        def change_node(names, *args):
+            for name in write_node_items(names, *args):
+                if name == 'extranode':
+                    chef.save_config({"run_list": []}, force=True)
+                yield name
+        with patch.object(chef, '_write_node_items', change_node):
+            chef.build_node_data_bag()
+        with patch.object(chef, '_add_merged_attributes',
+                          wraps=chef._add_merged_attributes) as mock_merge:
+            chef.build_node_data_bag()
+        self.assertEqual([c[0][0]['name'] for c in mock_merge.call_args_list],
+                         ['extranode'])
+
+    def test_build_node_data_bag_keeps_no_bodies(self):
+        """Should not keep parsed node bodies in memory while streaming"""
+        littlechef.kitchen_cache = False
+        try:
+            chef.build_node_data_bag()
+        finally:
+            littlechef.kitchen_cache = True
+        entries = lib._nodes_cache().entries
+        self.assertTrue(entries)
+        self.assertEqual([path for path, entry in entries.items()
+                          if entry[1] is not None], [])
+
+    def test_build_node_data_bag_merge_workers(self):
+        """Should build the same items in worker processes"""
+        littlechef.kitchen_cache = False
+        try:
+            chef.build_node_data_bag()
+            serial = self._read_node_data_bag()
+            littlechef.merge_workers = 2
+            chef.build_node_data_bag()
+        finally:
+            littlechef.kitchen_cache = True
+            littlechef.merge_workers = 0
+        self.assertEqual(serial, self._read_node_data_bag())
+
+    def test_build_node_data_bag_merge_workers_abort(self):
+        """Should abort when a worker can't build an item"""
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["recipe[phantom_cookbook]"]})
+        littlechef.merge_workers = 2
+        try:
+            self.assertRaises(SystemExit, chef.build_node_data_bag)
+        finally:
+            littlechef.merge_workers = 0
+
+    def test_node_data_bag_scope(self):
+        """Should select the nodes in the configured scope"""
+        self.assertEqual(chef.get_node_data_bag_names(['testnode1']), None)
+        try:
+            littlechef.node_data_bag_scope = 'environment'
+            self.assertEqual(
+                chef.get_node_data_bag_names(['root@testnode2']),
+                set(['testnode2']))
+            self.assertEqual(
+                chef.get_node_data_bag_names(['testnode1']),
+                set(['testnode1', 'testnode3.mydomain.com', 'testnode4']))
+            littlechef.node_data_bag_scope = 'search'
+            littlechef.node_data_bag_search = ['role:base', 'testnode3*']
+            self.assertEqual(
+                chef.get_node_data_bag_names(['testnode1']),
+                set(['testnode1', 'testnode2', 'nestedroles1',
+                     'testnode3.mydomain.com']))
+        finally:
+            littlechef.node_data_bag_scope = 'all'
+            littlechef.node_data_bag_search = []
+
+    def test_build_node_data_bag_scope(self):
+        """Should only build and ship the items in the hosts' scope"""
+        littlechef.node_data_bag_scope = 'environment'
+        try:
+            chef.build_node_data_bag(['testnode2', 'testnode1'])
+            # The scopes were computed once, for all hosts
+            with patch.object(lib, 'NodeIndex') as mock_index:
+                filter_file = chef._write_sync_filter({'name': 'testnode2'})
+                chef._get_node_item_entries('testnode1')
+            self.assertFalse(mock_index.called)
+            chef.build_node_data_bag(['testnode2'])
+        finally:
+            littlechef.node_data_bag_scope = 'all'
+        self.assertEqual(self._read_node_data_bag().keys(),
+                         ['testnode2.json'])
+        with open(filter_file) as f:
+            rules = f.read().splitlines()
+        os.remove(filter_file)
+        self.assertEqual(rules, ['+ /data_bags/node/testnode2.json',
+                                 '- /data_bags/node/*'])
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.run')
+    def test_upload_archives(self, mock_run, mock_put):
+        """Should skip the kitchen archive when the node already holds it"""
+        class Output(str):
+            succeeded = True
+        env.host_string = 'testnode2'
+        env.node_work_path = '/tmp/chef-solo'
+        env.follow_symlinks = False
+        env.berksfile = None
+        chef.build_node_data_bag()
+        mock_run.return_value = Output('')
+        chef._upload_archives({'name': 'testnode2'})
+        uploaded = [os.path.basename(c[0][0]) for c in mock_put.call_args_list]
+        self.assertEqual([f.split('-')[0] for f in uploaded],
+                         ['kitchen', 'node'])
+        digest = chef.build_kitchen_archive()[0]
+        self.assertTrue(digest in mock_run.call_args_list[1][0][0])
+        mock_put.reset_mock()
+        mock_run.return_value = Output(digest + '\n')
+        chef._upload_archives({'name': 'testnode2'})
+        self.assertEqual(len(mock_put.call_args_list), 1)
+        self.assertTrue(os.path.basename(
+            mock_put.call_args[0][0]).startswith('node-'))
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.run')
+    def test_upload_fanned_out_archive(self, mock_run, mock_put):
+        """Should unpack the distributed kitchen archive when still good"""
+        def output(content, failed=False):
+            result = _AttributeString(content)
+            result.failed = failed
+            result.succeeded = not failed
+            return result
+        env.host_string = 'testnode2'
+        env.node_work_path = '/tmp/chef-solo'
+        env.follow_symlinks = False
+        env.berksfile = None
+        chef.build_node_data_bag()
+        chef._fanout.update(digest='abc123', hosts=set(['testnode2']))
+        try:
+            mock_run.side_effect = [output(''), output(''), output('')]
+            chef._upload_archives({'name': 'testnode2'})
+            self.assertEqual(len(mock_put.call_args_list), 1)
+            self.assertTrue(os.path.basename(
+                mock_put.call_args[0][0]).startswith('node-'))
+            command = mock_run.call_args_list[1][0][0]
+            self.assertTrue(
+                'sha1sum ~/.littlechef-kitchen.tar.gz' in command)
+            self.assertTrue('"abc123"' in command)
+            # Uploaded by the workstation when the copy is not good
+            mock_put.reset_mock()
+            mock_run.side_effect = [output(''), output('', failed=True),
+                                    output(''), output('')]
+            chef._upload_archives({'name': 'testnode2'})
+            uploaded = [os.path.basename(c[0][0])
+                        for c in mock_put.call_args_list]
+            self.assertEqual([f.split('-')[0] for f in uploaded],
+                             ['kitchen', 'node'])
+        finally:
+            chef._fanout.update(digest=None, hosts=set())
+
+    @patch('littlechef.chef.rsync_project')
+    def test_rsync_kitchen_quoting(self, mock_rsync):
+        """Should pass paths with spaces to rsync as single arguments"""
+        directory = tempfile.mkdtemp(suffix=' kitchen')
+        try:
+            filter_file = os.path.join(directory, 'filter')
+            open(filter_file, 'w').close()
+            env.node_work_path = '/tmp/chef-solo'
+            paths = ['./roles', os.path.join(directory, 'data_bags')]
+            with patch.object(chef, '_write_sync_filter') as mock_filter:
+                mock_filter.return_value = filter_file
+                chef._rsync_kitchen({'name': 'testnode1'}, paths, '-q', '')
+            args, kwargs = mock_rsync.call_args
+            self.assertEqual(shlex.split(args[1]), paths)
+            self.assertEqual(shlex.split(kwargs['extra_opts']), [
+                '-q', '--filter=merge ' + filter_file, '--delete-excluded'])
+            self.assertFalse(os.path.exists(filter_file))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_generate_fanout_key(self):
+        """Should generate a new key for the run, marked for revocation"""
+        key_path, public_key, marker = chef._generate_fanout_key()
+        self.assertTrue(os.path.exists(key_path))
+        self.assertTrue(public_key.strip().endswith(' ' + marker))
+        self.assertNotEqual(chef._generate_fanout_key()[1], public_key)
+
+    def test_upload_delta(self):
+        """Should only ship the kitchen files which changed"""
+        kitchen = tempfile.mkdtemp()
+        node_work_path = tempfile.mkdtemp()
+        uploads = []
+
+        def fake_put(local_path, remote_path):
+            uploads.append(local_path)
+            shutil.copy(local_path, remote_path)
+
+        def fake_run(command):
+            proc = subprocess.Popen(['sh', '-c', command],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = _AttributeString(proc.communicate()[0])
+            output.return_code = proc.returncode
+            output.failed = proc.returncode != 0
+            output.succeeded = not output.failed
+            return output
+
+        def write(path, content):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+
+        def sync():
+            chef._kitchen_manifests.clear()
+            with patch.object(chef, 'put', fake_put):
+                with patch.object(chef, 'run', fake_run):
+                    chef._upload_delta({'name': 'testnode2'})
+            with tarfile.open(uploads[-1]) as tar:
+                return sorted(name for name in tar.getnames()
+                              if not name.startswith('data_bags')
+                              and not name.startswith('.littlechef'))
+
+        def remote(*parts):
+            return os.path.join(node_work_path, *parts)
+
+        env.host_string = 'deltanode'
+        env.node_work_path = node_work_path
+        env.follow_symlinks = False
+        paths = [os.path.join(kitchen, 'roles'),
+                 os.path.join(kitchen, 'cookbooks')]
+        write(os.path.join(kitchen, 'roles', 'base.json'), '{}')
+        write(os.path.join(kitchen, 'roles', 'web.json'), '{}')
+        write(os.path.join(kitchen, 'cookbooks', 'vim', 'metadata.json'), '{}')
+        chef.build_node_data_bag()
+        try:
+            with patch.object(chef, '_get_kitchen_paths', lambda: paths):
+                self.assertEqual(len(sync()), 6)
+                self.assertTrue(os.path.exists(remote('roles', 'web.json')))
+                self.assertTrue(os.path.exists(
+                    remote('data_bags', 'node', 'testnode2.json')))
+                # Nothing changed
+                self.assertEqual(sync(), [])
+                # One changed and one removed file
+                write(os.path.join(kitchen, 'roles', 'base.json'), '{"a": 1}')
+                os.remove(os.path.join(kitchen, 'roles', 'web.json'))
+                self.assertEqual(sync(), ['roles/base.json'])
+                self.assertFalse(os.path.exists(remote('roles', 'web.json')))
+                with open(remote('roles', 'base.json')) as f:
+                    self.assertEqual(f.read(), '{"a": 1}')
+                # Without local state the node's own manifest is used
+                os.remove(archive._synced_path('deltanode'))
+                write(os.path.join(kitchen, 'roles', 'db.json'), '{}')
+                self.assertEqual(sync(), ['roles/db.json'])
+                # A node that changed behind our back gets everything
+                os.remove(remote(chef.KITCHEN_ARCHIVE_MARKER))
+                self.assertEqual(len(sync()), 6)
+        finally:
+            os.remove(archive._synced_path('deltanode'))
+            shutil.rmtree(kitchen)
+            shutil.rmtree(node_work_path)
+
+    def test_cookbook_closure(self):
+        """Should only sync the cookbooks a node needs when pruning"""
+        chef._cookbook_dependencies.clear()
+        node = lib.get_node('testnode2')
+        # apache2 is a dependency of subversion
+        self.assertEqual(chef.get_cookbook_closure(node),
+                         set(['man', 'subversion', 'apache2']))
+        # Roles are loaded once per invocation, not once per node
+        chef.build_node_data_bag()
+        with patch.object(lib, 'RoleGraph') as mock_graph:
+            chef.get_cookbook_closure(node)
+            chef.get_cookbook_closure(lib.get_node('testnode1'))
+        self.assertFalse(mock_graph.called)
+        littlechef.prune_cookbooks = True
+        try:
+            filter_file = chef._write_sync_filter(node)
+        finally:
+            littlechef.prune_cookbooks = False
+        with open(filter_file) as f:
+            rules = f.read().splitlines()
+        os.remove(filter_file)
+        self.assertEqual(rules, [
+            '+ /cookbooks/apache2/***', '+ /cookbooks/man/***',
+            '+ /cookbooks/subversion/***', '- /cookbooks/*',
+            '+ /site-cookbooks/apache2/***', '+ /site-cookbooks/man/***',
+            '+ /site-cookbooks/subversion/***', '- /site-cookbooks/*'])
+        self.assertEqual(chef._write_sync_filter(node), None)
+        manifest = {'cookbooks': 'd', 'cookbooks/vim': 'd',
+                    'cookbooks/vim/metadata.json': 'f644:1',
+                    'cookbooks/man': 'd', 'roles/vim.json': 'f644:2'}
+        self.assertEqual(sorted(chef._prune_manifest(manifest,
+                                                     set(['man']))),
+                         ['cookbooks', 'cookbooks/man', 'roles/vim.json'])
 
     def test_build_node_data_bag_nonalphanumeric(self):
         """Should create a node data bag when node name contains invalid chars
@@ -344,7 +967,7 @@ class TestChef(BaseTest):
         # 'testnode3', because dots are not allowed.
         filename = 'testnode3_mydomain_com'
         nodename = filename.replace("_", ".")
-        item_path = os.path.join('data_bags', 'node', filename + '.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), filename + '.json')
         self.assertTrue(os.path.exists(item_path), "node file does not exist")
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
@@ -355,7 +978,7 @@ class TestChef(BaseTest):
         """Should add Chef's automatic attributes"""
         chef.build_node_data_bag()
         # Check node with single word fqdn
-        testnode1_path = os.path.join('data_bags', 'node', 'testnode1.json')
+        testnode1_path = os.path.join(chef.get_node_data_bag_path(), 'testnode1.json')
         with open(testnode1_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('fqdn' in data and data['fqdn'] == 'testnode1')
@@ -364,7 +987,7 @@ class TestChef(BaseTest):
 
         # Check node with complex fqdn
         testnode3_path = os.path.join(
-            'data_bags', 'node', 'testnode3_mydomain_com.json')
+            chef.get_node_data_bag_path(), 'testnode3_mydomain_com.json')
         with open(testnode3_path, 'r') as f:
             print testnode3_path
             data = json.loads(f.read())
@@ -386,7 +1009,7 @@ class TestChef(BaseTest):
     def test_attribute_merge_cookbook_default(self):
         """Should have the value found in recipe/attributes/default.rb"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -395,7 +1018,7 @@ class TestChef(BaseTest):
     def test_attribute_merge_environment_default(self):
         """Should have the value found in environment/ENV.json"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode1.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode1.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -405,7 +1028,7 @@ class TestChef(BaseTest):
         """Should have real boolean values for default cookbook attributes"""
         chef.build_node_data_bag()
         item_path = os.path.join(
-            'data_bags', 'node', 'testnode3_mydomain_com.json')
+            chef.get_node_data_bag_path(), 'testnode3_mydomain_com.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('vim' in data)
@@ -417,7 +1040,7 @@ class TestChef(BaseTest):
 
         """
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -433,7 +1056,7 @@ class TestChef(BaseTest):
     def test_attribute_merge_role_default(self):
         """Should have the value found in the roles default attributes"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -445,7 +1068,7 @@ class TestChef(BaseTest):
     def test_attribute_merge_node_normal(self):
         """Should have the value found in the node attributes"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -454,7 +1077,7 @@ class TestChef(BaseTest):
     def test_attribute_merge_role_override(self):
         """Should have the value found in the roles override attributes"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
@@ -463,17 +1086,30 @@ class TestChef(BaseTest):
     def test_attribute_merge_environment_override(self):
         """Should have the value found in the environment override attributes"""
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode1.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode1.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('subversion' in data)
         self.assertEqual(data['subversion']['password'], 'env_override_pass')
 
+    def test_attribute_catalog_compiles_defaults_once(self):
+        """Should build the cookbook default tree once per recipe list"""
+        catalog = chef.AttributeCatalog(lib.get_recipes(), lib.get_roles())
+        node = {'name': 'a', 'recipes': ['subversion']}
+        with patch.object(chef, 'build_dct', wraps=chef.build_dct) as mock:
+            first = catalog.cookbook_defaults(node)
+            calls = mock.call_count
+            second = catalog.cookbook_defaults(node)
+        self.assertTrue(calls > 0)
+        self.assertEqual(mock.call_count, calls)
+        self.assertTrue(first is second)
+        self.assertEqual(first['subversion']['repo_name'], 'repo')
+
     def test_attribute_merge_deep_dict(self):
         """Should deep-merge a dict when it is defined in two different places
         """
         chef.build_node_data_bag()
-        item_path = os.path.join('data_bags', 'node', 'testnode2.json')
+        item_path = os.path.join(chef.get_node_data_bag_path(), 'testnode2.json')
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('other_attr' in data)
@@ -490,6 +1126,31 @@ class TestChef(BaseTest):
         self.assertFalse(chef.sync_node({'name': 'extranode', 'dummy': True}))
         self.assertFalse(chef.sync_node({'name': 'extranode', 'tags': ['dummy']}))
 
+    @patch('littlechef.chef.solo.node_locked')
+    @patch('littlechef.chef.solo.configure')
+    @patch('littlechef.chef._get_ipaddress')
+    @patch('littlechef.chef._synchronize_node')
+    @patch('littlechef.chef._configure_node')
+    @patch('littlechef.chef._node_cleanup')
+    def test_sync_node_saves_after_configure(self, mock_cleanup, mock_run,
+                                             mock_sync, mock_ipaddress,
+                                             mock_configure, mock_locked):
+        """Should only save the node file once Chef Solo is configured"""
+        env.host_string = 'extranode'
+        mock_locked.return_value = False
+        test_node = {'name': 'extranode', 'run_list': []}
+        node_file = os.path.join('nodes', 'extranode.json')
+
+        def configure(current_node, filepath, data_bag_secret):
+            self.assertTrue(os.path.exists(filepath))
+            raise SystemExit
+        mock_configure.side_effect = configure
+        self.assertRaises(SystemExit, chef.sync_node, test_node)
+        self.assertFalse(os.path.exists(node_file))
+        mock_configure.side_effect = None
+        self.assertTrue(chef.sync_node(test_node))
+        self.assertTrue(os.path.exists(node_file))
+
     @patch('littlechef.chef.solo.configure')
     @patch('littlechef.chef._get_ipaddress')
     @patch('littlechef.chef._synchronize_node')
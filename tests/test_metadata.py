@@ -0,0 +1,124 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from fabric.api import env
+from mock import patch
+
+import littlechef
+from littlechef import metadata
+
+
+class TestEvaluate(unittest.TestCase):
+    def test_matches_knife(self):
+        """Should evaluate metadata.rb into what knife wrote to metadata.json"""
+        for name in ['man', 'subversion', 'vim']:
+            path = os.path.join('cookbooks', name)
+            rb = os.path.join(path, 'metadata.rb')
+            with open(rb) as f:
+                data = metadata.evaluate(f.read(), rb)
+            with open(os.path.join(path, 'metadata.json')) as f:
+                expected = json.loads(f.read())
+            data['name'] = name
+            self.assertEqual(data, expected)
+
+    def test_dependencies(self):
+        """Should default version constraints to '>= 0.0.0'"""
+        data = metadata.evaluate(
+            "depends 'apt'\ndepends('mysql', '~> 1.2')\n"
+            "%w(ubuntu debian).each { |os| supports os, '>= 10.04' }\n")
+        self.assertEqual(data['dependencies'],
+                         {'apt': '>= 0.0.0', 'mysql': '~> 1.2'})
+        self.assertEqual(data['platforms'],
+                         {'ubuntu': '>= 10.04', 'debian': '>= 10.04'})
+
+    def test_new_style_hashes(self):
+        """Should accept 'key: value' attribute options"""
+        data = metadata.evaluate(
+            'attribute "a/b", display_name: "B", required: true')
+        self.assertEqual(data['attributes']['a/b']['display_name'], 'B')
+        self.assertEqual(data['attributes']['a/b']['required'], 'required')
+
+    def test_unsupported(self):
+        """Should raise UnsupportedMetadata for other Ruby code"""
+        for source in ['name "a" if true', 'version "#{v}"',
+                       'chef_version ">= 12"', 'x = 1', 'version "abc"']:
+            self.assertRaises(metadata.UnsupportedMetadata,
+                              metadata.evaluate, source)
+
+
+class TestGenerate(unittest.TestCase):
+    def setUp(self):
+        self.kitchen = tempfile.mkdtemp()
+        self.cookbooks = []
+        for name in ['a', 'b', 'c']:
+            path = os.path.join(self.kitchen, name)
+            os.mkdir(path)
+            with open(os.path.join(path, 'metadata.rb'), 'w') as f:
+                f.write('version "1.0.{0}"\n'.format(ord(name)))
+            self.cookbooks.append((path, self.kitchen, name))
+        metadata._attempted.clear()
+        metadata.knife_installed = True
+        env.loglevel = 'info'
+
+    def tearDown(self):
+        littlechef.metadata_evaluator = 'knife'
+        metadata._attempted.clear()
+        metadata.knife_installed = True
+        shutil.rmtree(self.kitchen)
+
+    def test_python_evaluator(self):
+        """Should write metadata.json without running knife"""
+        littlechef.metadata_evaluator = 'python'
+        with patch.object(metadata, '_run_knife') as mock_knife:
+            metadata.generate(self.cookbooks)
+        self.assertFalse(mock_knife.called)
+        with open(os.path.join(self.kitchen, 'b', 'metadata.json')) as f:
+            data = json.loads(f.read())
+        self.assertEqual(data['name'], 'b')
+        self.assertEqual(data['version'], '1.0.98')
+        self.assertFalse(metadata.is_outdated(self.cookbooks[0][0]))
+
+    def test_python_evaluator_falls_back_to_knife(self):
+        """Should run knife only for metadata.rb it can't evaluate"""
+        littlechef.metadata_evaluator = 'python'
+        with open(os.path.join(self.kitchen, 'c', 'metadata.rb'), 'a') as f:
+            f.write('chef_version ">= 12"\n')
+        with patch.object(metadata, '_run_knife') as mock_knife:
+            mock_knife.side_effect = lambda c: (c, 'Generating metadata for',
+                                                '')
+            metadata.generate(self.cookbooks)
+        mock_knife.assert_called_once_with(self.cookbooks[2])
+
+    def test_knife_not_installed(self):
+        """Should only try to run knife once"""
+        with patch.object(metadata, '_run_knife') as mock_knife:
+            mock_knife.side_effect = lambda c: (c, None, None)
+            metadata.generate(self.cookbooks)
+        self.assertEqual(mock_knife.call_count, 1)
+        self.assertFalse(metadata.knife_installed)
+
+    def test_knife_pool(self):
+        """Should run knife for every outdated cookbook, once per process"""
+        with patch.object(metadata, '_run_knife') as mock_knife:
+            mock_knife.side_effect = lambda c: (c, 'Generating metadata for',
+                                                '')
+            metadata.generate(self.cookbooks)
+            metadata.generate(self.cookbooks)
+        self.assertEqual(sorted(call[0][0] for call in
+                                mock_knife.call_args_list), self.cookbooks)
@@ -0,0 +1,74 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import socket
+import unittest
+
+from mock import patch
+
+import littlechef
+from littlechef import multiplex
+
+
+class TestMultiplex(unittest.TestCase):
+    def setUp(self):
+        littlechef.ssh_multiplexing = True
+
+    def tearDown(self):
+        littlechef.ssh_multiplexing = False
+        multiplex.close()
+
+    def test_ssh_options(self):
+        """Should give every destination its own short control socket"""
+        options = multiplex.get_ssh_options('root@node1:22')
+        self.assertTrue('ControlMaster=auto' in options)
+        path = options.split('ControlPath=')[1].split()[0]
+        self.assertEqual(os.path.dirname(path), multiplex.get_control_dir())
+        self.assertTrue(len(path) < 90)
+        self.assertEqual(multiplex.get_ssh_options('root@node1:22'), options)
+        self.assertNotEqual(multiplex.get_ssh_options('root@node2:22'),
+                            options)
+
+    def test_close(self):
+        """Should stop the masters and remove the control directory"""
+        directory = multiplex.get_control_dir()
+        self.assertEqual(oct(os.stat(directory).st_mode & 0777), '0700')
+        path = os.path.join(directory, 'master')
+        master = socket.socket(socket.AF_UNIX)
+        master.bind(path)
+        with patch('littlechef.multiplex.subprocess.call') as mock_call:
+            multiplex.close()
+        master.close()
+        self.assertEqual(mock_call.call_args[0][0],
+                         ['ssh', '-o', 'ControlPath=' + path, '-O', 'exit',
+                          'littlechef'])
+        self.assertFalse(os.path.exists(directory))
+        self.assertNotEqual(multiplex.get_control_dir(), directory)
+
+    def test_close_from_worker(self):
+        """Should leave the masters of the parent process alone"""
+        directory = multiplex.get_control_dir()
+        with patch('os.getpid', return_value=-1):
+            multiplex.close()
+        self.assertTrue(os.path.exists(directory))
+
+    def test_disabled(self):
+        """Should neither give options nor create a directory when disabled"""
+        littlechef.ssh_multiplexing = False
+        self.assertFalse(multiplex.enabled())
+        self.assertEqual(multiplex.get_ssh_options('root@node1:22'), "")
+        self.assertEqual(multiplex._control, [])
+        littlechef.ssh_multiplexing = True
+        with patch('os.name', 'nt'):
+            self.assertFalse(multiplex.enabled())
@@ -0,0 +1,79 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import unittest
+
+from littlechef import runlist
+
+
+class TestParse(unittest.TestCase):
+    def test_parse_item(self):
+        """Should parse typed run_list entries"""
+        self.assertEqual(runlist.parse_item('role[base]'),
+                         ('role', 'base', None))
+        self.assertEqual(runlist.parse_item('recipe[apache2::mod_ssl]'),
+                         ('recipe', 'apache2::mod_ssl', None))
+        self.assertEqual(runlist.parse_item('recipe[vim@1.0.2]'),
+                         ('recipe', 'vim', '1.0.2'))
+        self.assertEqual(runlist.parse_item('vim'), ('recipe', 'vim', None))
+
+    def test_parse_item_memoized(self):
+        """Should parse an entry only once, surrounding whitespace included"""
+        item = runlist.parse_item(' role[web] ')
+        self.assertEqual(item, ('role', 'web', None))
+        self.assertTrue(runlist.parse_item(' role[web] ') is item)
+
+    def test_get_roles_and_recipes(self):
+        """Should return the entries listed directly, in order"""
+        run_list = ['recipe[vim]', 'role[b]', 'role[a]', 'role[b]', 'man']
+        self.assertEqual(runlist.get_roles(run_list), ['b', 'a'])
+        self.assertEqual(runlist.get_recipes(run_list), ['vim', 'man'])
+
+
+class TestExpander(unittest.TestCase):
+    def setUp(self):
+        self.roles = {
+            'web': {'run_list': ['recipe[nginx]', 'role[base]'],
+                    'env_run_lists': {'staging': ['role[base]',
+                                                  'recipe[nginx::debug]']}},
+            'base': {'run_list': ['recipe[vim]', 'recipe[nginx]']},
+        }
+        self.loaded = []
+
+        def get_role(name):
+            self.loaded.append(name)
+            return self.roles[name]
+        self.expander = runlist.Expander(get_role)
+
+    def test_expand_run_list(self):
+        """Should expand roles in place, keeping the first occurrence"""
+        roles, recipes = self.expander.expand_run_list(
+            ['recipe[man]', 'role[web]', 'recipe[vim@1.0]'])
+        self.assertEqual(roles, ['web', 'base'])
+        self.assertEqual(recipes, ['man', 'nginx', 'vim'])
+
+    def test_env_run_lists(self):
+        """Should use a role's run_list for the node's environment"""
+        roles, recipes = self.expander.expand_run_list(['role[web]'],
+                                                       'staging')
+        self.assertEqual(recipes, ['vim', 'nginx', 'nginx::debug'])
+        roles, recipes = self.expander.expand_run_list(['role[web]'],
+                                                       'production')
+        self.assertEqual(recipes, ['nginx', 'vim'])
+
+    def test_memoized(self):
+        """Should expand identical run_lists and load every role only once"""
+        first = self.expander.expand_run_list(['role[web]'])
+        self.assertTrue(self.expander.expand_run_list(['role[web]']) is first)
+        self.expander.expand_run_list(['role[base]', 'role[web]'])
+        self.assertEqual(sorted(self.loaded), ['base', 'web'])
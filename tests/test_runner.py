@@ -30,6 +30,17 @@ class TestConfig(BaseTest):
             self.assertRaises(SystemExit, runner._readconfig)
 
 
+    def test_invalid_cache_option(self):
+        """Should abort when the cache option is not a boolean"""
+        getboolean = SafeConfigParser.getboolean
+
+        def fake_getboolean(config, section, option):
+            if (section, option) == ('kitchen', 'cache'):
+                raise ValueError('Not a boolean: maybe')
+            return getboolean(config, section, option)
+        with patch.object(SafeConfigParser, 'getboolean', fake_getboolean):
+            self.assertRaises(SystemExit, runner._readconfig)
+
 class TestNode(BaseTest):
 
     def test_node_one(self):
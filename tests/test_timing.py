@@ -0,0 +1,125 @@
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from fabric.api import settings
+
+import littlechef
+from littlechef import staging, timing
+
+
+@timing.timed('configure')
+def _configure(fail=False):
+    if fail:
+        raise SystemExit(1)
+    return 'done'
+
+
+def _configure_host(host):
+    with settings(host_string=host):
+        _configure()
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(staging.get_path('profile'), ignore_errors=True)
+        littlechef.profile = True
+
+    def tearDown(self):
+        littlechef.profile = False
+        shutil.rmtree(staging.get_path('profile'), ignore_errors=True)
+
+    def test_disabled(self):
+        """Should not record anything when profiling is disabled"""
+        littlechef.profile = False
+        self.assertEqual(_configure(), 'done')
+        self.assertEqual(timing.get_records(), [])
+
+    def test_records_hosts(self):
+        """Should record every call for the current host, failed or not"""
+        with settings(host_string=None):
+            _configure()
+        with settings(host_string='node1'):
+            self.assertEqual(_configure(), 'done')
+            self.assertRaises(SystemExit, _configure, fail=True)
+        records = timing.get_records()
+        self.assertEqual([(r['host'], r['phase'], r['failed'])
+                          for r in records],
+                         [(None, 'configure', False),
+                          ('node1', 'configure', False),
+                          ('node1', 'configure', True)])
+
+    def test_records_of_worker_processes(self):
+        """Should collect the records of hosts configured in parallel"""
+        workers = [multiprocessing.Process(target=_configure_host,
+                                           args=('node{0}'.format(i),))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(r['host'] for r in timing.get_records()),
+                         ['node0', 'node1', 'node2'])
+
+    def test_percentile(self):
+        """Should return the nearest-rank percentile"""
+        values = range(1, 101)
+        self.assertEqual(timing.percentile(values, 50), 50)
+        self.assertEqual(timing.percentile(values, 99), 99)
+        self.assertEqual(timing.percentile([3], 95), 3)
+        self.assertEqual(timing.percentile([], 95), None)
+
+    def test_build_report(self):
+        """Should aggregate the phases of every host"""
+        records = [
+            {'host': None, 'phase': 'readconfig', 'seconds': 0.5,
+             'failed': False},
+            {'host': 'node1', 'phase': 'rsync', 'seconds': 1.0,
+             'failed': False},
+            {'host': 'node1', 'phase': 'rsync', 'seconds': 2.0,
+             'failed': False},
+            {'host': 'node2', 'phase': 'rsync', 'seconds': 1.0,
+             'failed': True},
+        ]
+        report = timing.build_report(records, wall=4.0)
+        self.assertEqual(report['run'], {'readconfig': 0.5})
+        self.assertEqual(report['host_count'], 2)
+        self.assertEqual(report['failed_hosts'], ['node2'])
+        self.assertEqual(report['hosts']['node1'], {'rsync': 3.0})
+        rsync = report['phases']['rsync']
+        self.assertEqual(rsync['count'], 2)
+        self.assertEqual(rsync['max'], 3.0)
+        self.assertEqual(rsync['p50'], 1.0)
+        self.assertEqual(rsync['slowest'][0],
+                         {'host': 'node1', 'seconds': 3.0})
+
+    def test_write_report(self):
+        """Should write the JSON report to the given path"""
+        directory = tempfile.mkdtemp()
+        try:
+            littlechef.profile = os.path.join(directory, 'profile.json')
+            with settings(host_string='node1'):
+                _configure()
+            self.assertEqual(timing.write_report(), littlechef.profile)
+            with open(littlechef.profile) as f:
+                report = json.load(f)
+            self.assertEqual(report['hosts'].keys(), ['node1'])
+            self.assertEqual(report['phases']['configure']['count'], 1)
+        finally:
+            shutil.rmtree(directory)